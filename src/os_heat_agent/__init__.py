@@ -1,17 +1,19 @@
 import click
 # import configparser
-import requests
-import json
 import os
+# Not `signal`, which main uses for signal payloads.
+import signal as os_signal
 import sys
 import time
-import copy
+from pathlib import Path
 
+# Only what every command needs is imported here. Everything else, the
+#   agent itself included, is imported when it's first used, so that
+#   `--help` and the small commands start quickly.
 # from os_heat_agent.deployments import get_deployment
-from os_heat_agent import deployments
-from os_heat_agent.heat import get_config
 from os_heat_agent.config import config
 from os_heat_agent.errors import ConfigurationError, MissingRuntimeError
+from os_heat_agent import logs
 import configparser
 
 import logging
@@ -31,6 +33,12 @@ log_levels = {
 
 LOG_FORMAT='%(asctime)s:%(levelname)s:%(name)s  %(message)s'
 
+def _terminate(signum, frame):
+  # atexit doesn't run when we're killed by a signal, so exit instead, as if
+  #   we'd been killed, and leave writing out the logs to atexit. Nothing is
+  #   logged here, since the signal may have interrupted logging.
+  raise SystemExit(128 + signum)
+
 # config = configparser.ConfigParser()
 # config["agent"] = {
 #   # Default to 60 seconds
@@ -46,23 +54,44 @@ LOG_FORMAT='%(asctime)s:%(levelname)s:%(name)s  %(message)s'
 #   "region": ""
 # }
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option("-c", "--config_file", default="/etc/os_heat_agent.ini", show_default=True)
 @click.option("-i", "--init_file", default="/var/lib/heat-cfntools/cfn-init-data", show_default=True)
 @click.option("-r", "--fetch_region", is_flag=True, default=False)
 @click.option("-l", "--log-level", default="WARN", show_default=True)
-def main(config_file, init_file, fetch_region, log_level):
+@click.option("--profile", is_flag=True, default=False,
+  help="Log how long each phase of every poll cycle takes.")
+@click.option("--profile-dump", default=None, type=click.Path(dir_okay=False),
+  help="Write cProfile stats for the first cycles to this file. Implies --profile.")
+@click.option("--profile-cycles", default=1, show_default=True,
+  help="Number of cycles to run under cProfile.")
+@click.pass_context
+def main(ctx, config_file, init_file, fetch_region, log_level,
+         profile, profile_dump, profile_cycles):
+  """Runs the agent, unless a command is given."""
   
-  structlog.configure(
-      wrapper_class=structlog.make_filtering_bound_logger(log_levels[log_level.upper()]),
-  )
+  config.read(config_file)
+  
+  # Events below the log level are dropped before anything is formatted,
+  #   and everything else is written out in the background.
+  logs.configure(log_levels[log_level.upper()])
    
-  log.info("starting os-heat-agent")
   if not os.path.exists(config_file):
     log.warn("missing config file %s", config_file)
     log.warn("using default configuration.")
   
-  config.read(config_file)
+  if ctx.invoked_subcommand:
+    # Commands only need the configuration loaded.
+    return
+  
+  log.info("starting os-heat-agent")
+  os_signal.signal(os_signal.SIGTERM, _terminate)
+  from os_heat_agent import (
+    deployments, changes, scheduler, executor, signals, cache, journal,
+    metrics, profiling, sources,
+  )
+  if profile or profile_dump:
+    profiling.enable(profile_dump, profile_cycles, log_levels[log_level.upper()])
   if config["cloud"]["region"] == "" and fetch_region:
     try:
       config["cloud"]["region"] = dynamically_fetch_region()
@@ -73,7 +102,6 @@ def main(config_file, init_file, fetch_region, log_level):
       log.fatal(f"No region defined and unable to fetch region: {e}")
       sys.exit(10)
   
-  log.info("polling interval: %s", config["agent"]["polling_interval"])
   log.info("cache directory: %s", config["cache"]["dir"])
   log.info("cache filename: %s", config["cache"]["filename"])
   
@@ -94,10 +122,17 @@ def main(config_file, init_file, fetch_region, log_level):
   #     obviously not ideal, and will be improved once the configuration file
   #     is moved to `toml` and uses something more akin to modern Python's
   #     tooling configurations.
+  from os_heat_agent.runners import runtime
+  runtime.configure(config["agent"])
   enabled_tools = {}
-  for name, module in deployments.TOOLS.items():
+  for name, (module_name, section) in deployments.RUNNERS.items():
+    if not config.has_section(section):
+      # Not configured, so don't even import it
+      log.debug("Disabling tool %s", name)
+      continue
     log.debug("Attempting to initialize tool %s", name)
     try:
+      module = deployments.load_runner(name)
       module.init()
       enabled_tools[name] = module
     except (configparser.NoSectionError, KeyError):
@@ -117,91 +152,173 @@ def main(config_file, init_file, fetch_region, log_level):
   else:
     log.info("Enabled runners: %s", list(deployments.TOOLS.keys()))
   
+  # Signals are delivered in the background, so a slow signal endpoint
+  #   doesn't hold up the next deployment. Anything left undelivered from a
+  #   previous run gets sent now.
+  signals.start(config["signal"], config["cache"]["dir"])
+  
+  # Only served if a port is configured; the textfile is written every poll.
+  metrics.start(config["metrics"])
+  
+  schedule = scheduler.Scheduler.from_config(config["agent"])
+  log.info("polling interval: %s-%ss", schedule.minimum, schedule.maximum)
+  
   # Okay now we can load our default values
-  while 1:
-    cache_file = "%s/%s" % (
-      config["cache"]["dir"],
-      config["cache"]["filename"]
-    )
-    current_config = ""
-    # Should we have guards around this? Hmm...
-    if not os.path.exists(cache_file):
-      log.info("Missing cache file %s", cache_file)
-      log.info("Assuming first run")
-      # Step 1, get our injected metadata from OS::Heat::SoftwareComponent
-      # This is a hardcoded path, set by OpenStack directly.
-      with open(init_file) as fh:
-        current_config = json.loads(fh.read())
-    else:
-      with open(cache_file) as fh:
-        # current config becomes the cached file
-        try:
-          current_config = json.loads(fh.read())
-        except json.decoder.JSONDecodeError:
-          # assume the current config is empty, and continue from there.
-          log.error("Could not load cache file %s; defaulting to first run.", cache_file)
-          with open(init_file) as fh:
-            current_config = json.loads(fh.read())
+  # The state is loaded once, and kept in memory from here on.
+  with profiling.span("cache_load"):
+    state = cache.StateCache.from_config(config["cache"])
+    state.load(init_file)
     
+    # The journal records every run as it happens, so it knows about anything
+    #   that ran after the state was last saved.
+    runs = journal.Journal.from_config(config["cache"])
+    runs.recover()
+    state.resume(runs.completed())
+  signals.dispatcher.listeners.append(
+    lambda entry, status: runs.signalled(entry["deployment"], status)
+  )
+  
+  try:
+    source = sources.get_source(config)
+  except ConfigurationError as e:
+    log.fatal(str(e))
+    sys.exit(13)
+  
+  while 1:
     # Fetch new config
     # The new configuration is expected to have a different metadata blob as
     #   compared to the current, saved metadata.
     
-    new_config = get_config(current_config["os-collect-config"]["cfn"], config["cloud"]["region"])
+    try:
+      with profiling.span("get_config"):
+        new_config = source.fetch(state.metadata)
+    except sources.SourceError as e:
+      # Try again next time; the metadata may be mid-update.
+      log.error(str(e))
+      # Written every poll, whatever happened, so that it's only ever stale
+      #   when the agent is.
+      metrics.export(config["metrics"])
+      schedule.record(changed=False)
+      schedule.sleep(source.wait)
+      continue
+    metrics.LAST_SUCCESSFUL_POLL.set(time.time())
+    
+    if new_config is None:
+      # The source knows nothing has changed since the last poll.
+      log.debug("Metadata unchanged")
+      metrics.DEPLOYMENTS_SKIPPED.inc(len(state.deployments))
+      signals.dispatcher.resend()
+      metrics.export(config["metrics"])
+      profiling.end_cycle()
+      schedule.record(changed=False)
+      schedule.sleep(source.wait)
+      continue
     
-    # != in Python does a deep comparison of dictionaries
-    if new_config["deployments"] != current_config["deployments"]:
-      # We have a different set of deployment. Great! 
-      for deployment in new_config["deployments"]:
-        dep = deployments.get_deployment(copy.deepcopy(deployment))
-        response = None
-        signal = {
-          "deploy_stdout": "",
-          "deploy_stderr": "",
-          "deploy_status_code": ""
-        }
-        try:
-          # Try to generate a response
-          response = dep.run()
-        except Exception as e:
-          # Generic exception sucks, but we do want any error at all to throw
-          #   back to OpenStack that the system is in a fucked state so it
-          #   rolls back and shit.
-          log.error(str(e))
-          signal["deploy_stderr"] = str(e)
-          signal["os_heat_agent_is_error"] = str(e)
-          signal["deploy_status_code"] = str(-254)
-        else:
-          # This part runs on success
-          signal["deploy_stdout"] = response.stdout
-          signal["deploy_stderr"] = response.stderr
-          signal["deploy_status_code"] = str(response.exit_code)
-          
-          if response.exit_code != 0:
-            log.debug("Reporting error")
-            signal["os_heat_agent_is_error"] = response.stderr
-        finally:
-          # The dependency object is expected to know how to send a signal
-          #   back to OpenStack, since the deployment signalling values are
-          #   expected to be present in the deployment blob.
-          resp = dep.signal(signal)
-          if resp.status_code >= 300:
-            log.error("Unsuccessful signal: %s", resp.status_code)
-        
+    # Only run the deployments that are new or have changed since we last
+    #   ran them, rather than replaying the entire list.
+    with profiling.span("diff"):
+      selected = changes.changed(new_config["deployments"], state.known())
+    metrics.DEPLOYMENTS_SKIPPED.inc(len(new_config["deployments"]) - len(selected))
+    # Dependencies on deployments that aren't being run again are satisfied
+    #   by their last run.
+    completed = set()
+    for deployment in new_config["deployments"]:
+      if state.succeeded(deployment):
+        completed.update(filter(None, [deployment.get("name"), changes.key(deployment)]))
+    results = executor.run(selected,
+      workers=config["agent"].getint("deployment_workers", fallback=1),
+      journal=runs,
+      completed=completed,
+    )
+    
+    for (deployment, reason), signal in zip(selected, results):
+      state.record(deployment, signal)
+    state.update(new_config)
+    # Only actually written if something changed.
+    with profiling.span("cache_write"):
+      state.save()
+    metrics.export(config["metrics"])
     
-    # Save the cached file out
-    with open(cache_file, "w") as fh:
-      fh.write(json.dumps(new_config))
-      
-    log.debug("sleep %s", int(config["agent"]["polling_interval"]))
-    time.sleep(int(config["agent"]["polling_interval"]))
+    # Retry anything that previously ran out of attempts, since the signal
+    #   endpoint may well be back by now.
+    signals.dispatcher.resend()
+    profiling.end_cycle()
+    
+    # Poll again quickly while things are changing, and back off while
+    #   they aren't.
+    server_id = scheduler.server_id(new_config)
+    if server_id and server_id != schedule.server_id:
+      schedule.server_id = server_id
+    schedule.record(changed=bool(selected))
+    # Sources that can tell when something's changed cut this short.
+    schedule.sleep(source.wait)
+
 
+@main.command()
+@click.option("-n", "--limit", default=20, show_default=True, help="Number of runs to show.")
+@click.option("-d", "--deployment", default=None, help="Only show runs of this deployment ID or name.")
+def history(limit, deployment):
+  """Show recent deployment runs from the journal."""
+  from os_heat_agent import journal
+  path = Path(config["cache"]["dir"]).joinpath(config["cache"]["journal_filename"])
+  if not path.exists():
+    click.echo(f"No journal at {path}", err=True)
+    sys.exit(1)
+  
+  runs = journal.Journal(path)
+  row_format = "{:<20} {:>9} {:<24} {:<8} {:>6} {:<12} {}"
+  click.echo(row_format.format("STARTED", "DURATION", "NAME", "ACTION", "EXIT", "SIGNAL", "DIGEST"))
+  for run in runs.history(limit, deployment):
+    duration = ""
+    if run["finished_at"] is not None:
+      duration = "%.1fs" % (run["finished_at"] - run["started_at"])
+    click.echo(row_format.format(
+      time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(run["started_at"])),
+      duration,
+      run["name"] or run["deployment_id"],
+      run["action"] or "",
+      "" if run["exit_code"] is None else run["exit_code"],
+      run["signal_status"] or "",
+      run["digest"][:12],
+    ))
+  runs.close()
+
+@main.command()
+@click.option("-m", "--metadata", required=True, type=click.Path(exists=True),
+  help="Metadata JSON file, or a directory of <StackName>.json files.")
+@click.option("-a", "--address", default="127.0.0.1", show_default=True)
+@click.option("-p", "--port", default=8000, show_default=True)
+@click.option("--latency", default=0.0, show_default=True, help="Seconds to delay every response.")
+@click.option("--jitter", default=0.0, show_default=True, help="Up to this many more seconds of delay.")
+@click.option("--error-rate", default=0.0, show_default=True, help="Fraction of requests to fail.")
+@click.option("--error-status", default=503, show_default=True, help="Status code of failed requests.")
+@click.option("--slow-body", default=0.0, show_default=True, help="Seconds to spread each response body over.")
+@click.option("--seed", default=None, type=int, help="Seed for choosing which requests fail.")
+@click.option("--signal-log", default=None, type=click.Path(dir_okay=False),
+  help="Append received signals to this JSON lines file.")
+def standin(metadata, address, port, latency, jitter, error_rate, error_status,
+            slow_body, seed, signal_log):
+  """Run a local stand-in for Heat's metadata and signal endpoints."""
+  from os_heat_agent import standin as stand_in
+  faults = stand_in.Faults(
+    latency=latency, jitter=jitter, error_rate=error_rate,
+    error_status=error_status, slow_body=slow_body, seed=seed,
+  )
+  server = stand_in.StandIn(metadata, address, port, faults, signal_log)
+  click.echo(f"Serving metadata from {metadata} at {server.metadata_url}")
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.stop()
 
 # Why isn't this just named "get_region"
 def dynamically_fetch_region():
   
   # Using a static URL here because this is the AWS well-known IP address,
   #   combined with the OpenStack directory structure.
+  import requests
   url = "http://169.254.169.254/openstack/latest/meta_data.json"
   metadata = requests.get(url).json()
   # Strip the trailing `a` because it's unused in Catalyst Cloud.
@@ -0,0 +1,208 @@
+"""The agent's on-disk state.
+
+The state cache records what the agent needs to carry between polls and
+  across restarts:
+
+  - the `os-collect-config` section of the most recent Heat metadata, which
+    tells us where and how to fetch the next one, and
+  - for every deployment that has been run, its fingerprint (see
+    `os_heat_agent.changes`) and the result of the last run.
+
+It is loaded once at startup and kept in memory. It is only written when it
+  has actually changed, and always atomically: to a temporary file in the
+  same directory, which is fsynced and then renamed over the old file. A
+  crash part way through a write leaves the previous state intact.
+
+Previous versions of the agent cached the whole metadata blob in
+  `[cache] filename`. If there is no state file yet, that file is migrated.
+"""
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+import structlog
+
+from os_heat_agent import changes, metrics
+
+logger = structlog.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+class StateCache:
+  """
+  Deployment state, persisted to the cache directory.
+  """
+
+  def __init__(self, path, legacy_path=None):
+    self.path = Path(path)
+    self.legacy_path = Path(legacy_path) if legacy_path else None
+    self.metadata = {}
+    self.deployments = {}
+    self._written = None
+
+  @classmethod
+  def from_config(cls, section) -> "StateCache":
+    """Build a StateCache from the `[cache]` configuration section."""
+    directory = Path(section.get("dir"))
+    return cls(
+      directory.joinpath(section.get("state_filename")),
+      directory.joinpath(section.get("filename")),
+    )
+
+  def load(self, init_file) -> None:
+    """Load the state from disk.
+
+    Falls back to migrating the legacy metadata cache, and then to the
+      initial Heat configuration in `init_file` if neither can be read.
+    """
+    state = _read(self.path)
+    if state is not None and state.get("version") == FORMAT_VERSION:
+      self.metadata = state["os-collect-config"]
+      self.deployments = state["deployments"]
+      self._written = self._serialize()
+      logger.info("Loaded state for %s deployments from %s", len(self.deployments), self.path)
+      return
+    if state is not None:
+      logger.error("Unknown state cache format in %s; ignoring", self.path)
+
+    legacy = _read(self.legacy_path) if self.legacy_path else None
+    if legacy is not None:
+      logger.info("Migrating cached metadata %s to %s", self.legacy_path, self.path)
+      self._from_metadata(legacy)
+      self.save()
+      return
+
+    logger.info("No usable state cache; assuming first run")
+    with open(init_file) as fh:
+      self._from_metadata(json.loads(fh.read()))
+
+  def _from_metadata(self, metadata: dict) -> None:
+    # Everything in a metadata blob that was cached or handed to us at boot
+    #   is treated as already run, and as having succeeded, as the agent
+    #   always has.
+    self.metadata = metadata["os-collect-config"]
+    self.deployments = {
+      ident: {"fingerprint": fingerprint, "result": {"assumed": True}}
+      for ident, fingerprint in changes.fingerprints(metadata["deployments"]).items()
+    }
+
+  def known(self) -> dict:
+    """Returns fingerprints of deployments that have been run, keyed by ID."""
+    return {
+      ident: state["fingerprint"] for ident, state in self.deployments.items()
+    }
+
+  def resume(self, completed: dict) -> None:
+    """Bring the state up to date with runs recorded in the journal.
+
+    Args:
+      completed (dict): The last completed run of each deployment, as
+        returned by `Journal.completed`.
+    """
+    for ident, run in completed.items():
+      known = self.deployments.get(ident)
+      if known and known["fingerprint"].get("digest") == run["digest"]:
+        continue
+      logger.info("Deployment %s already ran; resuming from the journal", ident)
+      # Whatever the state knew is about an older run, so the result comes
+      #   from the journal too.
+      self.deployments[ident] = {
+        "fingerprint": {"digest": run["digest"]},
+        "result": {
+          "action": run["action"],
+          "status_code": None if run["exit_code"] is None else str(run["exit_code"]),
+          "finished": int(run["finished_at"]),
+        }
+      }
+
+  def succeeded(self, deployment: dict) -> bool:
+    """Whether the last recorded run of a deployment succeeded.
+
+    Deployments that were treated as already run when the agent started
+      keeping state count as having succeeded. Anything else without a
+      recorded status code doesn't.
+    """
+    state = self.deployments.get(changes.key(deployment))
+    if state is None:
+      return False
+    result = state.get("result")
+    if not result:
+      return False
+    return bool(result.get("assumed")) or str(result.get("status_code")) == "0"
+
+  def record(self, deployment: dict, signal: dict) -> None:
+    """Record the result of running a deployment."""
+    self.deployments[changes.key(deployment)] = {
+      "fingerprint": changes.fingerprint(deployment),
+      "result": {
+        "action": changes.deploy_action(deployment),
+        "status_code": signal.get("deploy_status_code"),
+        "finished": int(time.time()),
+      }
+    }
+
+  def update(self, metadata: dict) -> None:
+    """Update from the latest Heat metadata.
+
+    Keeps the `os-collect-config` section, and forgets any deployments that
+      Heat no longer has, so that they are run again if they come back.
+    """
+    self.metadata = metadata["os-collect-config"]
+    current = set(changes.key(d) for d in metadata["deployments"])
+    for ident in set(self.deployments) - current:
+      logger.debug("Forgetting deployment %s", ident)
+      del self.deployments[ident]
+
+  def save(self) -> bool:
+    """Write the state to disk, if it has changed.
+
+    Returns:
+      bool: True if the state was written.
+    """
+    serialized = self._serialize()
+    metrics.CACHED_DEPLOYMENTS.set(len(self.deployments))
+    if serialized == self._written:
+      return False
+    write_atomic(self.path, serialized)
+    self._written = serialized
+    metrics.CACHE_BYTES.set(len(serialized.encode("utf-8")))
+    return True
+
+  def _serialize(self) -> str:
+    return json.dumps({
+      "version": FORMAT_VERSION,
+      "os-collect-config": self.metadata,
+      "deployments": self.deployments,
+    }, sort_keys=True)
+
+def _read(path: Path) -> dict:
+  if not path.exists():
+    return None
+  try:
+    with open(path) as fh:
+      return json.loads(fh.read())
+  except (OSError, json.decoder.JSONDecodeError) as e:
+    logger.error("Could not load cache file %s: %s", path, e)
+    return None
+
+def write_atomic(path, data: str) -> None:
+  """Replace the contents of `path` with `data`, without ever leaving it
+  partially written."""
+  path = Path(path)
+  fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+  try:
+    with os.fdopen(fd, "w", encoding="utf-8") as fh:
+      fh.write(data)
+      fh.flush()
+      os.fsync(fh.fileno())
+    os.replace(tmp, path)
+  except BaseException:
+    Path(tmp).unlink(missing_ok=True)
+    raise
+  # Make sure the rename itself survives a crash.
+  directory = os.open(path.parent, os.O_RDONLY)
+  try:
+    os.fsync(directory)
+  finally:
+    os.close(directory)
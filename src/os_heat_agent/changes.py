@@ -0,0 +1,106 @@
+"""Per-deployment change detection.
+
+Heat hands us the complete list of deployments for this server on every poll.
+Rather than replaying that whole list whenever anything in it differs, each
+  deployment is reduced to a fingerprint: a digest of each of the parts that
+  affect what the deployment actually does. Comparing fingerprints by
+  deployment `id` tells us which deployments are new or modified, and why.
+"""
+import hashlib
+import json
+import structlog
+
+logger = structlog.getLogger(__name__)
+
+# The parts of a deployment that, if changed, mean the deployment should be
+#   run again.
+# `deploy_action` is also present in the inputs, but is called out on its own
+#   so that a change of action is reported as such.
+FINGERPRINT_FIELDS = ["config", "inputs", "options", "deploy_action"]
+
+def key(deployment: dict) -> str:
+  """Returns the identifier used to track a deployment between polls.
+
+  Heat always gives us an `id`, but fall back to the name in case something
+    hand-written, such as an init file, doesn't.
+  """
+  return deployment.get("id") or deployment.get("name")
+
+def deploy_action(deployment: dict) -> str:
+  """Returns the `deploy_action` input value of a deployment, if present."""
+  for input in deployment.get("inputs", []):
+    if input.get("name") == "deploy_action":
+      return input.get("value")
+  return None
+
+def _digest(value) -> str:
+  # Sorted keys and fixed separators so that the same content always hashes
+  #   the same way, regardless of how Heat happened to order the JSON.
+  encoded = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+  return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+def fingerprint(deployment: dict) -> dict:
+  """Generate the fingerprint of a single deployment.
+
+  Args:
+    deployment (dict): A deployment, as received from Heat.
+
+  Returns:
+    dict: A digest for each of `FINGERPRINT_FIELDS`, plus a `digest` of the
+      deployment as a whole.
+  """
+  parts = {
+    "config":        _digest(deployment.get("config")),
+    "inputs":        _digest(deployment.get("inputs", [])),
+    "options":       _digest(deployment.get("options", {})),
+    "deploy_action": _digest(deploy_action(deployment)),
+  }
+  parts["digest"] = _digest([parts[field] for field in FINGERPRINT_FIELDS])
+  return parts
+
+def fingerprints(deployments: list) -> dict:
+  """Fingerprint a list of deployments.
+
+  Returns:
+    dict: fingerprints, keyed by deployment identifier.
+  """
+  return { key(d): fingerprint(d) for d in deployments }
+
+def changed(deployments: list, known: dict) -> list:
+  """Determine which deployments need to be run.
+
+  Args:
+    deployments (list): The deployments most recently received from Heat.
+    known (dict): Fingerprints of deployments that have already been run, as
+      returned by `fingerprints`.
+
+  Returns:
+    list: (deployment, reason) tuples for every deployment that is new or
+      has been modified, in the order Heat declared them. Unchanged
+      deployments are not returned.
+  """
+  selected = []
+  for deployment in deployments:
+    ident = key(deployment)
+    current = fingerprint(deployment)
+    previous = known.get(ident)
+
+    if not previous:
+      selected.append((deployment, "new deployment"))
+      continue
+
+    if previous.get("digest") == current["digest"]:
+      logger.debug("Deployment %s unchanged", ident)
+      continue
+
+    differences = [
+      field for field in FINGERPRINT_FIELDS
+      if previous.get(field) != current[field]
+    ]
+    selected.append((deployment, "changed %s" % ", ".join(differences)))
+
+  removed = set(known.keys()) - set(key(d) for d in deployments)
+  for ident in removed:
+    logger.debug("Deployment %s no longer present", ident)
+
+  return selected
@@ -10,14 +10,86 @@ config.read_dict(
   {
     "agent": {
       "polling_interval": 60,
-      "init_file": "/var/lib/heat-cfntools/cfn-init-data"
+      "init_file": "/var/lib/heat-cfntools/cfn-init-data",
+      # See os_heat_agent.scheduler
+      "min_polling_interval": 5,
+      "polling_decay": 2,
+      "fast_polling_window": 300,
+      "polling_jitter": 0.1,
+      # See os_heat_agent.executor
+      "deployment_workers": 1,
+      # Seconds a deployment may run for before it is terminated. 0, the
+      #   default, for no limit. See os_heat_agent.deployments
+      "timeout": 0,
+      # See os_heat_agent.runners.capture
+      "kill_grace": 10,
+      # Seconds a runner's executables and directories are trusted for
+      #   before being validated again. See os_heat_agent.runners.runtime
+      "runtime_ttl": 300,
+      # Where to get deployments from. See os_heat_agent.sources
+      "source": "cfn"
+    },
+    # See os_heat_agent.sources.local
+    "source.file": {
+      "path": "/var/lib/os-heat-agent/metadata",
+      "poll_interval": 1,
+      "inotify": "true"
+    },
+    # See os_heat_agent.sources.http
+    "source.http": {
+      "url": "",
+      "timeout": 30,
+      "validators": "os-heat-agent-http-validators.json"
+    },
+    # See os_heat_agent.sources.configdrive
+    "source.configdrive": {
+      "path": "/mnt/config",
+      "label": "config-2",
+      "file": "/var/lib/os-heat-agent/metadata.json"
     },
     "cache": {
       "dir": "/var/lib/heat-cfntools/",
-      "filename": "os-cfn-current"
+      # Metadata cache used by earlier versions, migrated on startup
+      "filename": "os-cfn-current",
+      # See os_heat_agent.cache
+      "state_filename": "os-heat-agent-state.json",
+      # See os_heat_agent.journal
+      "journal_filename": "os-heat-agent-journal.sqlite"
     },
     "cloud": {
       "region": ""
+    },
+    # See os_heat_agent.runners.capture
+    "capture": {
+      "head_bytes": 32768,
+      "tail_bytes": 32768,
+      "spool": "true",
+      "directory": "logs"
+    },
+    # See os_heat_agent.metrics
+    "metrics": {
+      "textfile": "",
+      "listen_address": "127.0.0.1",
+      "port": 0
+    },
+    # See os_heat_agent.logs
+    "logging": {
+      "renderer": "console",
+      "queue_size": 10000,
+      "policy": "drop",
+      "field_length": 4096,
+      "field_items": 100
+    },
+    # See os_heat_agent.signals
+    "signal": {
+      "timeout": 10,
+      "retries": 5,
+      "backoff": 1,
+      "max_backoff": 60,
+      "outbox": "outbox",
+      "max_bytes": 65536,
+      "error_bytes": 4096,
+      "digest": "true"
     }
   }
 )
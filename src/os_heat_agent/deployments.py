@@ -1,23 +1,48 @@
 from abc import ABCMeta, abstractmethod, ABC
+import importlib
 import os
-import requests
-import tempfile
-import subprocess
 import structlog as logging
 from pathlib import Path
 
-from .runners import babashka, shell, Output
+from .runners import Output
+from . import signals, metrics, profiling
+from .config import config
 
 from .errors import MissingInputs, MissingOutputs, NoSuchRunner
 
 logger = logging.getLogger(__name__)
 # logger.addHandler(logging.NullHandler())
 
-TOOLS = {
-  "babashka": babashka,
-  "shell":    shell,
+# Every runner we know of: the module that implements it, and the
+#   configuration section that has to exist for it to be enabled. Runners
+#   are only imported once they're needed.
+RUNNERS = {
+  "babashka": ("os_heat_agent.runners.babashka", "tools.babashka"),
+  "shell":    ("os_heat_agent.runners.shell",    "tools.shell.runners"),
 }
 
+def load_runner(name: str):
+  """Import the module for a runner.
+
+  Raises:
+    KeyError: If there is no such runner.
+  """
+  return importlib.import_module(RUNNERS[name][0])
+
+class Tools(dict):
+  """
+  Runner modules by name, imported the first time each is looked up.
+  """
+  
+  def __missing__(self, name):
+    if name not in RUNNERS:
+      raise KeyError(name)
+    module = self[name] = load_runner(name)
+    return module
+
+# Replaced with just the enabled runners when the agent starts.
+TOOLS = Tools()
+
 # Schemas!
 # TODO: Add schemas
 
@@ -40,7 +65,10 @@ heat_inputs = [
 #   But these are a reference for those.
 agent_inputs = [
   "os_heat_agent_tool",
-  "os_heat_agent_serialize"
+  "os_heat_agent_serialize",
+  "os_heat_agent_serial",
+  "os_heat_agent_timeout",
+  "os_heat_agent_depends_on"
 ]
 
 agent_outputs = [
@@ -151,7 +179,7 @@ class Deployment(ABC):
     return env
   
   
-  def signal(self, payload: dict) -> requests.Response: 
+  def signal(self, payload: dict) -> "requests.Response":
     """Signals completion of the deployment to OpenStack.
     
     If a signal has been defined by the orchestration configuration, attempt to
@@ -163,7 +191,8 @@ class Deployment(ABC):
         
     
     Returns:
-      :obj:`requests.Response` or None: a Requests response.
+      :obj:`requests.Response` or None: a Requests response, or None if the
+        signal was queued for background delivery.
     """
     # Sends the signal, if applicable, back to OpenStack.
     # Payload is expected to be a dict.
@@ -187,7 +216,7 @@ class Deployment(ABC):
     # If we don't know what verb we should be using, POST might be a good
     #   default.
     verb = self._heat_inputs.get("deploy_signal_verb", {}).get("value", "POST")
-    return requests.request(verb, url, json=payload)
+    return signals.deliver(verb, url, payload, self._data.get("id"))
     
   @property
   def tool(self):
@@ -241,6 +270,28 @@ class Deployment(ABC):
   @property
   def inputs(self) -> dict:
     return self._passthrough_inputs
+  
+  @property
+  def timeout(self) -> float:
+    """
+    Seconds this deployment may run for, or None for no limit.
+    The `os_heat_agent_timeout` option takes precedence over `timeout` in the
+      tool's configuration section, such as `[tools.babashka]`, which takes
+      precedence over `timeout` in `[agent]`.
+    """
+    value = self._options.get("os_heat_agent_timeout", None)
+    if value is None and self.tool:
+      value = config.get(f"tools.{self.tool}", "timeout", fallback=None)
+    if value is None:
+      value = config.get("agent", "timeout", fallback=None)
+    if value is None:
+      return None
+    try:
+      value = float(value)
+    except (TypeError, ValueError):
+      raise ValueError(f"Invalid timeout {value!r}")
+    # 0 turns the timeout off
+    return value if value > 0 else None
     
   def run(self) -> Output:
     """
@@ -264,9 +315,19 @@ class Deployment(ABC):
       raise NotImplementedError(f"Runner {self.tool} not supported by {self.__class__.__name__}")
     
     manifest = self.config
-    runner.pre(manifest, self.inputs)
-    response = runner.run(manifest, self.environment)
-    runner.post(manifest)
+    # Lets the runner spool output under this deployment's name.
+    manifest["deployment_id"] = self._data.get("id")
+    manifest["timeout"] = self.timeout
+    return self.execute(runner, self.tool, manifest)
+  
+  def execute(self, runner, tool: str, manifest: dict) -> Output:
+    """Hand a manifest to a runner, and return what it ran."""
+    with profiling.span("runner_pre"):
+      runner.pre(manifest, self.inputs)
+    with profiling.span("runner_run"), metrics.RUN_SECONDS.time(tool=tool):
+      response = runner.run(manifest, self.environment)
+    with profiling.span("runner_post"):
+      runner.post(manifest)
     
     logger.debug(response.stdout)
     logger.debug(response.stderr)
@@ -443,27 +504,153 @@ class StructuredConfig(Deployment):
   #   return resp
 
 class SoftwareComponent(Deployment):
-  # required_fields = [
-  #   "os_heat_agent_tool", # What tool we're using to run the configuration?
-  #   "os_heat_agent_serialize", # Should we be serializing the configuration we've gotten?
-  #   "os_heat_agent_serialization_path",  # where should we be serializing it?
-  #   "os_head_agent_serialization_strategy" # how we should be serializing? accepted options are "json", "yaml", and "shell"
-  # ]
-  # 
-  # @property
-  # def serialization_path(self):
-  #   return self._options["os_heat_agent_serialization_path"]
-  # @property
-  # def serialization_strategy(self):
-  #   return self._options["os_heat_agent_serialization_strategy"].lower()
-  # 
-  # def serialize(self):
-  #   pass
-  # 
-  def run(self):
+  """
+  An OS::Heat::SoftwareComponent: a list of configs, each with the lifecycle
+    actions it's for and the tool that runs it.
+  
+  Only the configs for the current `deploy_action` are run, in order, each
+    by its own runner. The first to fail stops the rest. Their output is
+    reported to Heat as one signal.
+  
+  Each config's `tool` is written like a deployment's group, without the
+    group name: `Shell::Bash`, or `Babashka`. A config that doesn't name a
+    tool uses the deployment's own. A config's `config` is a script, for
+    the shell runner, or a dict for runners that take structured config.
+  """
+  
+  # Heat's default, for a config that doesn't list its actions.
+  default_actions = ["CREATE", "UPDATE"]
+  
+  def normalize(self) -> None:
+    # Each config is normalized for its own runner when it's run.
     pass
+  
+  @property
+  def tool(self):
+    # Heat gives every component the group `component`, so there may well
+    #   not be a deployment-wide tool.
+    return self._tool[0] if self._tool else None
+  
+  @property
+  def action(self) -> str:
+    """The lifecycle action being deployed, such as CREATE."""
+    return str(self._heat_inputs.get("deploy_action", {}).get("value", "")).upper()
+  
+  @property
+  def components(self) -> list:
+    return self._data["config"].get("configs", [])
+  
+  def selected(self) -> list:
+    """Returns the configs to run for the current action, in order."""
+    selected = []
+    for index, component in enumerate(self.components):
+      actions = [a.upper() for a in component.get("actions") or self.default_actions]
+      if self.action not in actions:
+        logger.debug("Skipping config %s, which is only for %s", index, actions)
+        continue
+      selected.append(component)
+    return selected
+  
+  def tooling(self, component: dict) -> list:
+    """Returns the tool and sub-tools for a config.
     
+    Raises:
+      NoSuchRunner: If there is no tool for the config.
+    """
+    tool = component.get("tool")
+    tooling = [t.lower() for t in tool.split("::")] if tool else list(self._tool)
+    if not tooling:
+      raise NoSuchRunner(f"No tool for config {component.get('name', '')}".strip())
+    return tooling
+  
+  def manifest(self, component: dict, tooling: list) -> dict:
+    """Returns what to hand to the runner for a config."""
+    body = component.get("config", "")
+    if isinstance(body, dict):
+      manifest = dict(body)
+    else:
+      manifest = {
+        "command": body,
+        "serialize": self._options.get("os_heat_agent_serialize", False),
+      }
+    manifest["group"] = tooling[1:]
+    return manifest
+  
+  def validate(self) -> bool:
+    """
+    Validate this deployment.
     
+    Returns:
+      True, if the deployment is validated.
+    Raises:
+      MissingOutputs, if required OS Heat Agent outputs are not present.
+      NoSuchRunner, if a config for the current action needs a tool that
+        isn't loaded.
+    """
+    outputs = [ output["name"] for output in self._outputs ]
+    if set(agent_outputs) - set(outputs):
+      missing_outputs = set(agent_outputs) - set(outputs)
+      logger.fatal("missing os_heat_agent outputs %s", str(missing_outputs))
+      raise MissingOutputs(list(missing_outputs))
+    
+    for component in self.selected():
+      tool = self.tooling(component)[0]
+      try:
+        TOOLS[tool]
+      except KeyError:
+        logger.error("Tool %s not loaded", tool)
+        raise NoSuchRunner(f"Tool {tool} not found")
+    return True
+  
+  def run(self) -> Output:
+    """
+    Run every config for the current action, and combine their output.
+    """
+    outputs = []
+    for index, component in enumerate(self.selected()):
+      tooling = self.tooling(component)
+      try:
+        runner = TOOLS[tooling[0]]
+      except KeyError:
+        logger.fatal("No such runner: %s", tooling[0])
+        raise NoSuchRunner(tooling[0])
+      if not runner.supports(self.__class__.__name__):
+        raise NotImplementedError(f"Runner {tooling[0]} not supported by {self.__class__.__name__}")
+      
+      manifest = self.manifest(component, tooling)
+      # Spooled output is kept for each config separately.
+      manifest["deployment_id"] = f"{self._data.get('id')}.{index}"
+      manifest["timeout"] = self.timeout
+      response = self.execute(runner, tooling[0], manifest)
+      outputs.append(response)
+      if response.timed_out or response.exit_code != 0:
+        break
+    
+    if not outputs:
+      logger.info("No configs for %s in %s", self.action, self._data.get("name"))
+      return Output(stdout="", stderr="", exit_code=0)
+    if len(outputs) == 1:
+      return outputs[0]
+    last = outputs[-1]
+    return Output(
+      stdout="".join(output.stdout for output in outputs),
+      stderr="".join(output.stderr for output in outputs),
+      exit_code=last.exit_code,
+      timed_out=last.timed_out,
+      stdout_bytes=_total(outputs, "stdout"),
+      stderr_bytes=_total(outputs, "stderr"),
+      # Each config's output was spooled and digested separately.
+      parts=outputs,
+    )
+
+def _total(outputs: list, stream: str) -> int:
+  # The complete size of a stream across several outputs, counting what was
+  #   captured of any that don't know their complete size.
+  return sum(
+    getattr(output, f"{stream}_bytes") if getattr(output, f"{stream}_bytes") is not None
+    else len(getattr(output, stream).encode("utf-8"))
+    for output in outputs
+  )
     
 ###
 ### 
@@ -476,7 +663,7 @@ def get_deployment(data: dict) -> Deployment:
     return SoftwareConfig(data)
   elif type(data["config"]) is dict:
     # It could be one of two things ...
-    if type(data.get("configs", None)) is list:
+    if type(data["config"].get("configs", None)) is list:
       # It's an OS::Heat::SoftwareComponent
       return SoftwareComponent(data)
     else:
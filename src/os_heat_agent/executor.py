@@ -0,0 +1,367 @@
+"""Runs deployments and signals their results back to Heat.
+
+By default deployments are run one at a time, in the order Heat declared
+  them. Setting `deployment_workers` in the `[agent]` section to more than 1
+  runs deployments concurrently in a bounded thread pool instead, with each
+  deployment signalled as soon as it finishes.
+
+A deployment with the `os_heat_agent_serial` option set acts as a barrier in
+  parallel mode: everything declared before it finishes first, it runs on its
+  own, and only then does anything declared after it start.
+
+Deployments that share state on disk, which for now means Babashka
+  deployments that write the same variable file, are never run at the same
+  time as each other: they're run one after another, in declared order,
+  alongside everything else.
+
+A deployment can also name the deployments it needs in an
+  `os_heat_agent_depends_on` input (or option): a list of deployment names,
+  as a list, JSON list or comma separated string. Deployments are then run in
+  waves: each wave is everything whose dependencies have all finished, run
+  as above. A deployment whose dependency failed isn't run, and is signalled
+  as failed with `DEPENDENCY_STATUS_CODE`, as are deployments in a dependency
+  cycle and deployments that depend on something that isn't there. Cycles
+  are found before anything is run.
+
+A dependency that isn't being run this time around is satisfied if its last
+  run succeeded.
+"""
+import copy
+import json
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait
+import structlog
+
+from os_heat_agent import deployments, changes, signals, metrics, profiling, logs
+
+logger = structlog.getLogger(__name__)
+
+# Status code reported to Heat when running a deployment raised, rather than
+#   the runner returning an exit code.
+ERROR_STATUS_CODE = -254
+# Status code reported to Heat when a deployment was terminated for running
+#   past its timeout. Negative, like timeout(1)'s 124, so that it can't be
+#   mistaken for a command's own exit code.
+TIMEOUT_STATUS_CODE = -124
+# Status code reported to Heat for a deployment that wasn't run because of
+#   its dependencies.
+DEPENDENCY_STATUS_CODE = -125
+
+def serial(deployment: dict) -> bool:
+  """Whether a deployment has asked to be run on its own."""
+  value = deployment.get("options", {}).get("os_heat_agent_serial", False)
+  if isinstance(value, str):
+    return value.lower() in ("true", "yes", "1")
+  return bool(value)
+
+def shared(deployment: dict) -> set:
+  """Returns what a deployment writes that another deployment could too.
+
+  That's the variable file of any Babashka config, whether the deployment's
+    own or one of a SoftwareComponent's, keyed by tool and file name, which
+    is all that the runner keeps of it.
+  """
+  group = str(deployment.get("group", "")).split("::")
+  tool = group[1].lower() if len(group) > 1 else None
+  body = deployment.get("config")
+  if isinstance(body, dict) and isinstance(body.get("configs"), list):
+    components = [
+      (str(c["tool"]).split("::")[0].lower() if c.get("tool") else tool, c.get("config"))
+      for c in body["configs"] if isinstance(c, dict)
+    ]
+  else:
+    components = [(tool, body)]
+  keys = set()
+  for tool, body in components:
+    if isinstance(body, dict) and body.get("variable_file"):
+      keys.add((tool, Path(str(body["variable_file"])).name))
+  return keys
+
+def depends_on(deployment: dict) -> list:
+  """Returns the names of the deployments a deployment depends on."""
+  value = None
+  for input in deployment.get("inputs", []):
+    if input.get("name") == "os_heat_agent_depends_on":
+      value = input.get("value")
+  if value is None:
+    value = deployment.get("options", {}).get("os_heat_agent_depends_on")
+  if not value:
+    return []
+  if isinstance(value, str):
+    try:
+      value = json.loads(value)
+    except ValueError:
+      value = value.split(",")
+    if isinstance(value, str):
+      value = [value]
+  return [str(name).strip() for name in value if str(name).strip()]
+
+def name(deployment: dict) -> str:
+  return deployment.get("name") or changes.key(deployment)
+
+def _send(dep, deployment: dict, signal: dict, journal=None) -> None:
+  # The dependency object is expected to know how to send a signal back to
+  #   OpenStack, since the deployment signalling values are expected to be
+  #   present in the deployment blob.
+  with profiling.span("signal"):
+    resp = dep.signal(signal)
+  if resp is not None and resp.status_code >= 300:
+    logger.error("Unsuccessful signal: %s", resp.status_code)
+  if journal and resp is not None:
+    journal.signalled(changes.key(deployment),
+      signals.DELIVERED if resp.status_code < 300 else signals.REJECTED)
+
+def execute(deployment: dict, reason: str = None, journal=None) -> dict:
+  """Run a single deployment and signal the result.
+
+  Args:
+    deployment (dict): The deployment, as received from Heat. This is not
+      modified.
+    reason (str): Why the deployment is being run, for logging.
+    journal (:obj:`Journal`, optional): Journal to record the run in.
+
+  Returns:
+    dict: The signal payload that was sent to Heat.
+  """
+  logger.info("Running deployment %s (%s): %s",
+    deployment.get("name"), changes.key(deployment), reason)
+  with profiling.span("get_deployment"):
+    dep = deployments.get_deployment(copy.deepcopy(deployment))
+  execution = journal.started(deployment) if journal else None
+  response = None
+  signal = {
+    "deploy_stdout": "",
+    "deploy_stderr": "",
+    "deploy_status_code": ""
+  }
+  metrics.DEPLOYMENTS_RUN.inc()
+  try:
+    # Try to generate a response
+    response = dep.run()
+  except Exception as e:
+    # Generic exception sucks, but we do want any error at all to throw
+    #   back to OpenStack that the system is in a fucked state so it
+    #   rolls back and shit.
+    logger.error(str(e))
+    signal["deploy_stderr"] = str(e)
+    signal["os_heat_agent_is_error"] = str(e)
+    signal["deploy_status_code"] = str(ERROR_STATUS_CODE)
+    metrics.DEPLOYMENTS_FAILED.inc()
+  else:
+    # This part runs on success
+    signal["deploy_stdout"] = response.stdout
+    signal["deploy_stderr"] = response.stderr
+    signal["deploy_status_code"] = str(response.exit_code)
+
+    if response.timed_out:
+      message = f"Deployment timed out after {dep.timeout} seconds"
+      logger.error(message)
+      signal["deploy_stderr"] = f"{response.stderr}\n{message}" if response.stderr else message
+      signal["os_heat_agent_is_error"] = message
+      signal["deploy_status_code"] = str(TIMEOUT_STATUS_CODE)
+      metrics.DEPLOYMENTS_TIMED_OUT.inc()
+      metrics.DEPLOYMENTS_FAILED.inc()
+    elif response.exit_code != 0:
+      logger.debug("Reporting error")
+      signal["os_heat_agent_is_error"] = response.stderr
+      metrics.DEPLOYMENTS_FAILED.inc()
+  finally:
+    signal = signals.compact(signal, response)
+    _send(dep, deployment, signal, journal)
+  # Only finished once the signal has been handed off, so that a crash
+  #   before then runs the deployment, and signals, again.
+  if journal:
+    journal.finished(execution, int(signal["deploy_status_code"]))
+  return signal
+
+def skip(deployment: dict, message: str, journal=None) -> dict:
+  """Signal that a deployment wasn't run, without running it.
+
+  Returns:
+    dict: The signal payload that was sent to Heat.
+  """
+  logger.error("Not running deployment %s: %s", name(deployment), message)
+  dep = deployments.get_deployment(copy.deepcopy(deployment))
+  execution = journal.started(deployment) if journal else None
+  signal = {
+    "deploy_stdout": "",
+    "deploy_stderr": message,
+    "deploy_status_code": str(DEPENDENCY_STATUS_CODE),
+    "os_heat_agent_is_error": message,
+  }
+  metrics.DEPLOYMENTS_FAILED.inc()
+  signal = signals.compact(signal)
+  _send(dep, deployment, signal, journal)
+  if journal:
+    journal.finished(execution, DEPENDENCY_STATUS_CODE)
+  return signal
+
+def succeeded(signal: dict) -> bool:
+  return str(signal.get("deploy_status_code")) == "0"
+
+def plan(selected: list, completed=None) -> tuple:
+  """Work out the dependencies between deployments.
+
+  Args:
+    selected (list): (deployment, reason) tuples.
+    completed (set, optional): Names and IDs of deployments that aren't
+      being run, but whose last run succeeded.
+
+  Returns:
+    tuple: The indexes in `selected` that each deployment depends on, and a
+      message for each deployment that can't be run at all, both keyed by
+      index.
+  """
+  completed = completed or set()
+  indexes = {}
+  for index, (deployment, reason) in enumerate(selected):
+    for ident in {name(deployment), changes.key(deployment)}:
+      indexes.setdefault(ident, []).append(index)
+
+  needs = {}
+  blocked = {}
+  for index, (deployment, reason) in enumerate(selected):
+    needs[index] = []
+    for dependency in depends_on(deployment):
+      if dependency in indexes:
+        needs[index].extend(indexes[dependency])
+      elif dependency not in completed:
+        blocked[index] = f"Depends on {dependency}, which has not been deployed"
+
+  # Anything that can get back to itself is in a cycle.
+  for index in needs:
+    path = _cycle(index, needs)
+    if path:
+      blocked[index] = "Dependency cycle: " + " -> ".join(
+        name(selected[i][0]) for i in path
+      )
+  return needs, blocked
+
+def _cycle(start: int, needs: dict) -> list:
+  # Depth first, returning the first path found from `start` back to itself.
+  stack = [(start, [start])]
+  seen = set()
+  while stack:
+    index, path = stack.pop()
+    for dependency in needs[index]:
+      if dependency == start:
+        return path + [start]
+      if dependency not in seen:
+        seen.add(dependency)
+        stack.append((dependency, path + [dependency]))
+  return None
+
+def run(selected: list, workers: int = 1, journal=None, completed=None) -> list:
+  """Run and signal a list of deployments.
+
+  Args:
+    selected (list): (deployment, reason) tuples, as returned by
+      `changes.changed`.
+    workers (int): The maximum number of deployments to run at once. 1, the
+      default, runs everything serially.
+    journal (:obj:`Journal`, optional): Journal to record runs in.
+    completed (set, optional): Names and IDs of deployments that aren't
+      being run, but whose last run succeeded, for dependencies on them.
+
+  Returns:
+    list: The signal payload of each deployment, in the same order as
+      `selected`.
+  """
+  needs, blocked = plan(selected, completed)
+  results = [None] * len(selected)
+  # Nothing is run until everything that can't be has been dealt with.
+  for index, message in sorted(blocked.items()):
+    results[index] = skip(selected[index][0], message, journal)
+
+  remaining = [index for index in range(len(selected)) if index not in blocked]
+  wave = 0
+  while remaining:
+    ready = [i for i in remaining if all(results[j] is not None for j in needs[i])]
+    remaining = [i for i in remaining if i not in ready]
+    runnable = []
+    for index in ready:
+      failed = [j for j in needs[index] if not succeeded(results[j])]
+      if failed:
+        results[index] = skip(selected[index][0],
+          f"Depends on {name(selected[failed[0]][0])}, which failed", journal)
+      else:
+        runnable.append(index)
+    if not runnable:
+      continue
+    wave += 1
+    if remaining or wave > 1:
+      logger.info("Running wave %s: %s", wave,
+        logs.lazy(lambda: ", ".join(name(selected[i][0]) for i in runnable)))
+    for index, result in zip(runnable, _run([selected[i] for i in runnable], workers, journal)):
+      results[index] = result
+  return results
+
+def chains(selected: list) -> list:
+  """Group deployments that share state, so that each group can be run in
+  order while the groups run in parallel.
+
+  Args:
+    selected (list): (deployment, reason) tuples.
+
+  Returns:
+    list: Lists of indexes in `selected`, each in declared order, in the
+      order of their first deployment.
+  """
+  groups = []
+  owners = {}
+  for index, (deployment, reason) in enumerate(selected):
+    keys = shared(deployment)
+    found = []
+    for key in keys:
+      if key in owners and not any(owners[key] is g for g in found):
+        found.append(owners[key])
+    if not found:
+      group = [index]
+      groups.append(group)
+    else:
+      # A deployment can join up groups that were separate until now.
+      group = found[0]
+      for other in found[1:]:
+        group.extend(other)
+        groups = [g for g in groups if g is not other]
+        for key, owner in owners.items():
+          if owner is other:
+            owners[key] = group
+      group.sort()
+      group.append(index)
+    for key in keys:
+      owners[key] = group
+  return sorted(groups, key=lambda group: group[0])
+
+def _chain(selected: list, journal=None) -> list:
+  return [execute(deployment, reason, journal) for deployment, reason in selected]
+
+def _run(selected: list, workers: int = 1, journal=None) -> list:
+  # Runs one wave, in declared order or in parallel.
+  if workers <= 1:
+    return _chain(selected, journal)
+
+  results = [None] * len(selected)
+  with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="deployment") as pool:
+    def run_between(start: int, end: int) -> None:
+      # Everything between two barriers, with deployments that share state
+      #   run one after another.
+      pending = {}
+      for group in chains(selected[start:end]):
+        indexes = [start + i for i in group]
+        pending[tuple(indexes)] = pool.submit(_chain, [selected[i] for i in indexes], journal)
+      wait(pending.values())
+      for indexes, future in pending.items():
+        for i, result in zip(indexes, future.result()):
+          results[i] = result
+
+    start = 0
+    for index, (deployment, reason) in enumerate(selected):
+      if not serial(deployment):
+        continue
+      # Wait for everything declared before this one to finish first
+      run_between(start, index)
+      results[index] = execute(deployment, reason, journal)
+      start = index + 1
+    run_between(start, len(selected))
+  return results
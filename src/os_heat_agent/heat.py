@@ -1,24 +1,48 @@
-import boto3
 import json
 import logging
 
+from os_heat_agent import metrics
+
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# Clients are expensive to build, since boto3 has to load and parse the
+#   botocore service models every time, and a new client also means a new
+#   connection pool. So hold on to them between polls.
+# Keyed by (access key, endpoint, region), and holds (secret key, client) so
+#   that a changed secret for the same access key still gets a new client.
+_clients = {}
+
 # Jan 17, 2025
-# This function uses boto3 instead of the OpenStack APIs as it is unclear, at 
+# This function uses boto3 instead of the OpenStack APIs as it is unclear, at
 #   time of writing, how to fetch the current deployment information.
 
-# Explicitly does not perform any error checking on the JSON blob, expects the
-#   caller to handle any errors that come back.
-# Expected errrors:
-#   - JSONDecodeError
-#   - Whatever boto3 throws
+def get_client(cfn, region):
+  """Returns a CloudFormation client for the given credentials.
 
-def get_config(cfn, region):
+  Clients are cached and reused between polls. boto3 itself is only imported
+    the first time a client is actually needed.
+
+  Args:
+    cfn (dict): The `os-collect-config` `cfn` section of the Heat metadata.
+    region (str): The cloud region.
+  """
+  key = (cfn["access_key_id"], cfn["metadata_url"], region)
+  cached = _clients.get(key)
+  if cached and cached[0] == cfn["secret_access_key"]:
+    return cached[1]
+
+  # Credentials have been rotated, or this is the first fetch. Either way
+  #   any client we have for this endpoint is no longer useful.
+  for stale in [k for k in _clients if k[1:] == key[1:]]:
+    logger.debug("Discarding CloudFormation client for %s", stale[1])
+    del _clients[stale]
+
+  import boto3
+  from botocore.config import Config
 
+  logger.debug("Creating CloudFormation client for %s", cfn["metadata_url"])
   session = boto3.session.Session()
-  logger.debug("Fetching {}", cfn["stack_name"])
   client = session.client(
     # We're using CFN
     service_name="cloudformation",
@@ -26,13 +50,33 @@ def get_config(cfn, region):
     aws_secret_access_key = cfn["secret_access_key"],
     endpoint_url = cfn["metadata_url"],
     region_name = region,
+    # Keep the connection to the metadata server open between polls.
+    config = Config(tcp_keepalive=True),
     # use_ssl = False
   )
+  _clients[key] = (cfn["secret_access_key"], client)
+  return client
+
+def clear_clients():
+  """Drops all cached clients."""
+  _clients.clear()
+
+# Explicitly does not perform any error checking on the JSON blob, expects the
+#   caller to handle any errors that come back.
+# Expected errrors:
+#   - JSONDecodeError
+#   - Whatever boto3 throws
+
+def get_config(cfn, region):
+
+  logger.debug("Fetching %s", cfn["stack_name"])
+  client = get_client(cfn, region)
   # We only need the first part of the "path", which will be in the format of some.Path
   resource, field = cfn["path"].split(".", 1)
 
-  response = client.describe_stack_resource(
-    StackName=cfn["stack_name"],
-    LogicalResourceId=resource
-  )
+  with metrics.GET_CONFIG_SECONDS.time():
+    response = client.describe_stack_resource(
+      StackName=cfn["stack_name"],
+      LogicalResourceId=resource
+    )
   return json.loads(response["StackResourceDetail"]["Metadata"])
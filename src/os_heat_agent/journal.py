@@ -0,0 +1,170 @@
+"""A persistent journal of deployment runs.
+
+Every time a deployment is run, the journal records when it started and
+  finished, the deployment's digest and action, its exit code, and what
+  happened to the signal sent back to Heat. It is a small SQLite database in
+  the cache directory, written as each deployment starts and finishes.
+
+Because a run is only recorded as finished after its signal has been handed
+  off, the journal is what lets the agent pick up where it left off after a
+  crash or reboot: anything recorded as finished with the digest Heat is
+  still asking for doesn't need to run again, and anything that started but
+  never finished does.
+
+It also keeps a cheap history of what the agent has done; see
+  `os_heat_agent history`.
+"""
+import sqlite3
+import threading
+import time
+from pathlib import Path
+import structlog
+
+from os_heat_agent import changes
+
+logger = structlog.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS executions (
+  id            INTEGER PRIMARY KEY AUTOINCREMENT,
+  deployment_id TEXT NOT NULL,
+  name          TEXT,
+  digest        TEXT NOT NULL,
+  action        TEXT,
+  started_at    REAL NOT NULL,
+  finished_at   REAL,
+  exit_code     INTEGER,
+  signal_status TEXT
+);
+CREATE INDEX IF NOT EXISTS executions_deployment
+  ON executions (deployment_id, id);
+"""
+
+# Started, but the agent stopped before it finished. Other statuses come
+#   from signal delivery; see os_heat_agent.signals.
+INTERRUPTED = "interrupted"
+
+class Journal:
+  """
+  SQLite-backed record of deployment executions.
+  """
+
+  def __init__(self, path):
+    self.path = Path(path)
+    # Deployments may be run from a thread pool, and signals are delivered
+    #   from another thread again, so share one connection behind a lock.
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+    self._db.row_factory = sqlite3.Row
+    with self._lock:
+      self._db.execute("PRAGMA journal_mode=WAL")
+      self._db.execute("PRAGMA synchronous=FULL")
+      self._db.executescript(SCHEMA)
+
+  @classmethod
+  def from_config(cls, section) -> "Journal":
+    """Open the Journal configured in the `[cache]` configuration section."""
+    return cls(Path(section.get("dir")).joinpath(section.get("journal_filename")))
+
+  def close(self) -> None:
+    with self._lock:
+      self._db.close()
+
+  def _execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+    with self._lock:
+      return self._db.execute(sql, parameters)
+
+  def started(self, deployment: dict) -> int:
+    """Record that a deployment has started running.
+
+    Returns:
+      int: The ID of the execution, to pass to `finished`.
+    """
+    cursor = self._execute(
+      "INSERT INTO executions (deployment_id, name, digest, action, started_at)"
+      " VALUES (?, ?, ?, ?, ?)",
+      (
+        changes.key(deployment),
+        deployment.get("name"),
+        changes.fingerprint(deployment)["digest"],
+        changes.deploy_action(deployment),
+        time.time(),
+      )
+    )
+    return cursor.lastrowid
+
+  def finished(self, execution: int, exit_code: int) -> None:
+    """Record that a deployment finished, and its signal was sent."""
+    self._execute(
+      "UPDATE executions SET finished_at = ?, exit_code = ? WHERE id = ?",
+      (time.time(), exit_code, execution)
+    )
+
+  def signalled(self, deployment_id: str, status: str) -> None:
+    """Record the delivery status of the latest signal for a deployment."""
+    self._execute(
+      "UPDATE executions SET signal_status = ? WHERE id = ("
+      " SELECT MAX(id) FROM executions WHERE deployment_id = ?)",
+      (status, deployment_id)
+    )
+
+  def completed(self) -> dict:
+    """Returns the last finished run of each deployment.
+
+    Returns:
+      dict: The `digest`, `action`, `exit_code` and `finished_at` of each
+        run, keyed by deployment ID. The exit code is the status code that
+        was signalled, so a timeout is `executor.TIMEOUT_STATUS_CODE`.
+    """
+    rows = self._execute(
+      "SELECT deployment_id, digest, action, exit_code, finished_at FROM executions"
+      " WHERE id IN ("
+      " SELECT MAX(id) FROM executions WHERE finished_at IS NOT NULL"
+      " GROUP BY deployment_id)"
+    )
+    return {
+      row["deployment_id"]: {
+        "digest": row["digest"],
+        "action": row["action"],
+        "exit_code": row["exit_code"],
+        "finished_at": row["finished_at"],
+      }
+      for row in rows.fetchall()
+    }
+
+  def recover(self) -> list:
+    """Mark executions that never finished as interrupted.
+
+    Called at startup; anything still running at that point was cut short by
+      the agent stopping.
+
+    Returns:
+      list: The interrupted executions.
+    """
+    rows = self._execute(
+      "SELECT * FROM executions WHERE finished_at IS NULL"
+      " AND (signal_status IS NULL OR signal_status != ?)",
+      (INTERRUPTED,)
+    ).fetchall()
+    for row in rows:
+      logger.warning("Deployment %s (%s) was interrupted; it will be run again",
+        row["name"], row["deployment_id"])
+    self._execute(
+      "UPDATE executions SET signal_status = ? WHERE finished_at IS NULL",
+      (INTERRUPTED,)
+    )
+    return [dict(row) for row in rows]
+
+  def history(self, limit: int = 20, deployment: str = None) -> list:
+    """Returns the most recent executions, newest first."""
+    if deployment:
+      rows = self._execute(
+        "SELECT * FROM executions WHERE deployment_id = ? OR name = ?"
+        " ORDER BY id DESC LIMIT ?",
+        (deployment, deployment, limit)
+      )
+    else:
+      rows = self._execute(
+        "SELECT * FROM executions ORDER BY id DESC LIMIT ?", (limit,)
+      )
+    return [dict(row) for row in rows.fetchall()]
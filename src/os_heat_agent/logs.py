@@ -0,0 +1,398 @@
+"""Asynchronous, structured logging.
+
+Logging from a deployment used to mean formatting and writing every event,
+  stdout and stderr blobs included, in the thread that was running the
+  deployment, so a slow journald or a full disk held up the deployments
+  themselves. Instead, once `configure` has been called:
+
+  - each event is checked against the level first. Below the configured
+    level a structlog logger does nothing at all, and a standard library
+    logger only checks its level, so nothing is formatted.
+  - enabled events are given their level, logger name and timestamp, and
+    every field is cut down to `field_length` characters, with at most
+    `field_items` entries from any dict or list. What's left is a snapshot,
+    safe to render later whatever happens to the original values.
+  - the snapshot is put on a bounded queue, and a background writer
+    renders and writes it out.
+
+Whatever is still queued is written out when the agent exits, including
+  when it's sent SIGTERM, and anything logged after that is written
+  straight away.
+
+When the queue is full, events are dropped, and counted, or with `policy`
+  set to `block`, the logging thread waits for the writer to catch up. The
+  writer reports how many events were dropped, and they're counted in the
+  `os_heat_agent_log_events_dropped_total` metric.
+
+The standard library's `logging`, which some modules and libraries use, is
+  sent through the same queue.
+
+Anything expensive to work out that's only needed for a log message should
+  be wrapped in `lazy`, so that it's only worked out if the message is
+  actually logged:
+
+  logger.debug("Inputs: %s", logs.lazy(json.dumps, inputs, indent=2))
+
+Configured in the `[logging]` section:
+
+  renderer: `console`, for people, or `json`, one object per line.
+  queue_size: Events to hold before the policy applies.
+  policy: `drop` or `block`, when the queue is full.
+  field_length: Characters to keep from any one field.
+  field_items: Entries to keep from any one dict or list.
+"""
+import atexit
+import datetime
+import logging
+import queue
+import sys
+import threading
+import time
+import structlog
+from os_heat_agent.config import config
+
+QUEUE_SIZE = 10000
+FIELD_LENGTH = 4096
+FIELD_ITEMS = 100
+# Containers nested deeper than this are only kept as their repr.
+DEPTH = 4
+
+DROP = "drop"
+BLOCK = "block"
+
+ELIDED_MARKER = "[... {} characters elided ...]"
+
+# The running pipeline, if any.
+pipeline = None
+
+class Lazy:
+  """
+  A value that's only worked out when a log message needs it, and at most
+    once.
+  """
+
+  __slots__ = ("_function", "_args", "_kwargs", "_value", "_resolved")
+
+  def __init__(self, function, *args, **kwargs):
+    self._function = function
+    self._args = args
+    self._kwargs = kwargs
+    self._resolved = False
+
+  def resolve(self):
+    if not self._resolved:
+      self._value = self._function(*self._args, **self._kwargs)
+      self._resolved = True
+    return self._value
+
+  # %-formatting of positional arguments goes through these.
+  def __str__(self) -> str:
+    return str(self.resolve())
+
+  def __repr__(self) -> str:
+    return repr(self.resolve())
+
+def lazy(function, *args, **kwargs) -> Lazy:
+  """Defer `function(*args, **kwargs)` until the log message it's passed to
+  is logged."""
+  return Lazy(function, *args, **kwargs)
+
+def truncate(text: str, length: int) -> str:
+  """Keep the head and tail of `text`, if it's over `length` characters."""
+  if len(text) <= length:
+    return text
+  head = length // 2
+  tail = length - head
+  return text[:head] + ELIDED_MARKER.format(len(text) - length) + text[len(text) - tail:]
+
+def snapshot(value, length: int = FIELD_LENGTH, items: int = FIELD_ITEMS, depth: int = 0):
+  """Returns a bounded copy of `value`, for rendering later.
+
+  Strings are truncated, dicts and lists are copied with at most `items`
+    entries, and anything else that isn't a number is replaced with its
+    truncated repr.
+  """
+  if isinstance(value, Lazy):
+    value = value.resolve()
+  if value is None or isinstance(value, (bool, int, float)):
+    return value
+  if isinstance(value, str):
+    return truncate(value, length)
+  if depth < DEPTH:
+    if isinstance(value, dict):
+      copy = {}
+      for index, (key, item) in enumerate(value.items()):
+        if index == items:
+          copy["..."] = f"{len(value) - items} more"
+          break
+        copy[key if isinstance(key, str) else truncate(repr(key), length)] = (
+          snapshot(item, length, items, depth + 1)
+        )
+      return copy
+    if isinstance(value, (list, tuple, set, frozenset)):
+      copy = []
+      for index, item in enumerate(value):
+        if index == items:
+          copy.append(f"... {len(value) - items} more")
+          break
+        copy.append(snapshot(item, length, items, depth + 1))
+      return copy
+  try:
+    text = repr(value)
+  except Exception as e:
+    text = f"<unrepresentable {type(value).__name__}: {e}>"
+  return truncate(text, length)
+
+class Pipeline:
+  """
+  A bounded queue of log events, and the background writer that renders
+    them.
+  """
+
+  def __init__(self, renderer=None, size: int = QUEUE_SIZE, policy: str = DROP,
+               length: int = FIELD_LENGTH, items: int = FIELD_ITEMS, stream=None):
+    if policy not in (DROP, BLOCK):
+      raise ValueError(f"Unknown logging policy {policy}")
+    self.renderer = renderer or structlog.dev.ConsoleRenderer(colors=False)
+    self.policy = policy
+    self.length = length
+    self.items = items
+    # Looked up every time if not given, so that it follows sys.stdout.
+    self._stream = stream
+    self._queue = queue.Queue(maxsize=size)
+    self._lock = threading.Lock()
+    # Held while checking whether the pipeline is closed, and while closing
+    #   it, but never while waiting on the queue: a signal handler that logs
+    #   could otherwise wait on a put it interrupted.
+    self._closing = threading.Lock()
+    self._closed = False
+    self.dropped = 0
+    self._unreported = 0
+    self._writer = threading.Thread(target=self._work, name="os-heat-agent-logs", daemon=True)
+    self._writer.start()
+
+  @classmethod
+  def from_config(cls, stream=None) -> "Pipeline":
+    """A pipeline configured from the `[logging]` section."""
+    renderer = config.get("logging", "renderer", fallback="console")
+    if renderer == "json":
+      renderer = structlog.processors.JSONRenderer(default=repr)
+    elif renderer == "console":
+      renderer = None
+    else:
+      raise ValueError(f"Unknown log renderer {renderer}")
+    return cls(
+      renderer=renderer,
+      size=config.getint("logging", "queue_size", fallback=QUEUE_SIZE),
+      policy=config.get("logging", "policy", fallback=DROP),
+      length=config.getint("logging", "field_length", fallback=FIELD_LENGTH),
+      items=config.getint("logging", "field_items", fallback=FIELD_ITEMS),
+      stream=stream,
+    )
+
+  @property
+  def stream(self):
+    return self._stream or sys.stdout
+
+  def put(self, event: dict) -> bool:
+    """Queue an event, which has already been snapshotted.
+
+    Returns:
+      bool: False if it was dropped.
+    """
+    with self._closing:
+      closed = self._closed
+    if closed:
+      # Nothing's left to write it in the background.
+      self._write(event)
+      return True
+    if self.policy == BLOCK:
+      self._queue.put(event)
+    else:
+      try:
+        self._queue.put_nowait(event)
+      except queue.Full:
+        with self._lock:
+          self.dropped += 1
+          self._unreported += 1
+        return False
+    if self._closed and not self._writer.is_alive():
+      # Closed while this was being queued, and after close() had written
+      #   out what the writer left.
+      self._drain()
+    return True
+
+  def flush(self) -> None:
+    """Wait for everything queued so far to be written."""
+    self._queue.join()
+
+  def close(self, timeout: float = 5) -> None:
+    """Write out what's queued, and stop the writer.
+
+    Anything put after this is written straight away.
+    """
+    with self._closing:
+      if self._closed:
+        return
+      self._closed = True
+      self._queue.put(None)
+    self._writer.join(timeout)
+    if self._writer.is_alive():
+      # Stuck writing; whatever's left would only get stuck too.
+      return
+    # Anything the writer didn't get to.
+    self._drain()
+
+  def _drain(self) -> None:
+    # Write out what's queued, once the writer has stopped.
+    while True:
+      try:
+        event = self._queue.get_nowait()
+      except queue.Empty:
+        break
+      try:
+        if event is not None:
+          self._write(event)
+      finally:
+        self._queue.task_done()
+    self._flush_stream()
+
+  def _work(self) -> None:
+    while True:
+      event = self._queue.get()
+      try:
+        if event is None:
+          return
+        self._write(event)
+        if self._unreported:
+          self._report()
+        if self._queue.empty():
+          self._flush_stream()
+      finally:
+        self._queue.task_done()
+
+  def _report(self) -> None:
+    with self._lock:
+      count, self._unreported = self._unreported, 0
+    self._write({
+      "event": f"Dropped {count} log events; the log queue was full",
+      "level": "warning",
+      "logger": __name__,
+      "timestamp": _timestamp(),
+    })
+    # Only imported once something's been dropped, to keep startup quick.
+    from os_heat_agent import metrics
+    metrics.LOG_EVENTS_DROPPED.inc(count)
+
+  def _write(self, event: dict) -> None:
+    try:
+      line = self.renderer(None, event.get("level", "info"), dict(event))
+      self.stream.write(line + "\n")
+    except Exception:
+      # There's nowhere left to log this to, and the writer has to keep
+      #   going for everything else.
+      pass
+
+  def _flush_stream(self) -> None:
+    try:
+      self.stream.flush()
+    except Exception:
+      pass
+
+class QueueLogger:
+  """
+  The structlog logger behind every bound logger, which puts events on the
+    pipeline.
+  """
+
+  def __init__(self, name: str = None):
+    self.name = name
+
+  def msg(self, **event) -> None:
+    if pipeline is not None:
+      pipeline.put(event)
+
+  log = debug = info = warning = warn = error = critical = fatal = exception = msg
+
+def _logger_factory(*args) -> QueueLogger:
+  return QueueLogger(args[0] if args else None)
+
+def _timestamp(seconds: float = None) -> str:
+  # The same format as structlog's TimeStamper(fmt="iso", utc=True)
+  moment = datetime.datetime.fromtimestamp(
+    time.time() if seconds is None else seconds, datetime.timezone.utc
+  )
+  return moment.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+def _add_logger_name(logger, method: str, event: dict) -> dict:
+  if getattr(logger, "name", None):
+    event.setdefault("logger", logger.name)
+  return event
+
+def _snapshot(logger, method: str, event: dict) -> dict:
+  length = pipeline.length if pipeline else FIELD_LENGTH
+  items = pipeline.items if pipeline else FIELD_ITEMS
+  return {key: snapshot(value, length, items) for key, value in event.items()}
+
+class Handler(logging.Handler):
+  """
+  Sends standard library log records through the pipeline.
+  """
+
+  def emit(self, record: logging.LogRecord) -> None:
+    try:
+      event = {
+        "event": record.getMessage(),
+        "level": record.levelname.lower(),
+        "logger": record.name,
+        "timestamp": _timestamp(record.created),
+      }
+      if record.exc_info:
+        event["exception"] = logging.Formatter().formatException(record.exc_info)
+      if pipeline is not None:
+        pipeline.put(_snapshot(None, record.levelname.lower(), event))
+    except Exception:
+      self.handleError(record)
+
+def configure(level: int, stream=None) -> Pipeline:
+  """Send all logging through a new pipeline, configured from the
+  `[logging]` section.
+
+  Args:
+    level (int): The lowest level to log, as in :mod:`logging`.
+    stream (file, optional): Where to write to. Defaults to stdout.
+
+  Returns:
+    :obj:`Pipeline`: The new pipeline.
+  """
+  global pipeline
+  new = Pipeline.from_config(stream)
+  old, pipeline = pipeline, new
+  if old is not None:
+    old.close()
+
+  structlog.configure(
+    processors=[
+      structlog.contextvars.merge_contextvars,
+      structlog.processors.add_log_level,
+      _add_logger_name,
+      structlog.processors.TimeStamper(fmt="iso", utc=True),
+      structlog.processors.format_exc_info,
+      _snapshot,
+    ],
+    wrapper_class=structlog.make_filtering_bound_logger(level),
+    logger_factory=_logger_factory,
+  )
+
+  root = logging.getLogger()
+  for handler in [h for h in root.handlers if isinstance(h, Handler)]:
+    root.removeHandler(handler)
+  root.addHandler(Handler())
+  root.setLevel(level)
+  return pipeline
+
+@atexit.register
+def close() -> None:
+  """Write out everything that's queued, and stop the writer."""
+  if pipeline is not None:
+    pipeline.close()
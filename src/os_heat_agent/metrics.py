@@ -0,0 +1,330 @@
+"""Metrics for the poll loop, the runners and signal delivery.
+
+Metrics are kept in memory, and exposed in the Prometheus text format in
+  either or both of two ways:
+
+  - written to a file for node_exporter's textfile collector, after every
+    poll, and
+  - served over HTTP from a small built-in server, which by default only
+    listens on localhost.
+
+Configured in the `[metrics]` section:
+
+  textfile: Path to write metrics to, for example
+    `/var/lib/node_exporter/textfile_collector/os_heat_agent.prom`. Not
+    written if empty.
+  listen_address: Address for the HTTP server to listen on.
+  port: Port for the HTTP server to listen on. The server is not started
+    if this is 0.
+
+This deliberately doesn't depend on `prometheus_client`; the handful of
+  metric types the agent needs are simple enough to keep here.
+"""
+import math
+import threading
+import time
+from pathlib import Path
+import structlog
+
+logger = structlog.getLogger(__name__)
+
+# Seconds. Covers everything from a local metadata fetch to a long
+#   configuration management run.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+  30, 60, 120, 300, 600, 1800, 3600)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class Metric:
+  """
+  Base metric class. Should not be used.
+  """
+
+  type = None
+
+  def __init__(self, name: str, documentation: str, labels: tuple = ()):
+    self.name = name
+    self.documentation = documentation
+    self.labels = tuple(labels)
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def _key(self, labels: dict) -> tuple:
+    if set(labels) != set(self.labels):
+      raise ValueError(f"{self.name} expects labels {self.labels}, got {tuple(labels)}")
+    return tuple(str(labels[label]) for label in self.labels)
+
+  def clear(self) -> None:
+    """Forget every recorded value."""
+    with self._lock:
+      self._values.clear()
+
+  def samples(self) -> list:
+    """Returns (name, labels, value) for every sample of this metric."""
+    with self._lock:
+      return [
+        (self.name, dict(zip(self.labels, key)), value)
+        for key, value in sorted(self._values.items())
+      ]
+
+class Counter(Metric):
+  """
+  A value that only goes up.
+  """
+
+  type = "counter"
+
+  def __init__(self, name: str, documentation: str, labels: tuple = ()):
+    super().__init__(name, documentation, labels)
+    # Without labels, there's only ever one value, and it starts at 0.
+    if not self.labels:
+      self._values[()] = 0
+
+  def clear(self) -> None:
+    super().clear()
+    if not self.labels:
+      self._values[()] = 0
+
+  def inc(self, amount: float = 1, **labels) -> None:
+    if amount < 0:
+      raise ValueError("Counters can only be increased")
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + amount
+
+  def value(self, **labels) -> float:
+    with self._lock:
+      return self._values.get(self._key(labels), 0)
+
+class Gauge(Metric):
+  """
+  A value that can go up and down.
+  """
+
+  type = "gauge"
+
+  def set(self, value: float, **labels) -> None:
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = value
+
+  def value(self, **labels) -> float:
+    with self._lock:
+      return self._values.get(self._key(labels))
+
+class Histogram(Metric):
+  """
+  The distribution of observed values, such as durations, in buckets.
+  """
+
+  type = "histogram"
+
+  def __init__(self, name: str, documentation: str, labels: tuple = (),
+               buckets: tuple = DEFAULT_BUCKETS):
+    super().__init__(name, documentation, labels)
+    self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+  def observe(self, value: float, **labels) -> None:
+    key = self._key(labels)
+    with self._lock:
+      counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          counts[i] += 1
+      self._values[key] = (counts, total + value)
+
+  def time(self, **labels) -> "Timer":
+    """Returns a context manager that observes how long its block takes."""
+    return Timer(self, labels)
+
+  def count(self, **labels) -> int:
+    with self._lock:
+      counts, total = self._values.get(self._key(labels), ([0], 0))
+      return counts[-1]
+
+  def samples(self) -> list:
+    samples = []
+    for name, labels, (counts, total) in super().samples():
+      for bound, count in zip(self.buckets, counts):
+        samples.append((f"{name}_bucket", dict(labels, le=_format_value(bound)), count))
+      samples.append((f"{name}_sum", labels, total))
+      samples.append((f"{name}_count", labels, counts[-1]))
+    return samples
+
+class Timer:
+  """
+  Observes the time taken by a block in a Histogram, whether or not it
+  raised.
+  """
+
+  def __init__(self, histogram: Histogram, labels: dict):
+    self.histogram = histogram
+    self.labels = labels
+
+  def __enter__(self) -> "Timer":
+    self._started = time.monotonic()
+    return self
+
+  def __exit__(self, *exc) -> None:
+    self.histogram.observe(time.monotonic() - self._started, **self.labels)
+
+###
+###
+###
+
+# Every metric the agent exposes, in the order they're rendered.
+registry = []
+
+def _register(metric: Metric) -> Metric:
+  registry.append(metric)
+  return metric
+
+GET_CONFIG_SECONDS = _register(Histogram(
+  "os_heat_agent_get_config_seconds",
+  "Time taken to fetch deployment metadata from Heat.",
+))
+RUN_SECONDS = _register(Histogram(
+  "os_heat_agent_run_seconds",
+  "Time taken to run a deployment, by tool.",
+  labels=("tool",),
+))
+SIGNAL_SECONDS = _register(Histogram(
+  "os_heat_agent_signal_seconds",
+  "Time taken for Heat to respond to a signal.",
+))
+DEPLOYMENTS_RUN = _register(Counter(
+  "os_heat_agent_deployments_run_total",
+  "Deployments run.",
+))
+DEPLOYMENTS_FAILED = _register(Counter(
+  "os_heat_agent_deployments_failed_total",
+  "Deployments that exited non-zero, timed out or could not be run.",
+))
+DEPLOYMENTS_SKIPPED = _register(Counter(
+  "os_heat_agent_deployments_skipped_total",
+  "Deployments not run because they were unchanged since they last ran.",
+))
+DEPLOYMENTS_TIMED_OUT = _register(Counter(
+  "os_heat_agent_deployments_timed_out_total",
+  "Deployments terminated for running past their timeout.",
+))
+LAST_SUCCESSFUL_POLL = _register(Gauge(
+  "os_heat_agent_last_successful_poll_timestamp_seconds",
+  "When deployment metadata was last fetched from Heat successfully.",
+))
+CACHED_DEPLOYMENTS = _register(Gauge(
+  "os_heat_agent_cached_deployments",
+  "Deployments recorded in the state cache.",
+))
+CACHE_BYTES = _register(Gauge(
+  "os_heat_agent_state_cache_bytes",
+  "Size of the state cache file.",
+))
+LOG_EVENTS_DROPPED = _register(Counter(
+  "os_heat_agent_log_events_dropped_total",
+  "Log events dropped because the log queue was full.",
+))
+
+def _format_value(value: float) -> str:
+  if value == math.inf:
+    return "+Inf"
+  if isinstance(value, float) and value.is_integer():
+    return str(int(value))
+  return str(value)
+
+def _escape(value: str) -> str:
+  return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def render(metrics: list = None) -> str:
+  """Render metrics in the Prometheus text exposition format.
+
+  Args:
+    metrics (list, optional): The metrics to render. Defaults to every
+      metric the agent exposes.
+  """
+  lines = []
+  for metric in registry if metrics is None else metrics:
+    lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+    lines.append(f"# TYPE {metric.name} {metric.type}")
+    for name, labels, value in metric.samples():
+      if labels:
+        rendered = ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels.items())
+        name = f"{name}{{{rendered}}}"
+      lines.append(f"{name} {_format_value(value)}")
+  return "\n".join(lines) + "\n"
+
+def write_textfile(path) -> None:
+  """Write metrics for the node_exporter textfile collector.
+
+  The file is replaced atomically, so the collector never reads half of it.
+  """
+  # Imported here; the cache imports half the agent.
+  from os_heat_agent.cache import write_atomic
+  write_atomic(Path(path), render())
+
+###
+###
+###
+
+_server = None
+
+def serve(address: str = "127.0.0.1", port: int = 0):
+  """Serve metrics over HTTP from a background thread.
+
+  Args:
+    address (str): Address to listen on.
+    port (int): Port to listen on. 0 picks a free port.
+
+  Returns:
+    :obj:`http.server.ThreadingHTTPServer`: The running server. Its
+      `server_address` has the port actually in use.
+  """
+  global _server
+  from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+  class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      if self.path not in ("/", "/metrics"):
+        self.send_error(404)
+        return
+      body = render().encode("utf-8")
+      self.send_response(200)
+      self.send_header("Content-Type", CONTENT_TYPE)
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      logger.debug("metrics: " + format, *args)
+
+  _server = ThreadingHTTPServer((address, port), Handler)
+  _server.daemon_threads = True
+  thread = threading.Thread(target=_server.serve_forever, name="metrics", daemon=True)
+  thread.start()
+  logger.info("Serving metrics on http://%s:%s/metrics", *_server.server_address[:2])
+  return _server
+
+def shutdown() -> None:
+  """Stop the HTTP server, if it's running."""
+  global _server
+  if _server is not None:
+    _server.shutdown()
+    _server.server_close()
+    _server = None
+
+def start(section) -> None:
+  """Start exposing metrics as set in the `[metrics]` configuration section."""
+  port = section.getint("port", fallback=0)
+  if port:
+    serve(section.get("listen_address", fallback="127.0.0.1"), port)
+
+def export(section) -> None:
+  """Write the textfile, if one is configured. Called after every poll."""
+  path = section.get("textfile", fallback="")
+  if not path:
+    return
+  try:
+    write_textfile(path)
+  except OSError as e:
+    # Never worth stopping the agent over.
+    logger.error("Unable to write metrics to %s: %s", path, e)
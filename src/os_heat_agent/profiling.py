@@ -0,0 +1,133 @@
+"""Per-phase timing of the agent's poll cycle.
+
+Enabled with `os_heat_agent --profile`. Each phase of a cycle is wrapped in a
+  `span`:
+
+  cache_load, get_config, diff, get_deployment, runner_pre, runner_run,
+  runner_post, signal, cache_write
+
+and at the end of every cycle the time spent in each one, and how many times
+  it was entered, is logged as a single `cycle profile` event, at INFO or
+  the configured log level if that's higher, so that it's always logged
+  without changing what else is. Phases that
+  happen before the first cycle, such as loading the cache, are counted in
+  the first cycle. When deployments run in parallel, their spans are summed.
+
+`--profile-dump` additionally runs the first `--profile-cycles` cycles under
+  cProfile and writes the stats to a file, for `python -m pstats` or
+  snakeviz. cProfile only sees the main thread, so use it with
+  `deployment_workers = 1` to see inside the runners.
+
+When profiling is off, `span` returns a shared do-nothing context manager,
+  so the instrumented code pays for one function call and one attribute
+  check.
+"""
+import contextlib
+import logging
+import threading
+import time
+import structlog
+
+logger = structlog.getLogger(__name__)
+
+_NULL_SPAN = contextlib.nullcontext()
+
+class Profiler:
+  """
+  Collects phase timings for one cycle at a time.
+  """
+
+  def __init__(self, dump: str = None, cycles: int = 1, clock=time.perf_counter,
+               level: int = logging.INFO):
+    self.dump = dump
+    self.cycles = cycles
+    # What to log cycle profiles at.
+    self.level = level
+    self.clock = clock
+    self.cycle = 0
+    self._phases = {}
+    self._lock = threading.Lock()
+    self._started = clock()
+    self._profile = None
+    if self.dump and self.cycles > 0:
+      self._start_profile()
+
+  def _start_profile(self) -> None:
+    import cProfile
+    self._profile = cProfile.Profile()
+    self._profile.enable()
+
+  @contextlib.contextmanager
+  def span(self, phase: str):
+    started = self.clock()
+    try:
+      yield
+    finally:
+      elapsed = self.clock() - started
+      with self._lock:
+        total, count = self._phases.get(phase, (0.0, 0))
+        self._phases[phase] = (total + elapsed, count + 1)
+
+  def end_cycle(self) -> dict:
+    """Log the breakdown of the cycle that just finished, and start a new one.
+
+    Returns:
+      dict: The logged phases, as {phase: {"seconds": float, "count": int}}.
+    """
+    now = self.clock()
+    with self._lock:
+      phases, self._phases = self._phases, {}
+    self.cycle += 1
+    breakdown = {
+      phase: {"seconds": round(total, 6), "count": count}
+      for phase, (total, count) in phases.items()
+    }
+    logger.log(self.level, "cycle profile",
+      cycle=self.cycle,
+      total_seconds=round(now - self._started, 6),
+      phases=breakdown,
+    )
+    self._started = now
+
+    if self._profile is not None and self.cycle >= self.cycles:
+      self._profile.disable()
+      self._profile.dump_stats(self.dump)
+      logger.log(self.level, "Wrote profile of %s cycles to %s", self.cycle, self.dump)
+      self._profile = None
+    return breakdown
+
+# The active Profiler, if profiling is on.
+profiler = None
+
+def enable(dump: str = None, cycles: int = 1, level: int = logging.INFO) -> Profiler:
+  """Turn profiling on.
+
+  Args:
+    dump (str, optional): Where to write cProfile stats to. cProfile isn't
+      run if this is not given.
+    cycles (int): How many cycles to run under cProfile.
+    level (int): The log level the agent is running at. Profiles are logged
+      at INFO, or at this level if it's higher.
+  """
+  global profiler
+  profiler = Profiler(dump, cycles, level=max(level, logging.INFO))
+  return profiler
+
+def disable() -> None:
+  """Turn profiling off."""
+  global profiler
+  profiler = None
+
+def span(phase: str):
+  """Time a phase of the current cycle.
+
+  Use as `with profiling.span("get_config"): ...`.
+  """
+  if profiler is None:
+    return _NULL_SPAN
+  return profiler.span(phase)
+
+def end_cycle() -> None:
+  """Mark the end of a poll cycle."""
+  if profiler is not None:
+    profiler.end_cycle()
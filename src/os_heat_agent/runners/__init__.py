@@ -31,6 +31,21 @@ class Output:
   stdout: str
   stderr: str
   exit_code: int
+  # Whether the command was terminated for running past its timeout.
+  timed_out: bool = False
+  # Where the complete output was spooled to, if it was.
+  stdout_log: str = None
+  stderr_log: str = None
+  # Size, and "sha256:<hex>" digest, of the complete output, of which
+  #   stdout and stderr may only be the head and tail.
+  stdout_bytes: int = None
+  stderr_bytes: int = None
+  stdout_digest: str = None
+  stderr_digest: str = None
+  # The outputs this was combined from, when several commands were run,
+  #   each with its own log and digest. The combined streams have no single
+  #   log or digest of their own.
+  parts: list = None
 
 class Runner(metaclass=ABCMeta):
   """
@@ -1,6 +1,7 @@
-from . import Output, RunnerError
+from . import Output, RunnerError, capture, runtime, worker
+# Variables are written out by the Bash serializer
+from .serializer import bashify, SerializerError
 import subprocess
-import shlex
 from pathlib import Path
 from public import public, private
 # Load the configuration
@@ -21,9 +22,6 @@ VARIABLES_PATH="/etc/babashka/variables"
 
 SUPPORTED_CONFIGS = ["StructuredConfig","SoftwareComponent"]
 
-class SerializerError(RunnerError): 
-  pass
-
 @public
 def init() -> None:
   """Initialize this runner.
@@ -33,27 +31,44 @@ def init() -> None:
     and before causing issues with the runtime environment.
   
   Raises:
-    FileNotFoundError: If the variables path is not found.
-    FileNotFoundError: If the Babashka executable is not found.
+    FileNotFoundError: If the variables path is not found, or is not a
+      directory.
+    MissingRuntimeError: If the Babashka executable is not found.
   """
   
-  babashka = Path(config.get("tools.babashka","path"))
-  
+  # Validated once here; runs only check that nothing has changed since.
+  runtime.registry.check(config.get("tools.babashka", "path"), _executable)
+  runtime.registry.check(config.get("tools.babashka", "variables"), _variables)
+
+@private
+def _executable(babashka: Path) -> Path:
   if not babashka.exists() or babashka.is_dir():
     # Babashka isn't installed, which we need to except on
     logger.error("Babashka not installed or incorrectly configured: %s", babashka.resolve())
-    raise MissingRuntimeError("Babashka not installed or incorrectly configured: %s", babashka.resolve())
-  
-  # Validate the variables path stuff.
-  variable_path = Path(config.get("tools.babashka", "variables"))
-  
+    raise MissingRuntimeError(f"Babashka not installed or incorrectly configured: {babashka.resolve()}")
+  return babashka.resolve()
+
+@private
+def _variables(variable_path: Path) -> Path:
   if not variable_path.exists():
     logger.error("Babashka variables path %s doesn't exist", variable_path.resolve())
     raise FileNotFoundError(f"Babashka variables path {variable_path.resolve()} doesn't exist")
   
   if not variable_path.is_dir():
     logger.error("Babashka variables path %s is not a directory", variable_path.resolve())
-    raise ConfigurationError(f"Babashka variables path {variable_path.resolve()} is not a directory")
+    raise FileNotFoundError(f"Babashka variables path {variable_path.resolve()} is not a directory")
+  return variable_path.resolve()
+
+@private
+def _directory(directory: Path) -> Path:
+  # we should check if the directory exists, right?
+  if not directory.exists():
+    logger.error("Babashka directory %s does not exist", directory.resolve())
+    raise FileNotFoundError(f"Babashka directory {directory.resolve()} does not exist", )
+  if not directory.is_dir():
+    logger.error("Babashka directory %s is not a directory", directory.resolve())
+    raise FileNotFoundError(f"Babashka directory {directory.resolve()} is not a directory")
+  return directory.resolve()
 
 @public
 def init_config() -> None:
@@ -99,37 +114,14 @@ def normalize(data: dict) -> bool:
   if not isinstance(data, dict):
     raise NotImplementedError("Babashka runner requires StructuredConfig or SoftwareComponent")
   
-  # Test if Babashka is actually installed where we think it is
-  babashka = Path(config.get("tools.babashka","path"))
-  
-  if not babashka.exists() or babashka.is_dir():
-    # Babashka isn't installed, which we need to except on
-    logger.error("Babashka not installed or incorrectly configured: %s", babashka.resolve())
-    raise FileNotFoundError("Babashka not installed or incorrectly configured: %s", babashka.resolve())
-  data["runner"] = babashka
-  
-  # Validate the variables path stuff.
-  variable_path = Path(config.get("tools.babashka", "variables"))
-  
-  if not variable_path.exists():
-    logger.error("Babashka variables path %s doesn't exist", variable_path.resolve())
-    raise FileNotFoundError(f"Babashka variables path {variable_path.resolve()} doesn't exist")
-  
-  if not variable_path.is_dir():
-    logger.error("Babashka variables path %s is not a directory", variable_path.resolve())
-    raise FileNotFoundError(f"Babashka variables path {variable_path.resolve()} is not a directory")
+  # Test if Babashka is actually installed where we think it is. These were
+  #   checked when the runner was initialized, so this only checks that
+  #   nothing has changed since.
+  data["runner"] = runtime.registry.check(config.get("tools.babashka", "path"), _executable)
+  runtime.registry.check(config.get("tools.babashka", "variables"), _variables)
   
   if data.get("directory", ""):
-    directory = Path(data.get("directory", ""))
-    # we should check if the directory exists, right?
-    if not directory.exists():
-      logger.error("Babashka directory %s does not exist", directory.resolve())
-      raise FileNotFoundError(f"Babashka directory {directory.resolve()} does not exist", )
-    if not directory.is_dir():
-      logger.error("Babashka directory %s is not a directory", directory.resolve())
-      raise FileNotFoundError(f"Babashka directory {directory.resolve()} is not a directory")
-      
-    data["directory"] = directory.resolve()
+    data["directory"] = runtime.registry.check(data["directory"], _directory)
     
     if not data.get("function", None):
       # There is currently no way to validate if Babashka has given function
@@ -150,11 +142,12 @@ def command(data: dict) -> list:
   """
   
   
+  # Both paths were resolved by `normalize`
   command = [
-    data["runner"].resolve()
+    data["runner"]
   ]
   if data.get("directory", ""):
-    command.extend(["-d", data["directory"].resolve()])
+    command.extend(["-d", data["directory"]])
   command.append(data["function"])
   return command
   
@@ -172,6 +165,8 @@ def run(config: dict, environment: dict=None) -> Output:
         The function that will be run by Babashka
       `directory` (str, optional):
         What directory to include in the Babashka run.
+      `timeout` (float, optional):
+        Seconds to let Babashka run for.
     environment (dict, optional): System environment variables that will be
       passed to ``subprocess.run``.
   
@@ -188,25 +183,35 @@ def run(config: dict, environment: dict=None) -> Output:
   if not environment:
     environment = {}
   
+  if config.get("directory", "") and use_worker():
+    try:
+      return worker.run(
+        config["directory"], config["function"], environment,
+        library=worker_library(), name=config.get("deployment_id"),
+        timeout=config.get("timeout"),
+      )
+    except worker.WorkerError as e:
+      # Nothing has been run yet, so it's safe to run it the usual way.
+      logger.warning("%s; running Babashka directly", e)
+  
   # Generate the command list for subprocess
   cmd = command(config)
   
-  # Run subprocess.
-  response = subprocess.run(
-    cmd,
-    capture_output=True,
-    env=environment,
-    # Treat output as pure text
-    text=True
-  )
-  # Add the subprocess outputs to the Output object.
-  # Wait why does it do this and not just return the subprocess.run response directly?
-  return Output(
-    stdout=response.stdout,
-    stderr=response.stderr,
-    exit_code=response.returncode
+  # Run subprocess, streaming its output into an Output object.
+  return capture.run(
+    cmd, environment, name=config.get("deployment_id"), timeout=config.get("timeout")
   )
 
+@private
+def use_worker() -> bool:
+  """Whether functions are run in warm workers. See `runners.worker`."""
+  # A function, since `config` is shadowed in `run`
+  return config.getboolean("tools.babashka", "worker", fallback=False)
+
+@private
+def worker_library() -> list:
+  return config.get("tools.babashka", "worker_library", fallback="").split()
+
 @public
 def pre(data: dict, input: dict) -> bool:
   """Write out any Babashka variables to disk at the specified location.
@@ -266,39 +271,3 @@ def post(data: dict) -> None:
   """Post-process step. Babashka runner does not need post-processing.
   """
   pass
-  
-  
-@private
-def bashify(config: dict) -> list:
-  bash_vars = []
-  
-  for key, value in config.items():
-    if isinstance(value, dict):
-      # Use the built-in Bash associative arrays
-      
-      bash_vars.append(f'declare -A {key}')
-      for k, v in value.items():
-        # Raise an error because we can't serialize nested structures
-        if isinstance(v, dict) or isinstance(v, list):
-          raise SerializerError("Nested data structures cannot be serialized.")
-        # Use shlex.quote to escape special characters in keys and values
-        escaped_key = subprocess.check_output(['bash', '-c', f'printf %s {shlex.quote(k)}']).decode('utf-8').strip()
-        escaped_value = subprocess.check_output(['bash', '-c', f'printf %s {shlex.quote(v)}']).decode('utf-8').strip()
-        bash_vars.append(f'{key}["{escaped_key}"]="{escaped_value}"')
-    elif isinstance(value, list):
-        # Use Bash array syntax for lists
-        escaped_values = []
-        for v in value:
-          escaped = subprocess.check_output(['bash', '-c', f'printf %s {shlex.quote(v)}']).decode('utf-8').strip()
-          escaped_values.append(
-            f'"{escaped}"'
-          )
-        array_elements = ' '.join(escaped_values)
-        bash_vars.append(f'{key}=({array_elements})')
-    elif isinstance(value, str):
-        # Use shlex.quote to escape special characters
-        escaped_value = subprocess.check_output(['bash', '-c', f'printf %s {shlex.quote(value)}']).decode('utf-8').strip()
-        bash_vars.append(f'{key}="{escaped_value}"')
-    else:
-        bash_vars.append(f'{key}={value}')
-  return bash_vars
\ No newline at end of file
@@ -0,0 +1,55 @@
+#!/usr/bin/env bash
+# A warm Babashka worker. See os_heat_agent.runners.worker.
+#
+# Usage: babashka_worker.sh DIRECTORY [LIBRARY...]
+#
+# Sources every LIBRARY (a file, or a directory of *.sh files), then every
+#   *.sh file under DIRECTORY, once. It then reads one request per line from
+#   stdin, tab separated:
+#
+#   run <function> <environment file> <stdout fifo> <stderr fifo>
+#
+# and runs the function in a subshell, with the environment file sourced
+#   and its output sent to the FIFOs. Every call is its own job, and so its
+#   own process group. The worker answers with `started <pid>` and, once the
+#   call has finished, `exited <status>`.
+
+set -m
+shopt -s globstar nullglob
+
+directory=$1
+shift
+
+load() {
+  if [ -d "$1" ]; then
+    for file in "$1"/**/*.sh; do
+      source "$file"
+    done
+  else
+    source "$1"
+  fi
+}
+
+# Anything printed while loading would get mixed up with our answers.
+for library in "$@"; do
+  load "$library" >&2
+done
+load "$directory" >&2
+
+echo ready
+
+while IFS=$'\t' read -r request function environment stdout stderr; do
+  if [ "$request" != "run" ]; then
+    echo "error unknown request"
+    continue
+  fi
+  (
+    exec </dev/null >"$stdout" 2>"$stderr"
+    source "$environment"
+    "$function"
+  ) &
+  pid=$!
+  echo "started $pid"
+  wait "$pid"
+  echo "exited $?"
+done
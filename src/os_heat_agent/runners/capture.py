@@ -0,0 +1,346 @@
+"""Bounded, streaming capture of a runner's output.
+
+Rather than buffering everything a deployment prints in memory, both pipes
+  are read as the command runs. Only the first `head_bytes` and the last
+  `tail_bytes` of each are kept; anything in between is replaced in the
+  `Output` with a marker saying how much was left out.
+
+The complete output is spooled to disk as it is read, one file per stream,
+  named after the deployment, so nothing is lost for debugging. Its size and
+  SHA-256 digest are kept in the `Output`, so that whatever ends up with
+  only the head and tail can still tell which spooled log it came from.
+
+Commands are started in their own session, and so their own process group.
+  If a command runs past its timeout, the whole group is sent SIGTERM, and
+  then SIGKILL if anything is still running `kill_grace` seconds later, so
+  that nothing the command started is left behind holding its pipes open.
+
+The timeout covers reading the output too. Something the command started in
+  the background, such as `sleep 60 &` or a daemon that doesn't close its
+  stdout, keeps the pipes open after the command itself has exited. Once
+  the timeout is up, or `kill_grace` seconds after the command exits if
+  there's no timeout, the group is terminated in the same way, and the run
+  fails: as timed out if there was a timeout, and otherwise with the
+  leftover processes noted in stderr.
+
+Configured in the `[capture]` section:
+
+  head_bytes: Bytes to keep from the start of each stream.
+  tail_bytes: Bytes to keep from the end of each stream.
+  spool: Whether to write the complete output to disk.
+  directory: Where to spool output to. Relative paths are relative to the
+    cache directory.
+
+Timeouts are configured in the `[agent]` section (see
+  `os_heat_agent.deployments`), along with:
+
+  kill_grace: Seconds between SIGTERM and SIGKILL when a command times out.
+"""
+import hashlib
+import os
+import signal
+import subprocess
+import threading
+import time
+from pathlib import Path
+import structlog
+from os_heat_agent.config import config
+from . import Output
+
+logger = structlog.getLogger(__name__)
+
+HEAD_BYTES = 32768
+TAIL_BYTES = 32768
+CHUNK_SIZE = 65536
+KILL_GRACE = 10
+
+ELIDED_MARKER = "\n[... {} bytes elided ...]\n"
+LEFTOVER_MARKER = (
+  "\n[os-heat-agent: processes left running in the background were still "
+  "holding the output {} seconds after the command exited, and were killed]\n"
+)
+
+class Buffer:
+  """
+  Keeps the head and tail of a stream of bytes.
+  """
+
+  def __init__(self, head_bytes: int = HEAD_BYTES, tail_bytes: int = TAIL_BYTES, spool=None):
+    self.head_bytes = head_bytes
+    self.tail_bytes = tail_bytes
+    self.spool = spool
+    # A reader that's been given up on may still be writing.
+    self._lock = threading.Lock()
+    self.total = 0
+    self._digest = hashlib.sha256()
+    self._head = bytearray()
+    self._tail = bytearray()
+
+  def write(self, chunk: bytes) -> None:
+    with self._lock:
+      self.total += len(chunk)
+      self._digest.update(chunk)
+      if self.spool:
+        self.spool.write(chunk)
+
+      room = self.head_bytes - len(self._head)
+      if room > 0:
+        self._head += chunk[:room]
+        chunk = chunk[room:]
+      if chunk and self.tail_bytes > 0:
+        self._tail += chunk
+        excess = len(self._tail) - self.tail_bytes
+        if excess > 0:
+          del self._tail[:excess]
+
+  def close(self) -> None:
+    """Close the spool. Anything written from here on is only kept in memory."""
+    with self._lock:
+      if self.spool:
+        self.spool.close()
+      self.spool = None
+
+  @property
+  def elided(self) -> int:
+    """Number of bytes that were dropped from the middle of the stream."""
+    return self.total - len(self._head) - len(self._tail)
+
+  @property
+  def digest(self) -> str:
+    """Digest of the complete stream, as `sha256:<hex>`."""
+    return f"sha256:{self._digest.hexdigest()}"
+
+  def text(self) -> str:
+    """Returns the kept output as text, marking where anything was dropped."""
+    if self.elided:
+      text = decode(self._head) + ELIDED_MARKER.format(self.elided) + decode(self._tail)
+    else:
+      text = decode(self._head + self._tail)
+    return text
+
+def decode(data: bytes) -> str:
+  # Match what `subprocess.run(text=True)` gives us, including its newline
+  #   translation, but never fail on output that isn't valid UTF-8.
+  return data.decode("utf-8", errors="replace").replace("\r\n", "\n").replace("\r", "\n")
+
+def spool_directory() -> Path:
+  """Returns the directory output is spooled to, or None if disabled."""
+  if not config.getboolean("capture", "spool", fallback=True):
+    return None
+  directory = Path(config.get("capture", "directory", fallback="logs"))
+  if not directory.is_absolute():
+    directory = Path(config.get("cache", "dir")).joinpath(directory)
+  return directory
+
+def _private(path, flags: int) -> int:
+  # `wb` is O_CREAT | O_WRONLY | O_TRUNC, created readable only by us.
+  return os.open(path, flags, 0o600)
+
+def _open_spool(name: str, stream: str):
+  if not name:
+    return None
+  directory = spool_directory()
+  if directory is None:
+    return None
+  try:
+    # The cache directory itself is expected to exist already.
+    directory.mkdir(mode=0o700, exist_ok=True)
+    # Output often has secrets in it, so only we get to read it, whatever
+    #   the umask, and whoever could read an earlier run's log.
+    spool = open(directory.joinpath(f"{Path(name).name}.{stream}.log"), "wb",
+      opener=_private)
+    try:
+      os.fchmod(spool.fileno(), 0o600)
+    except OSError:
+      spool.close()
+      raise
+    return spool
+  except OSError as e:
+    logger.warning("Unable to spool %s output for %s: %s", stream, name, e)
+    return None
+
+def _drain(pipe, buffer: Buffer) -> None:
+  try:
+    for chunk in iter(lambda: pipe.read1(CHUNK_SIZE), b""):
+      buffer.write(chunk)
+  finally:
+    pipe.close()
+
+def _signal_group(process, sig) -> None:
+  try:
+    os.killpg(process.pid, sig)
+  except ProcessLookupError:
+    # Everything in the group has already exited.
+    pass
+
+def _join(readers: list, timeout: float) -> bool:
+  """Wait up to `timeout` seconds in all for `readers`.
+
+  Returns:
+    bool: Whether they've all finished.
+  """
+  deadline = time.monotonic() + timeout
+  for reader in readers:
+    reader.join(max(deadline - time.monotonic(), 0))
+  return not any(reader.is_alive() for reader in readers)
+
+def terminate(process, grace: float) -> int:
+  """Terminate a process started by `run` and everything it started.
+
+  Args:
+    process (:obj:`subprocess.Popen`): The process. It must be the leader of
+      its own process group.
+    grace (float): Seconds to wait after SIGTERM before sending SIGKILL.
+
+  Returns:
+    int: The process's exit code.
+  """
+  _signal_group(process, signal.SIGTERM)
+  try:
+    process.wait(grace)
+  except subprocess.TimeoutExpired:
+    logger.warning("Process %s ignored SIGTERM; killing it", process.pid)
+  # Children may have outlived the leader, so the group is always killed.
+  _signal_group(process, signal.SIGKILL)
+  return process.wait()
+
+def run(cmd: list, env: dict = None, name: str = None, timeout: float = None,
+        input: bytes = None, pass_fds: tuple = ()) -> Output:
+  """Run a command, capturing its output.
+
+  Args:
+    cmd (list): The command, as for `subprocess.Popen`.
+    env (dict, optional): The environment for the command.
+    name (str, optional): Name to spool the output under, usually the
+      deployment ID. Output is not spooled if this is not given.
+    timeout (float, optional): Seconds to let the command run for. The
+      command is terminated, and the Output marked as timed out, if it runs
+      for longer. No timeout if not given, or not positive.
+    input (bytes, optional): Written to the command's stdin, which is then
+      closed. The command inherits the agent's stdin if not given.
+    pass_fds (tuple, optional): File descriptors for the command to
+      inherit, as for `subprocess.Popen`.
+
+  Returns:
+    :obj:`Output`: The command's exit code and captured output.
+  """
+  def start():
+    process = subprocess.Popen(
+      cmd,
+      stdin=subprocess.PIPE if input is not None else None,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.PIPE,
+      env=env,
+      pass_fds=pass_fds,
+      # Its own process group, so that it can be terminated along with
+      #   anything it starts.
+      start_new_session=True,
+    )
+    if input is not None:
+      # In the background, since the command may not read all of it before
+      #   it has written enough output to block on.
+      threading.Thread(target=_feed, args=(process.stdin, input), daemon=True).start()
+    return process
+
+  return collect(start, name=name, timeout=timeout, label=name or cmd[0])
+
+def _feed(pipe, data: bytes) -> None:
+  try:
+    pipe.write(data)
+  except (BrokenPipeError, ValueError):
+    # The command exited, or was killed, without reading all of it.
+    pass
+  finally:
+    try:
+      pipe.close()
+    except BrokenPipeError:
+      pass
+
+def collect(start, name: str = None, timeout: float = None, label: str = None) -> Output:
+  """Capture the output of something that has been started, as for `run`.
+
+  Args:
+    start (callable): Starts the command, returning something that behaves
+      like a :obj:`subprocess.Popen`: with `stdout` and `stderr` pipes, a
+      `wait(timeout)` that raises :obj:`subprocess.TimeoutExpired`, and a
+      `pid` that is also its process group.
+    name (str, optional): Name to spool the output under.
+    timeout (float, optional): Seconds to let the command run for.
+    label (str, optional): What to call the command in log messages.
+
+  Returns:
+    :obj:`Output`: The command's exit code and captured output.
+  """
+  head_bytes = config.getint("capture", "head_bytes", fallback=HEAD_BYTES)
+  tail_bytes = config.getint("capture", "tail_bytes", fallback=TAIL_BYTES)
+  grace = config.getfloat("agent", "kill_grace", fallback=KILL_GRACE)
+  if timeout is not None and timeout <= 0:
+    timeout = None
+  timed_out = False
+  leftover = False
+
+  spools = {stream: _open_spool(name, stream) for stream in ("stdout", "stderr")}
+  buffers = {
+    stream: Buffer(head_bytes, tail_bytes, spools[stream])
+    for stream in ("stdout", "stderr")
+  }
+
+  try:
+    process = start()
+    readers = [
+      threading.Thread(target=_drain, args=(process.stdout, buffers["stdout"]), daemon=True),
+      threading.Thread(target=_drain, args=(process.stderr, buffers["stderr"]), daemon=True),
+    ]
+    for reader in readers:
+      reader.start()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+      exit_code = process.wait(timeout)
+    except subprocess.TimeoutExpired:
+      logger.error("Command %s timed out after %s seconds", label, timeout)
+      timed_out = True
+      exit_code = terminate(process, grace)
+    else:
+      # Anything the command left running in the background may still hold
+      #   the pipes open, and gets no longer than the command itself would.
+      remaining = grace if deadline is None else max(deadline - time.monotonic(), 0)
+      if not _join(readers, remaining):
+        if deadline is None:
+          logger.error("Command %s exited, but left processes holding its output", label)
+          leftover = True
+        else:
+          logger.error("Command %s timed out after %s seconds, waiting on processes "
+            "it left holding its output", label, timeout)
+          timed_out = True
+        _signal_group(process, signal.SIGTERM)
+        if not _join(readers, grace):
+          _signal_group(process, signal.SIGKILL)
+    # Something outside the process group could still hold the pipes open;
+    #   don't wait on it forever once we've given up on the command.
+    if (timed_out or leftover) and not _join(readers, grace):
+      logger.warning("Giving up on the output of %s, held open outside its process group", label)
+    if leftover:
+      buffers["stderr"].write(LEFTOVER_MARKER.format(grace).encode("utf-8"))
+      if exit_code == 0:
+        exit_code = -signal.SIGKILL
+  finally:
+    # Readers that were given up on only write to memory from here on.
+    for buffer in buffers.values():
+      buffer.close()
+
+  for stream, buffer in buffers.items():
+    if buffer.elided:
+      logger.info("Truncated %s: %s of %s bytes elided", stream, buffer.elided, buffer.total)
+
+  return Output(
+    stdout=buffers["stdout"].text(),
+    stderr=buffers["stderr"].text(),
+    exit_code=exit_code,
+    timed_out=timed_out,
+    stdout_log=spools["stdout"].name if spools["stdout"] else None,
+    stderr_log=spools["stderr"].name if spools["stderr"] else None,
+    stdout_bytes=buffers["stdout"].total,
+    stderr_bytes=buffers["stderr"].total,
+    stdout_digest=buffers["stdout"].digest,
+    stderr_digest=buffers["stderr"].digest,
+  )
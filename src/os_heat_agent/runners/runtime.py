@@ -0,0 +1,127 @@
+"""Validated runtimes, shared between runners.
+
+Runners check that the executables and directories they've been configured
+  with exist and are usable when they're initialized. Rather than doing all
+  of that again for every deployment, the result is kept here, and each
+  later check only costs a single `stat`: a path is validated again if the
+  file it points to has been replaced or modified, or if it was last
+  validated more than `runtime_ttl` seconds ago (see the `[agent]`
+  section).
+
+Validation itself is up to the runner. A validator takes the configured
+  path, raises if it isn't usable, and returns whatever the runner wants to
+  use in its place, usually the resolved path. Only successful validations
+  are kept, so a broken runtime is reported every time it's used.
+"""
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from public import public
+import structlog
+
+logger = structlog.getLogger(__name__)
+
+# Seconds a validation is trusted for, when it hasn't been configured.
+TTL = 300
+
+@dataclass
+class Entry:
+  """
+  A validated path.
+  """
+
+  # What the validator returned
+  value: object
+  # (device, inode, mtime) of the path when it was validated
+  identity: tuple
+  checked_at: float
+
+def identity(path) -> tuple:
+  """Returns what identifies the current contents of `path`, or None if it
+  can't be statted. Symlinks are followed, so repointing one counts as a
+  change.
+  """
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return None
+  return (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+
+@public
+class Registry:
+  """
+  Validation results by path and validator.
+  """
+
+  def __init__(self, ttl: float = TTL, clock=time.monotonic):
+    self.ttl = ttl
+    self.clock = clock
+    self._entries = {}
+    self._lock = threading.Lock()
+
+  @classmethod
+  def from_config(cls, config) -> "Registry":
+    return cls(config.getfloat("runtime_ttl", fallback=TTL))
+
+  def check(self, path, validate):
+    """Validate `path`, unless it already has been and hasn't changed since.
+
+    Args:
+      path (str | Path): The configured path.
+      validate (callable): Called with `path` as a Path to validate it.
+
+    Returns:
+      Whatever `validate` returned when it last succeeded.
+
+    Raises:
+      Whatever `validate` raises.
+    """
+    key = (str(path), validate)
+    current = identity(path)
+    now = self.clock()
+    with self._lock:
+      entry = self._entries.get(key)
+    if (entry is not None and current is not None
+        and entry.identity == current
+        and now - entry.checked_at < self.ttl):
+      return entry.value
+
+    if entry is not None:
+      logger.debug("Revalidating %s", path)
+    with self._lock:
+      self._entries.pop(key, None)
+    value = validate(Path(path))
+    with self._lock:
+      self._entries[key] = Entry(value, current, now)
+    return value
+
+  def invalidate(self, path=None) -> None:
+    """Forget validations of `path`, or of everything."""
+    with self._lock:
+      if path is None:
+        self._entries.clear()
+        return
+      for key in [key for key in self._entries if key[0] == str(path)]:
+        del self._entries[key]
+
+  def validated(self) -> dict:
+    """Returns every currently trusted path and what its validator returned."""
+    now = self.clock()
+    with self._lock:
+      return {
+        key[0]: entry.value for key, entry in self._entries.items()
+        if now - entry.checked_at < self.ttl
+      }
+
+# Shared by every runner. Replaced with one using the configured TTL when
+#   the agent starts.
+registry = Registry()
+
+@public
+def configure(config) -> Registry:
+  """Start over with a registry configured from the `[agent]` section."""
+  global registry
+  registry = Registry.from_config(config)
+  return registry
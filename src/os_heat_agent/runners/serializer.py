@@ -0,0 +1,110 @@
+"""Serializes input values to Bash variable declarations.
+
+Used by the Babashka runner to write the variables file that Babashka
+  functions source. Everything is done in-process; no shell is run to escape
+  values.
+
+Values are written as:
+
+  - Strings: `name="value"`, with `\\`, `"`, `$` and backticks escaped so
+    that sourcing the file gives back exactly the original value. Leading
+    and trailing whitespace is stripped.
+  - Numbers, booleans and None: `name=value`, as Python prints them.
+  - Lists: an indexed array, `name=("a" "b")`.
+  - Dicts: an associative array, `declare -A name` followed by
+    `name["key"]="value"` for each item.
+
+Bash has no nested arrays, so a list or dict inside a list or dict is
+  flattened into its own variable, named after its parent and its key (or
+  index), joined with a double underscore. Characters in the key that can't
+  be used in a variable name are replaced with `_`. The parent's entry holds
+  the name of that variable, for use with `declare -n`. For example,
+
+    {"servers": {"web": ["a", "b"]}}
+
+  becomes
+
+    declare -A servers
+    servers["web"]="servers__web"
+    servers__web=("a" "b")
+"""
+import re
+from . import RunnerError
+
+class SerializerError(RunnerError):
+  pass
+
+NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+INVALID_NAME_CHARACTERS = re.compile(r"[^A-Za-z0-9_]")
+
+# Characters that keep their special meaning inside double quotes.
+ESCAPES = str.maketrans({
+  "\\": "\\\\",
+  '"': '\\"',
+  "$": "\\$",
+  "`": "\\`",
+})
+
+def quote(value) -> str:
+  """Quote a value for use inside a Bash double-quoted string."""
+  return '"%s"' % str(value).strip().translate(ESCAPES)
+
+def child_name(parent: str, key) -> str:
+  """The name of the variable a nested list or dict is flattened into."""
+  return "%s__%s" % (parent, INVALID_NAME_CHARACTERS.sub("_", str(key)))
+
+def bashify(config: dict) -> list:
+  """Serialize a dict of values to Bash variable declarations.
+
+  Args:
+    config (dict): The values to serialize, keyed by variable name.
+
+  Returns:
+    list (str): One declaration per line.
+
+  Raises:
+    SerializerError: If a key isn't a valid Bash variable name, or two nested
+      structures would be flattened into the same variable.
+  """
+  bash_vars = []
+  declared = set()
+
+  def declare(name: str) -> None:
+    if name in declared:
+      raise SerializerError(f"Variable {name} would be declared more than once.")
+    declared.add(name)
+
+  def element(name: str, key, value) -> str:
+    # Nested structures get their own variable, and the parent holds its name
+    if isinstance(value, (dict, list)):
+      child = child_name(name, key)
+      nested.append((child, value))
+      return quote(child)
+    return quote(value)
+
+  pending = []
+  for key, value in config.items():
+    if not NAME.match(str(key)):
+      raise SerializerError(f"{key!r} is not a valid Bash variable name.")
+    pending.append((key, value))
+
+  while pending:
+    nested = []
+    for name, value in pending:
+      declare(name)
+      if isinstance(value, dict):
+        # Use the built-in Bash associative arrays
+        bash_vars.append(f"declare -A {name}")
+        for k, v in value.items():
+          bash_vars.append(f"{name}[{quote(k)}]={element(name, k, v)}")
+      elif isinstance(value, list):
+        # Use Bash array syntax for lists
+        elements = " ".join(element(name, i, v) for i, v in enumerate(value))
+        bash_vars.append(f"{name}=({elements})")
+      elif isinstance(value, str):
+        bash_vars.append(f"{name}={quote(value)}")
+      else:
+        bash_vars.append(f"{name}={value}")
+    pending = nested
+
+  return bash_vars
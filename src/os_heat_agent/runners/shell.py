@@ -3,10 +3,30 @@
 This runner exports the ability to run scripts provided via OpenStack Heat
   on a system using the configured shell.
   
-Scripts will be serialized to a temporary location on disk and will be run
-  from there.
+Scripts are passed to the runner as a single argument, or, if they're
+  serialized or too large to pass as an argument, delivered to it as a
+  file. How that file is delivered depends on what the host supports:
+
+  memfd: An anonymous in-memory file, sealed against changes and passed to
+    the runner as `/proc/self/fd/N`. Never touches a filesystem.
+  tmpfs: A private temporary file in a memory-backed directory.
+  file: A private temporary file in the default temporary directory, on
+    disk.
+  stdin: Written to the runner's stdin. Only for runners that read a
+    script from stdin, and only suitable for scripts that don't read stdin
+    themselves, so it's only ever used when asked for.
+
+With `delivery` set to `auto`, the first of memfd, tmpfs and file that
+  works is used, except for scripts over `memory_max`, which are always
+  written to disk. Setting `delivery` to a mode tries that one first.
 
 Config format is expected to be
+[tools.shell]
+delivery = auto
+tmpfs = /dev/shm
+argv_max = 65536
+memory_max = 16777216
+
 [tools.shell.runners]
 bash="/bin/bash" 
 python="/usr/bin/python"
@@ -14,25 +34,46 @@ python="/usr/bin/python"
 import subprocess
 import structlog
 import os
+import io
 import copy
+import fcntl
 from pathlib import Path
-import shlex
 import tempfile
 from public import public, private
 from os_heat_agent.config import config
-from . import RunnerError, Output
+from . import RunnerError, Output, capture, runtime
 
 logger = structlog.getLogger(__name__)
 
 SUPPORTED_CONFIGS = ["SoftwareConfig","StructuredConfig","SoftwareComponent"]
 
 enabled_runners = {}
+# The configured path of each enabled runner, which is what gets revalidated.
+runner_paths = {}
 
 known_modifiers = {
   "bash": "-c",
   "python": "-e"
 }
 
+# Arguments that make a runner read its script from stdin. Runners that
+#   aren't listed never get their script through stdin.
+stdin_modifiers = {
+  "bash": ["-s"],
+  "sh": ["-s"],
+  "python": ["-"],
+}
+
+# In order of preference, for `auto` delivery. stdin takes the script's
+#   stdin away from it, so isn't one of them.
+DELIVERY_MODES = ["memfd", "tmpfs", "file"]
+TMPFS = "/dev/shm"
+# Scripts larger than this are delivered as a file even when they aren't
+#   serialized, well short of Linux's limit on a single argument.
+ARGV_MAX = 65536
+# Scripts larger than this are written to disk rather than held in memory.
+MEMORY_MAX = 16 * 1024 * 1024
+
 class NoEnabledRunners(RunnerError):
   pass
 class MissingRunner(RunnerError):
@@ -55,29 +96,34 @@ def init() -> None:
   """
   
   # Clear the existing runners
-  global enabled_runners
+  global enabled_runners, runner_paths
   enabled_runners = {}
+  runner_paths = {}
   
   for name, path in config["tools.shell.runners"].items():
-    runner = Path(path).resolve()
-    if not runner.exists():
-      # If the runner doesn't exist, we should error
-      logger.error("Command %s not found", runner.resolve())
-      continue
-    if not runner.is_file():
-      # If the runner isn't a file, IE it's a directory, we should error
-      logger.error("Command %s is not a file", runner.resolve())
-      continue
-    
-    if not os.access(runner.resolve(), os.X_OK):
-      logger.error("Command %s is not executable", runner.resolve())
+    try:
+      enabled_runners[name] = runtime.registry.check(path, _executable)
+    except MissingRunner as e:
+      logger.error(str(e))
       continue
-    
-    enabled_runners[name] = runner
+    runner_paths[name] = path
   
   if not enabled_runners:
     raise NoEnabledRunners("No enabled shell runners.")
 
+@private
+def _executable(path: Path) -> Path:
+  runner = path.resolve()
+  if not runner.exists():
+    # If the runner doesn't exist, we should error
+    raise MissingRunner(f"Command {runner} not found")
+  if not runner.is_file():
+    # If the runner isn't a file, IE it's a directory, we should error
+    raise MissingRunner(f"Command {runner} is not a file")
+  if not os.access(runner, os.X_OK):
+    raise MissingRunner(f"Command {runner} is not executable")
+  return runner
+
 @public
 def normalize(data: dict, options: dict = {}) -> dict:
   """Validate and normalize the data from OpenStack.
@@ -107,39 +153,168 @@ def normalize(data: dict, options: dict = {}) -> dict:
   if not data.get("command", None):
     raise RunnerError("Command not defined.")
   
-  data["runner"] = enabled_runners[data["group"][0]]
+  # Checked when the runner was enabled; this only notices if it has been
+  #   changed or removed since.
+  name = data["group"][0]
+  data["runner"] = runtime.registry.check(runner_paths[name], _executable)
   return data
   
+class Script:
+  """
+  A script, delivered to the runner.
+
+  Reads like the file the script was written to, whichever way it was
+    delivered.
+  """
+
+  def __init__(self, mode: str, fh, path: str = None, arguments: list = None,
+               input: bytes = None, pass_fds: tuple = ()):
+    self.mode = mode
+    self._fh = fh
+    self.path = path
+    # Passed to the runner in place of the script
+    self.arguments = arguments if arguments is not None else [path]
+    self.input = input
+    self.pass_fds = pass_fds
+
+  @property
+  def name(self) -> str:
+    return self.path
+
+  def seek(self, *args) -> int:
+    return self._fh.seek(*args)
+
+  def read(self, *args) -> bytes:
+    return self._fh.read(*args)
+
+  def close(self) -> None:
+    # Temporary files are removed, and memfds freed, when they're closed.
+    self._fh.close()
+
+@private
+def _memfd(script: bytes, name: str) -> Script:
+  if not hasattr(os, "memfd_create") or not os.path.isdir("/proc/self/fd"):
+    raise OSError("memfd_create is not supported here")
+  flags = os.MFD_CLOEXEC | getattr(os, "MFD_ALLOW_SEALING", 0)
+  fd = os.memfd_create("os-heat-agent-script", flags)
+  fh = open(fd, "w+b")
+  try:
+    fh.write(script)
+    fh.flush()
+    if hasattr(fcntl, "F_ADD_SEALS"):
+      # Nothing, including the script itself, gets to change it from here on.
+      fcntl.fcntl(fd, fcntl.F_ADD_SEALS,
+        fcntl.F_SEAL_SEAL | fcntl.F_SEAL_SHRINK | fcntl.F_SEAL_GROW | fcntl.F_SEAL_WRITE)
+    fh.seek(0)
+  except OSError:
+    fh.close()
+    raise
+  # Close-on-exec, so only the runner it's passed to inherits it, under the
+  #   same number.
+  return Script("memfd", fh, f"/proc/self/fd/{fd}", pass_fds=(fd,))
+
+@private
+def _tmpfs_directory(path: Path) -> Path:
+  if not path.is_dir():
+    raise OSError(f"{path} is not a directory")
+  if not os.access(path, os.W_OK | os.X_OK):
+    raise OSError(f"{path} is not writable")
+  return path
+
+@private
+def _tmpfs(script: bytes, name: str) -> Script:
+  directory = runtime.registry.check(
+    config.get("tools.shell", "tmpfs", fallback=TMPFS), _tmpfs_directory
+  )
+  return _file(script, name, directory, mode="tmpfs")
+
+@private
+def _stdin(script: bytes, name: str) -> Script:
+  if name not in stdin_modifiers:
+    raise OSError(f"Runner {name} doesn't read scripts from stdin")
+  return Script("stdin", io.BytesIO(script), arguments=stdin_modifiers[name], input=script)
+
+@private
+def _file(script: bytes, name: str, directory: Path = None, mode: str = "file") -> Script:
+  # Only readable by us, and removed when it's closed.
+  fh = tempfile.NamedTemporaryFile(prefix="os-heat-agent-", dir=directory)
+  try:
+    fh.write(script)
+    fh.flush()
+  except OSError:
+    fh.close()
+    raise
+  return Script(mode, fh, fh.name)
+
+DELIVERIES = {
+  "memfd": _memfd,
+  "tmpfs": _tmpfs,
+  "stdin": _stdin,
+  "file": _file,
+}
+
+@private
+def delivery(data: dict) -> list:
+  """Work out how the script in `data` should be delivered.
+
+  Returns:
+    list: The delivery modes to try, in order, or `["argv"]` if it should be
+      passed as an argument.
+
+  Raises:
+    RunnerError: If the configured delivery mode isn't known.
+  """
+  size = len(data["command"].encode("utf-8"))
+  argv_max = config.getint("tools.shell", "argv_max", fallback=ARGV_MAX)
+  if not data.get("serialize", False) and size <= argv_max:
+    return ["argv"]
+  if size > config.getint("tools.shell", "memory_max", fallback=MEMORY_MAX):
+    return ["file"]
+  configured = config.get("tools.shell", "delivery", fallback="auto")
+  if configured == "auto":
+    return list(DELIVERY_MODES)
+  if configured not in DELIVERIES:
+    raise RunnerError(f"Unknown script delivery {configured}")
+  return [configured] + [mode for mode in DELIVERY_MODES if mode != configured]
+
+@private
+def deliver(data: dict, modes: list) -> Script:
+  """Deliver the script in `data` the first way in `modes` that works."""
+  script = bytes(data["command"], "utf-8")
+  name = data["group"][0]
+  for mode in modes[:-1]:
+    try:
+      return DELIVERIES[mode](script, name)
+    except OSError as e:
+      logger.debug("Unable to deliver script by %s: %s", mode, e)
+  return DELIVERIES[modes[-1]](script, name)
+
 @public
 def pre(data: dict, input: dict) -> bool:
   """Pre-run commands for the Shell runner.
   
-  Serializes the payload, if the payload needs to be serialized.
+  Delivers the payload as a file, if the payload needs to be serialized or
+    is too large to pass as an argument.
   
   Args:
     data (dict): The data to be run.
     input (dict): Inputs provided from OpenStack. Unused.
   """
   
-  if data.get("serialize", False):
-    # Serialize out to a temporary file, and hold the filehandle until we 
-    #   can close it later.
-    logger.debug("Serializing shell command.")
-    # Write config out to disk and run it like that
-    serialized = tempfile.NamedTemporaryFile()
-    serialized.write(bytes(data["command"], "utf-8"))
-    serialized.flush() # Force the command to be written to disk.
-    data["filehandle"] = serialized
-    logger.debug("Serialized path: %s:", serialized.name)
-    return True
-  return False
+  modes = delivery(data)
+  if modes == ["argv"]:
+    return False
+  # Hold the script until we can close it later.
+  data["filehandle"] = deliver(data, modes)
+  logger.debug("Delivered shell command by %s: %s", data["filehandle"].mode, data["filehandle"].name)
+  return True
 
 @public
 def post(data: dict) -> bool:
   """Post-run commands for the Shell runner.
   
-  If the command was serialized to disk, we need to close the filehandle and
-    delete it, to not leak memory.
+  If the command was delivered as a file, we need to close it, which also
+    deletes it, to not leak memory.
   """
   
   if data.get("filehandle", None):
@@ -157,15 +332,17 @@ def command(data: dict) -> list:
   Generates a list appropriate to be used with subprocess.run. Requires that
     `normalize` and `pre` have already been run.
   """
+  # Already resolved by `normalize`
   cmd = [
-    str(data["runner"].resolve())
+    str(data["runner"])
   ]
-  if data.get("serialize", None):
+  if data.get("filehandle", None):
     # simple command, then.
-    cmd.append(data["filehandle"].name)
+    cmd.extend(data["filehandle"].arguments)
   else:
     cmd.append(known_modifiers[data["group"][0]])
-    cmd.append(subprocess.check_output(['bash', '-c', f'printf %s {shlex.quote(data["command"])}']).decode('utf-8'))
+    # The command is passed through as a single argument, exactly as given.
+    cmd.append(data["command"])
     # cmd.extend(data["command"].split(" "))
   return cmd
 
@@ -178,6 +355,7 @@ def run(data: dict, environment: dict = None) -> Output:
       to be in the format of:
       command (str): The command to run
       runner (Path): Path object to the runner to run the command
+      timeout (float, optional): Seconds to let the command run for
   """
   
   if not environment:
@@ -188,20 +366,15 @@ def run(data: dict, environment: dict = None) -> Output:
   cmd = command(data)
   env = copy.copy(environment)
   env["PATH"] = os.environ["PATH"]
-  response = subprocess.run(
-    cmd, 
-    capture_output=True,
-    env=env,
-    # Treat output as pure text
-    text=True,
+  script = data.get("filehandle", None)
+  response = capture.run(
+    cmd, env, name=data.get("deployment_id"), timeout=data.get("timeout"),
+    input=script.input if script else None,
+    pass_fds=script.pass_fds if script else (),
   )
   
   logger.debug(response.stdout)
   logger.debug(response.stderr)
-  logger.debug(response.returncode)
+  logger.debug(response.exit_code)
   
-  return Output(
-    stdout=response.stdout,
-    stderr=response.stderr,
-    exit_code=response.returncode
-  )
\ No newline at end of file
+  return response
\ No newline at end of file
@@ -0,0 +1,335 @@
+"""Warm Babashka workers.
+
+Starting Babashka means starting Bash and loading the whole `-d` directory,
+  which for a small function takes far longer than running it. With
+  `worker` enabled in the `[tools.babashka]` section, the directory is
+  loaded once into a long-lived worker (`babashka_worker.sh`), and each
+  deployment runs its function in a fork of it instead.
+
+A worker is started for each directory, the first time a deployment uses
+  it; if several deployments use the same directory at once, each gets its
+  own worker. Before every call the directory, and the libraries, are
+  checked for changes. A worker that is out of date, or that has died, is
+  replaced with a fresh one.
+
+Each call gets a pair of FIFOs for its stdout and stderr, and a file with
+  its environment. The output is captured exactly as it would be from
+  Babashka itself (see `os_heat_agent.runners.capture`): the same head and
+  tail limits, spooling, timeouts and exit codes.
+
+Configured in the `[tools.babashka]` section:
+
+  worker: Whether to run functions in warm workers.
+  worker_library: Files, or directories of `*.sh` files, to load into each
+    worker before the directory; usually Babashka's own function library,
+    since the worker doesn't start Babashka itself.
+"""
+import atexit
+import os
+import re
+import select
+import shlex
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+import structlog
+
+from . import RunnerError, Output, capture
+
+logger = structlog.getLogger(__name__)
+
+SCRIPT = Path(__file__).with_name("babashka_worker.sh")
+
+# Seconds to wait for a new worker to finish loading.
+READY_TIMEOUT = 60
+
+# Things that would break the request line.
+UNSAFE = re.compile(r"[\t\r\n]")
+NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+class WorkerError(RunnerError):
+  pass
+
+def signature(paths: list) -> tuple:
+  """Returns what identifies the current contents of `paths` and every
+  `*.sh` file under them, to tell when a worker is out of date.
+  """
+  entries = []
+  for path in paths:
+    path = Path(path)
+    files = sorted(path.rglob("*.sh")) if path.is_dir() else [path]
+    for file in [path] + files:
+      try:
+        stat = file.stat()
+      except OSError:
+        continue
+      entries.append((str(file), stat.st_ino, stat.st_mtime_ns, stat.st_size))
+  return tuple(entries)
+
+def environment_file(path: Path, environment: dict) -> None:
+  """Write `environment` out as Bash exports."""
+  lines = []
+  for name, value in environment.items():
+    if not NAME.match(str(name)):
+      logger.warning("Skipping environment variable %s, which Bash can't export", name)
+      continue
+    lines.append(f"export {name}={shlex.quote(str(value))}")
+  # Only readable by us; it may well contain secrets
+  fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+  with open(fd, "w", encoding="utf-8") as fh:
+    fh.write("\n".join(lines) + "\n")
+
+class Call:
+  """
+  A function running in a worker. Looks enough like a :obj:`subprocess.Popen`
+  for `capture.collect`.
+  """
+
+  def __init__(self, worker: "Worker", pid: int, stdout, stderr, holds: list):
+    self.worker = worker
+    self.pid = pid
+    self.stdout = stdout
+    self.stderr = stderr
+    # Our own write ends of the FIFOs, so they don't read as closed before
+    #   the call has opened them.
+    self._holds = holds
+    self.returncode = None
+    self._signalled = False
+
+  def wait(self, timeout: float = None) -> int:
+    if self.returncode is not None:
+      return self.returncode
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+      line = self.worker.readline(deadline)
+    except subprocess.TimeoutExpired:
+      # The call is about to be terminated, and its exit status should read
+      #   the way Popen's would.
+      self._signalled = True
+      raise subprocess.TimeoutExpired(f"worker call {self.pid}", timeout)
+    if line is None:
+      # The worker died underneath the call. Don't leave it running without
+      #   anyone to answer to.
+      logger.error("Worker for %s exited during a call", self.worker.directory)
+      self.send_signal(signal.SIGKILL)
+      self.returncode = -signal.SIGKILL
+    else:
+      status = int(line.split()[1])
+      if self._signalled and status > 128:
+        # What Popen reports for a process killed by a signal
+        status = 128 - status
+      self.returncode = status
+    self._release()
+    return self.returncode
+
+  def send_signal(self, sig) -> None:
+    self._signalled = True
+    try:
+      os.killpg(self.pid, sig)
+    except ProcessLookupError:
+      pass
+
+  def _release(self) -> None:
+    # Once the call is over, the FIFOs read as closed as soon as anything it
+    #   started closes them too, just like a pipe.
+    for fd in self._holds:
+      os.close(fd)
+    self._holds = []
+
+class Worker:
+  """
+  A warm worker, with a directory loaded.
+  """
+
+  def __init__(self, directory, library: list = None):
+    self.directory = Path(directory)
+    self.library = [Path(path) for path in library or []]
+    self.signature = signature(self.library + [self.directory])
+    self._buffer = b""
+    try:
+      self.process = subprocess.Popen(
+        ["bash", str(SCRIPT), str(self.directory)] + [str(path) for path in self.library],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        # The same empty environment Babashka itself would get; each call
+        #   sources its own.
+        env={},
+        start_new_session=True,
+      )
+    except OSError as e:
+      raise WorkerError(f"Unable to start a worker for {self.directory}: {e}")
+    try:
+      line = self.readline(time.monotonic() + READY_TIMEOUT)
+    except subprocess.TimeoutExpired:
+      line = None
+    if line != "ready":
+      self.close()
+      raise WorkerError(f"Worker for {self.directory} failed to start")
+    logger.info("Started worker %s for %s", self.process.pid, self.directory)
+
+  def alive(self) -> bool:
+    return self.process.poll() is None
+
+  def stale(self) -> bool:
+    return signature(self.library + [self.directory]) != self.signature
+
+  def readline(self, deadline: float = None) -> str:
+    """Read a line from the worker.
+
+    Returns:
+      str: The line, or None if the worker has exited.
+
+    Raises:
+      subprocess.TimeoutExpired: If there's no line by `deadline`.
+    """
+    fd = self.process.stdout.fileno()
+    while b"\n" not in self._buffer:
+      remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+      readable, _, _ = select.select([fd], [], [], remaining)
+      if not readable:
+        raise subprocess.TimeoutExpired("worker", remaining)
+      chunk = os.read(fd, 4096)
+      if not chunk:
+        return None
+      self._buffer += chunk
+    line, self._buffer = self._buffer.split(b"\n", 1)
+    return line.decode("utf-8")
+
+  def call(self, function: str, environment: dict, workspace: Path) -> Call:
+    """Start `function`.
+
+    Raises:
+      WorkerError: If the worker can't take the call. Nothing has been run.
+    """
+    workspace.mkdir()
+    fifos = {}
+    holds = []
+    for stream in ("stdout", "stderr"):
+      path = workspace.joinpath(stream)
+      os.mkfifo(path, 0o600)
+      # Open the read end without waiting for a writer, then hold a write end
+      #   ourselves until the call is over.
+      fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+      holds.append(os.open(path, os.O_WRONLY))
+      os.set_blocking(fd, True)
+      fifos[stream] = open(fd, "rb")
+    environment_file(workspace.joinpath("environment"), environment)
+
+    request = "\t".join([
+      "run", function, str(workspace.joinpath("environment")),
+      str(workspace.joinpath("stdout")), str(workspace.joinpath("stderr")),
+    ])
+    try:
+      self.process.stdin.write(request.encode("utf-8") + b"\n")
+      self.process.stdin.flush()
+      line = self.readline(time.monotonic() + READY_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired):
+      line = None
+    if not line or not line.startswith("started "):
+      for fd in holds:
+        os.close(fd)
+      for fh in fifos.values():
+        fh.close()
+      raise WorkerError(f"Worker for {self.directory} didn't accept the call")
+    return Call(self, int(line.split()[1]), fifos["stdout"], fifos["stderr"], holds)
+
+  def close(self) -> None:
+    if self.process.poll() is None:
+      try:
+        os.killpg(self.process.pid, signal.SIGKILL)
+      except ProcessLookupError:
+        pass
+    self.process.wait()
+    for pipe in (self.process.stdin, self.process.stdout):
+      try:
+        pipe.close()
+      except OSError:
+        pass
+
+class Pool:
+  """
+  Idle workers, by directory.
+  """
+
+  def __init__(self):
+    self._idle = {}
+    self._lock = threading.Lock()
+
+  def acquire(self, directory, library: list) -> Worker:
+    key = (str(directory), tuple(str(path) for path in library))
+    while True:
+      with self._lock:
+        idle = self._idle.get(key, [])
+        worker = idle.pop() if idle else None
+      if worker is None:
+        return Worker(directory, library)
+      if not worker.alive():
+        logger.warning("Worker for %s exited; restarting it", directory)
+      elif worker.stale():
+        logger.info("%s changed; restarting its worker", directory)
+      else:
+        return worker
+      worker.close()
+
+  def release(self, worker: Worker) -> None:
+    if not worker.alive():
+      worker.close()
+      return
+    key = (str(worker.directory), tuple(str(path) for path in worker.library))
+    with self._lock:
+      self._idle.setdefault(key, []).append(worker)
+
+  def close(self) -> None:
+    with self._lock:
+      workers = [worker for idle in self._idle.values() for worker in idle]
+      self._idle = {}
+    for worker in workers:
+      worker.close()
+
+pool = Pool()
+atexit.register(pool.close)
+
+def run(directory, function: str, environment: dict = None, library: list = None,
+        name: str = None, timeout: float = None) -> Output:
+  """Run a function in a warm worker for `directory`.
+
+  Args:
+    directory (Path): The Babashka directory.
+    function (str): The function to run.
+    environment (dict, optional): Environment for the function.
+    library (list, optional): Paths to load into the worker first.
+    name (str, optional): Name to spool the output under.
+    timeout (float, optional): Seconds to let the function run for.
+
+  Returns:
+    :obj:`Output`: As `capture.run` would return for Babashka itself.
+
+  Raises:
+    WorkerError: If no worker could run the function. It hasn't been run.
+  """
+  if UNSAFE.search(function):
+    raise RunnerError(f"Invalid Babashka function {function!r}")
+  library = library or []
+
+  with tempfile.TemporaryDirectory(prefix="os-heat-agent-worker-") as workspace:
+    worker = None
+    call = None
+    # A worker that died while idle is only noticed when it's called, so
+    #   give a fresh one a chance before giving up.
+    for attempt in range(2):
+      worker = pool.acquire(directory, library)
+      try:
+        call = worker.call(function, environment or {}, Path(workspace).joinpath(str(attempt)))
+        break
+      except WorkerError:
+        worker.close()
+        if attempt:
+          raise
+    try:
+      return capture.collect(lambda: call, name=name, timeout=timeout, label=name or function)
+    finally:
+      pool.release(worker)
@@ -0,0 +1,132 @@
+"""Adaptive polling schedule.
+
+Polling at a fixed interval is a trade-off between reacting slowly to
+  changes and hammering the Heat CFN endpoint for no reason. Instead, poll at
+  the minimum interval for a while after something changes, since Heat tends
+  to hand out deployments in bursts during a stack create or update, and then
+  back off toward the maximum interval while nothing happens.
+
+Every interval is also stretched or shrunk by a per-server jitter, derived
+  from the server ID. After a region-wide reboot every agent starts at the
+  same moment; the jitter spreads them across the interval instead of having
+  the whole fleet poll in lock-step. So that the spread is across the
+  maximum interval, rather than a few seconds either side of the minimum,
+  the schedule starts out idle: the fast window only starts once a poll
+  finds a change, and the first poll after startup, which finds everything
+  Heat has handed out, is the one that usually does.
+
+Configured in the `[agent]` section:
+
+  min_polling_interval: Interval to use after a change, in seconds.
+  max_polling_interval: Interval to back off to. Defaults to
+    `polling_interval`.
+  polling_decay: Multiplier applied to the interval after each idle poll.
+  fast_polling_window: How long to stay at the minimum interval after a
+    change, in seconds.
+  polling_jitter: Maximum fraction of the interval to add or remove.
+"""
+import hashlib
+import socket
+import time
+import structlog
+
+logger = structlog.getLogger(__name__)
+
+class Scheduler:
+  """
+  Works out how long to wait between polls.
+  """
+
+  def __init__(self, minimum: float, maximum: float, decay: float = 2.0,
+               window: float = 300, jitter: float = 0.1, server_id: str = None,
+               clock=time.monotonic):
+    self.minimum = minimum
+    self.maximum = max(minimum, maximum)
+    self.decay = max(decay, 1.0)
+    self.window = window
+    self.jitter = jitter
+    self._clock = clock
+    self._offset = 0.0
+    self.server_id = server_id
+    # Start out idle. If a stack is being created, the first poll finds its
+    #   deployments and starts the fast window.
+    self._interval = self.maximum
+    self._last_change = None
+
+  @classmethod
+  def from_config(cls, section, server_id: str = None, **kwargs) -> "Scheduler":
+    """Build a Scheduler from the `[agent]` configuration section."""
+    maximum = section.getfloat(
+      "max_polling_interval",
+      fallback=section.getfloat("polling_interval")
+    )
+    return cls(
+      minimum=min(section.getfloat("min_polling_interval"), maximum),
+      maximum=maximum,
+      decay=section.getfloat("polling_decay"),
+      window=section.getfloat("fast_polling_window"),
+      jitter=section.getfloat("polling_jitter"),
+      server_id=server_id,
+      **kwargs
+    )
+
+  @property
+  def server_id(self) -> str:
+    return self._server_id
+
+  @server_id.setter
+  def server_id(self, value: str) -> None:
+    self._server_id = value or socket.gethostname()
+    # Map the server ID onto [-1, 1) so that a fleet of servers ends up
+    #   spread evenly either side of the nominal interval.
+    digest = hashlib.sha256(self._server_id.encode("utf-8")).digest()
+    self._offset = int.from_bytes(digest[:8], "big") / 2**63 - 1.0
+
+  def record(self, changed: bool) -> None:
+    """Record the outcome of a poll.
+
+    Args:
+      changed (bool): Whether the poll found anything to do.
+    """
+    now = self._clock()
+    if changed:
+      self._last_change = now
+
+    if self._last_change is not None and now - self._last_change < self.window:
+      self._interval = self.minimum
+    else:
+      self._interval = min(self._interval * self.decay, self.maximum)
+
+  def next_interval(self) -> float:
+    """Returns the number of seconds to wait before the next poll."""
+    return max(self._interval * (1 + self.jitter * self._offset), 0.0)
+
+  def sleep(self, wait=None) -> bool:
+    """Wait until the next poll.
+
+    Args:
+      wait (callable, optional): Called with the number of seconds to wait,
+        instead of `time.sleep`. It may return early, returning True, if it
+        knows something has changed.
+
+    Returns:
+      bool: True if the wait was cut short by a change.
+    """
+    interval = self.next_interval()
+    logger.debug("sleep %.1f", interval)
+    if wait is None:
+      time.sleep(interval)
+      return False
+    return bool(wait(interval))
+
+def server_id(metadata: dict) -> str:
+  """Find the server ID in a Heat metadata blob.
+
+  Heat only gives us the server ID as the `deploy_server_id` input of each
+    deployment, so take the first one we can find.
+  """
+  for deployment in metadata.get("deployments", []):
+    for input in deployment.get("inputs", []):
+      if input.get("name") == "deploy_server_id" and input.get("value"):
+        return input["value"]
+  return None
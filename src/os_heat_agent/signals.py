@@ -0,0 +1,482 @@
+"""Delivery of deployment signals back to Heat.
+
+Signals are sent through a single pooled `requests.Session`, with a timeout
+  and exponential backoff between retries.
+
+Once `start` has been called, signals are handed to a background worker
+  instead of being sent inline, so the next deployment doesn't wait on a slow
+  signal endpoint. Every signal is written to an outbox directory in the cache
+  dir before it is queued, and only removed once Heat has accepted it (or
+  rejected it outright). Anything still in the outbox when the agent starts
+  is sent again, without re-running the deployment that produced it.
+
+Only the latest signal to any one URL, which is to say for any one
+  deployment, is worth sending: Heat takes whatever it gets last as the
+  deployment's status. So a signal that's waiting to be sent, or to be
+  retried, is dropped, and removed from the outbox, as soon as a newer one
+  to the same URL is queued, and one that's being sent isn't retried.
+
+Configured in the `[signal]` section:
+
+  timeout: Seconds to wait for Heat to respond to a signal.
+  retries: Attempts to make before giving up until the next poll.
+  backoff: Seconds to wait before the first retry. Doubles on every retry.
+  max_backoff: Upper limit on the wait between retries.
+  outbox: Directory to keep undelivered signals in. Relative paths are
+    relative to the cache directory.
+  max_bytes: Upper limit on the size of a signal, as JSON. 0 for no limit.
+  error_bytes: Upper limit on the size of `os_heat_agent_is_error`.
+  digest: Whether to describe the complete output of a stream that had to
+    be cut down.
+
+Heat keeps every signal in its database, and rejects request bodies larger
+  than its `max_json_body_size`, so signals are compacted by `compact`
+  before they're sent. Output that would take a signal over `max_bytes` is
+  cut down to its head and tail, with a marker saying how much was left out,
+  sharing the room fairly between stdout and stderr. `os_heat_agent_is_error`,
+  which is usually a copy of stderr, only keeps its last `error_bytes`, so
+  that large output isn't sent twice. With `digest` on, each stream that was
+  cut down, here or when it was captured, gets an `os_heat_agent_stdout_log`
+  (or `_stderr_log`) output with the size and digest of the complete stream,
+  and where it was spooled to on the server.
+"""
+import heapq
+import itertools
+import json
+import threading
+import time
+import uuid
+from pathlib import Path
+import structlog
+
+from os_heat_agent import cache, metrics
+from os_heat_agent.config import config
+
+logger = structlog.getLogger(__name__)
+
+# Delivery statuses, as passed to Dispatcher listeners.
+QUEUED = "queued"
+DELIVERED = "delivered"
+REJECTED = "rejected"
+# Ran out of attempts; still in the outbox.
+UNDELIVERED = "undelivered"
+
+# Responses worth trying again. Anything else that isn't a success means
+#   Heat has rejected the signal, and sending it again won't change that.
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+# Defaults for compacting signals. Well under Heat's default
+#   max_json_body_size of 1MiB.
+MAX_BYTES = 65536
+ERROR_BYTES = 4096
+
+ELIDED_MARKER = "\n[... {} bytes elided ...]\n"
+
+# The signal fields holding a deployment's output, and the stream each came
+#   from.
+OUTPUT_FIELDS = {"deploy_stdout": "stdout", "deploy_stderr": "stderr"}
+ERROR_FIELD = "os_heat_agent_is_error"
+
+_session = None
+_session_lock = threading.Lock()
+
+# The running Dispatcher, if any.
+dispatcher = None
+
+def session():
+  """Returns the shared, pooled HTTP session used for signalling."""
+  global _session
+  with _session_lock:
+    if _session is None:
+      import requests
+      _session = requests.Session()
+    return _session
+
+def send(verb: str, url: str, payload: dict, timeout: float = 10,
+         retries: int = 5, backoff: float = 1.0, max_backoff: float = 60):
+  """Send a signal immediately, retrying on failure.
+
+  Returns:
+    :obj:`requests.Response`: the last response received.
+
+  Raises:
+    requests.RequestException: If the last attempt could not get a response.
+  """
+  import requests
+  for attempt in range(1, retries + 1):
+    try:
+      with metrics.SIGNAL_SECONDS.time():
+        response = session().request(verb, url, json=payload, timeout=timeout)
+    except requests.RequestException as e:
+      if attempt == retries:
+        raise
+      logger.warning("Signal to %s failed (attempt %s): %s", url, attempt, e)
+    else:
+      if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+        return response
+      logger.warning("Signal to %s returned %s (attempt %s)",
+        url, response.status_code, attempt)
+    time.sleep(min(backoff * 2 ** (attempt - 1), max_backoff))
+
+class Dispatcher:
+  """
+  Background signal delivery, backed by an on-disk outbox.
+  """
+
+  def __init__(self, outbox, timeout: float = 10, retries: int = 5,
+               backoff: float = 1.0, max_backoff: float = 60):
+    self.outbox = Path(outbox)
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+
+    self._queue = []
+    self._counter = itertools.count()
+    self._queued = set()
+    # The newest signal queued for each URL.
+    self._latest = {}
+    self._inflight = 0
+    self._condition = threading.Condition()
+    self._thread = None
+    self._stopping = False
+    # Called with (entry, status) whenever a signal changes status.
+    self.listeners = []
+
+  @classmethod
+  def from_config(cls, section, cache_dir) -> "Dispatcher":
+    """Build a Dispatcher from the `[signal]` configuration section."""
+    return cls(
+      outbox=Path(cache_dir).joinpath(section.get("outbox")),
+      timeout=section.getfloat("timeout"),
+      retries=section.getint("retries"),
+      backoff=section.getfloat("backoff"),
+      max_backoff=section.getfloat("max_backoff"),
+    )
+
+  def start(self) -> None:
+    """Start delivering signals, beginning with anything left in the outbox."""
+    self.outbox.mkdir(parents=True, exist_ok=True)
+    self._stopping = False
+    self._thread = threading.Thread(
+      target=self._worker, name="signal-dispatcher", daemon=True
+    )
+    self._thread.start()
+    self.resend()
+
+  def stop(self, timeout: float = None) -> None:
+    """Stop the worker. Undelivered signals stay in the outbox."""
+    with self._condition:
+      self._stopping = True
+      self._condition.notify_all()
+    if self._thread:
+      self._thread.join(timeout)
+
+  def submit(self, verb: str, url: str, payload: dict, deployment: str = None) -> str:
+    """Queue a signal for delivery.
+
+    The signal is written to the outbox before this returns, so it will be
+      delivered even if the agent is restarted before the worker gets to it.
+
+    Returns:
+      str: The identifier of the signal in the outbox.
+    """
+    entry = {
+      # Time first, so that sorting the outbox gives the order signals were
+      #   sent in.
+      "id": "%020d-%s" % (time.time_ns(), uuid.uuid4().hex),
+      "deployment": deployment,
+      "verb": verb,
+      "url": url,
+      "payload": payload,
+    }
+    # Written and fsynced, directory and all, the same way as the state.
+    cache.write_atomic(self._path(entry["id"]), json.dumps(entry))
+    # Before it's queued, since the worker could otherwise deliver it, and
+    #   report that, before we get to say it's been queued.
+    self._notify(entry, QUEUED)
+    self._enqueue(entry)
+    return entry["id"]
+
+  def resend(self) -> int:
+    """Queue everything in the outbox that isn't already queued.
+
+    Returns:
+      int: The number of signals queued.
+    """
+    count = 0
+    for path in sorted(self.outbox.glob("*.json")):
+      try:
+        with open(path, encoding="utf-8") as fh:
+          entry = json.load(fh)
+      except (OSError, json.decoder.JSONDecodeError) as e:
+        logger.error("Discarding unreadable signal %s: %s", path, e)
+        path.unlink(missing_ok=True)
+        continue
+      if self._enqueue(entry):
+        count += 1
+    if count:
+      logger.info("Resending %s undelivered signals", count)
+    return count
+
+  def pending(self) -> int:
+    """Returns the number of signals queued or being delivered."""
+    with self._condition:
+      return len(self._queue) + self._inflight
+
+  def join(self, timeout: float = None) -> bool:
+    """Wait for everything queued to be delivered or given up on.
+
+    Returns:
+      bool: True if nothing is left to deliver.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with self._condition:
+      while self._queue or self._inflight:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+          return False
+        self._condition.wait(remaining)
+    return True
+
+  def _path(self, ident: str) -> Path:
+    return self.outbox.joinpath(f"{ident}.json")
+
+  def _enqueue(self, entry: dict, attempt: int = 1, due: float = 0) -> bool:
+    stale = []
+    with self._condition:
+      if attempt == 1 and entry["id"] in self._queued:
+        return False
+      # IDs start with the time, so they sort in the order signals were sent.
+      latest = self._latest.get(entry["url"])
+      if latest is not None and latest > entry["id"]:
+        # Superseded while it was waiting, or being sent.
+        self._queued.discard(entry["id"])
+        stale.append(entry["id"])
+      else:
+        if latest is not None and latest != entry["id"]:
+          stale.append(latest)
+          self._queued.discard(latest)
+          self._queue = [queued for queued in self._queue if queued[3]["id"] != latest]
+          heapq.heapify(self._queue)
+        self._latest[entry["url"]] = entry["id"]
+        self._queued.add(entry["id"])
+        heapq.heappush(self._queue, (due, next(self._counter), attempt, entry))
+      self._condition.notify_all()
+    for ident in stale:
+      logger.debug("Dropping signal %s, superseded by a newer one", ident)
+      self._path(ident).unlink(missing_ok=True)
+    return not stale or stale[0] != entry["id"]
+
+  def _worker(self) -> None:
+    while True:
+      with self._condition:
+        while not self._stopping:
+          if self._queue and self._queue[0][0] <= time.monotonic():
+            break
+          wait = self._queue[0][0] - time.monotonic() if self._queue else None
+          self._condition.wait(wait)
+        if self._stopping:
+          return
+        due, _, attempt, entry = heapq.heappop(self._queue)
+        self._inflight += 1
+      try:
+        self._deliver(entry, attempt)
+      except Exception as e:
+        # Never let one bad signal take the worker down with it.
+        logger.error("Error delivering signal %s: %s", entry["id"], e)
+        self._finish(entry)
+      finally:
+        with self._condition:
+          self._inflight -= 1
+          self._condition.notify_all()
+
+  def _deliver(self, entry: dict, attempt: int) -> None:
+    import requests
+    try:
+      with metrics.SIGNAL_SECONDS.time():
+        response = session().request(
+          entry["verb"], entry["url"], json=entry["payload"], timeout=self.timeout
+        )
+    except requests.RequestException as e:
+      logger.warning("Signal to %s failed (attempt %s): %s", entry["url"], attempt, e)
+    else:
+      if response.status_code < 300:
+        logger.debug("Delivered signal %s", entry["id"])
+        self._finish(entry, delete=True)
+        self._notify(entry, DELIVERED)
+        return
+      if response.status_code not in RETRY_STATUS_CODES:
+        logger.error("Signal to %s rejected: %s", entry["url"], response.status_code)
+        self._finish(entry, delete=True)
+        self._notify(entry, REJECTED)
+        return
+      logger.warning("Signal to %s returned %s (attempt %s)",
+        entry["url"], response.status_code, attempt)
+
+    if attempt >= self.retries:
+      # Leave it in the outbox; it'll be picked up by the next `resend`.
+      logger.error("Giving up on signal %s for now after %s attempts", entry["id"], attempt)
+      self._finish(entry)
+      self._notify(entry, UNDELIVERED)
+      return
+    delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+    self._enqueue(entry, attempt + 1, time.monotonic() + delay)
+
+  def _notify(self, entry: dict, status: str) -> None:
+    for listener in self.listeners:
+      try:
+        listener(entry, status)
+      except Exception as e:
+        logger.error("Signal listener failed: %s", e)
+
+  def _finish(self, entry: dict, delete: bool = False) -> None:
+    if delete:
+      self._path(entry["id"]).unlink(missing_ok=True)
+    with self._condition:
+      self._queued.discard(entry["id"])
+    # It stays the latest for its URL once it's been sent, so that an older
+    #   signal left in the outbox is never sent after it.
+
+def start(section, cache_dir) -> Dispatcher:
+  """Start background signal delivery for the agent."""
+  global dispatcher
+  dispatcher = Dispatcher.from_config(section, cache_dir)
+  dispatcher.start()
+  return dispatcher
+
+def deliver(verb: str, url: str, payload: dict, deployment: str = None):
+  """Deliver a signal to Heat.
+
+  Hands the signal to the background dispatcher if one is running, otherwise
+    sends it immediately.
+
+  Returns:
+    :obj:`requests.Response` or None: The response, if sent immediately.
+  """
+  if dispatcher is not None:
+    dispatcher.submit(verb, url, payload, deployment)
+    return None
+  return send(verb, url, payload)
+
+def _cost(value) -> int:
+  # What a value adds to the signal, as it'll be sent.
+  return len(json.dumps(value))
+
+def elide(text: str, limit: int, head: bool = True) -> str:
+  """Cut `text` down until it costs no more than `limit` bytes as JSON.
+
+  Args:
+    text (str): The text.
+    limit (int): Bytes it may take up, including its quotes.
+    head (bool): Whether to keep its head as well as its tail. Half of the
+      room goes to each if so.
+
+  Returns:
+    str: The text, or its head and tail around a marker saying how many
+      bytes were left out.
+  """
+  if _cost(text) <= limit:
+    return text
+  data = text.encode("utf-8")
+  # What a byte of the text costs as JSON depends on what it is, anything
+  #   from 1 for plain ASCII to 6 for a control character, so search for
+  #   the most that fits.
+  low, high = 0, len(data)
+  best = None
+  while low <= high:
+    keep = (low + high) // 2
+    result = _elided(data, keep, head)
+    if _cost(result) <= limit:
+      best = result
+      low = keep + 1
+    else:
+      high = keep - 1
+  return best if best is not None else ""
+
+def _elided(data: bytes, keep: int, head: bool) -> str:
+  """The first and last of `keep` bytes of `data`, around a marker."""
+  head_bytes = keep // 2 if head else 0
+  kept_head = data[:head_bytes].decode("utf-8", "ignore")
+  kept_tail = data[len(data) - (keep - head_bytes):].decode("utf-8", "ignore")
+  elided = len(data) - len(kept_head.encode("utf-8")) - len(kept_tail.encode("utf-8"))
+  return kept_head + ELIDED_MARKER.format(elided) + kept_tail
+
+def _allocate(costs: dict, room: int) -> dict:
+  """Share out `room` between fields, so that each field gets what it needs
+  or an equal share of what's left, whichever is smaller.
+  """
+  shares = {}
+  left = len(costs)
+  for field, cost in sorted(costs.items(), key=lambda item: item[1]):
+    share = min(cost, max(room, 0) // left)
+    shares[field] = share
+    room -= share
+    left -= 1
+  return shares
+
+def _log(output, stream: str) -> dict:
+  if output.parts:
+    # Run as several commands, each spooled and digested on its own.
+    return {
+      "bytes": getattr(output, f"{stream}_bytes"),
+      "parts": [_log(part, stream) for part in output.parts],
+    }
+  return {
+    "path": getattr(output, f"{stream}_log"),
+    "bytes": getattr(output, f"{stream}_bytes"),
+    "digest": getattr(output, f"{stream}_digest"),
+  }
+
+def compact(signal: dict, output=None) -> dict:
+  """Fit a deployment's signal within the configured budget.
+
+  Args:
+    signal (dict): The signal payload. This is not modified.
+    output (:obj:`Output`, optional): What the deployment's runner returned,
+      to describe the complete output of streams that were cut down.
+
+  Returns:
+    dict: The signal payload to send.
+  """
+  max_bytes = config.getint("signal", "max_bytes", fallback=MAX_BYTES)
+  error_bytes = config.getint("signal", "error_bytes", fallback=ERROR_BYTES)
+  digest = config.getboolean("signal", "digest", fallback=True)
+  signal = dict(signal)
+
+  # Only the end of an error is worth repeating.
+  if isinstance(signal.get(ERROR_FIELD), str) and error_bytes > 0:
+    signal[ERROR_FIELD] = elide(signal[ERROR_FIELD], error_bytes, head=False)
+
+  fields = [field for field in OUTPUT_FIELDS if isinstance(signal.get(field), str)]
+  truncated = set()
+  if max_bytes > 0 and _cost(signal) > max_bytes:
+    # Room for anything describing the complete output is set aside first,
+    #   whether or not it's needed in the end.
+    reserved = {}
+    if digest and output is not None:
+      reserved = {
+        f"os_heat_agent_{OUTPUT_FIELDS[field]}_log": _log(output, OUTPUT_FIELDS[field])
+        for field in fields
+      }
+    fixed = _cost(dict(signal, **reserved, **{field: "" for field in fields}))
+    shares = _allocate(
+      {field: _cost(signal[field]) for field in fields},
+      max_bytes - fixed + 2 * len(fields),
+    )
+    for field in fields:
+      text = elide(signal[field], shares[field])
+      if text != signal[field]:
+        truncated.add(field)
+        signal[field] = text
+    logger.warning("Compacted signal output to %s bytes: %s",
+      max_bytes, ", ".join(sorted(truncated)))
+
+  if digest and output is not None:
+    for field in fields:
+      stream = OUTPUT_FIELDS[field]
+      total = getattr(output, f"{stream}_bytes")
+      captured = total is not None and total > len(getattr(output, stream).encode("utf-8"))
+      if (field in truncated or captured) and (getattr(output, f"{stream}_digest") or output.parts):
+        signal[f"os_heat_agent_{stream}_log"] = _log(output, stream)
+  return signal
@@ -0,0 +1,91 @@
+"""Where the agent gets its deployment metadata from.
+
+A Source fetches the latest Heat metadata blob, with `os-collect-config` and
+  `deployments` keys, and waits between fetches. The source is chosen with
+  `source` in the `[agent]` section:
+
+  cfn: Poll Heat's CloudFormation-compatible API. The default.
+  file: Read a local file, or every `*.json` file in a drop directory, and
+    apply changes as soon as they're written. For air-gapped and bootstrap
+    environments. See `os_heat_agent.sources.local`.
+  configdrive: Read a file injected on to the server's config drive. See
+    `os_heat_agent.sources.configdrive`.
+  http: Poll a URL, using conditional requests so that unchanged metadata
+    isn't downloaded again. See `os_heat_agent.sources.http`.
+"""
+import time
+from abc import ABC, abstractmethod
+from public import public
+from ..errors import AgentError, ConfigurationError
+
+@public
+class SourceError(AgentError):
+  """The source couldn't provide usable metadata this time around."""
+  pass
+
+@public
+class Source(ABC):
+  """
+  Source interface class.
+  """
+
+  @classmethod
+  def from_config(cls, config) -> "Source":
+    """Build the source from the agent configuration."""
+    return cls()
+
+  @abstractmethod
+  def fetch(self, current: dict) -> dict:
+    """Fetch the latest metadata.
+
+    Args:
+      current (dict): The `os-collect-config` section of the last metadata
+        fetched, which tells polling sources where to look.
+
+    Returns:
+      dict: The metadata, with `os-collect-config` and `deployments` keys.
+        Sources that can tell cheaply that nothing has changed since their
+        last fetch may return None instead.
+
+    Raises:
+      SourceError: If the metadata couldn't be fetched or read.
+    """
+
+  def wait(self, timeout: float) -> bool:
+    """Wait until it's time to fetch again.
+
+    Sources that can tell when the metadata has changed return early when it
+      does.
+
+    Returns:
+      bool: True if the metadata is known to have changed.
+    """
+    time.sleep(timeout)
+    return False
+
+  def close(self) -> None:
+    pass
+
+def _sources() -> dict:
+  # Imported here so that only the source in use pays for its imports.
+  from . import cfn, local, configdrive, http
+  return {
+    "cfn": cfn.CFNSource,
+    "file": local.FileSource,
+    "configdrive": configdrive.ConfigDriveSource,
+    "http": http.HTTPSource,
+  }
+
+@public
+def get_source(config) -> Source:
+  """Build the source configured in `[agent] source`.
+
+  Raises:
+    ConfigurationError: If the source isn't known.
+  """
+  name = config.get("agent", "source", fallback="cfn").strip().lower()
+  try:
+    source = _sources()[name]
+  except KeyError:
+    raise ConfigurationError(f"Unknown metadata source {name}")
+  return source.from_config(config)
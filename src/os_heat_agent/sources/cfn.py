@@ -0,0 +1,35 @@
+"""Fetch metadata by polling Heat's CloudFormation-compatible API.
+
+This is how the agent has always found out about deployments: the
+  `os-collect-config` `cfn` section of the metadata, starting with the one in
+  the init file, says which stack resource to ask for and how.
+"""
+import json
+from os_heat_agent import heat
+from . import Source, SourceError
+
+class CFNSource(Source):
+  """
+  Polls `DescribeStackResource` for the server's metadata.
+  """
+
+  def __init__(self, region: str = ""):
+    self.region = region
+
+  @classmethod
+  def from_config(cls, config) -> "CFNSource":
+    return cls(config.get("cloud", "region", fallback=""))
+
+  def fetch(self, current: dict) -> dict:
+    # botocore is only imported along with boto3, once it's needed.
+    from botocore.exceptions import BotoCoreError, ClientError
+    stack = current.get("cfn", {}).get("stack_name")
+    try:
+      metadata = heat.get_config(current["cfn"], self.region)
+    except (BotoCoreError, ClientError) as e:
+      raise SourceError(f"Unable to fetch metadata for {stack}: {e}")
+    except (json.decoder.JSONDecodeError, KeyError, TypeError) as e:
+      raise SourceError(f"Invalid metadata for {stack}: {e!r}")
+    if not isinstance(metadata, dict):
+      raise SourceError(f"Unexpected metadata for {stack}")
+    return metadata
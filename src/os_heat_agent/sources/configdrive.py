@@ -0,0 +1,93 @@
+"""Read metadata from the server's config drive.
+
+Nova can attach a small read-only "config drive" to a server, which is
+  available before the network is. Files injected into the server at boot
+  (Nova personality files) are stored on it under `openstack/content/`, and
+  listed in `openstack/latest/meta_data.json` with the path they were meant
+  to have.
+
+This source reads the Heat metadata from the injected file whose path is
+  `file`. The drive is expected to be mounted at `path`. If it isn't, the
+  agent tries to mount the device labelled `label` there, read-only.
+
+Configured in the `[source.configdrive]` section:
+
+  path: Where the config drive is, or should be, mounted.
+  label: Filesystem label of the config drive.
+  file: The path the metadata file was injected as.
+
+A config drive never changes while the server is running, so this source
+  just waits out the polling interval between reads.
+"""
+import json
+import os
+import subprocess
+from pathlib import Path
+import structlog
+
+from . import Source, SourceError
+
+logger = structlog.getLogger(__name__)
+
+META_DATA = "openstack/latest/meta_data.json"
+
+class ConfigDriveSource(Source):
+  """
+  Reads metadata injected on to the config drive.
+  """
+
+  def __init__(self, path, file: str, label: str = "config-2"):
+    self.path = Path(path)
+    self.file = file
+    self.label = label
+
+  @classmethod
+  def from_config(cls, config) -> "ConfigDriveSource":
+    return cls(
+      config.get("source.configdrive", "path"),
+      config.get("source.configdrive", "file"),
+      config.get("source.configdrive", "label", fallback="config-2"),
+    )
+
+  def mount(self) -> None:
+    """Mount the config drive, if it isn't already.
+
+    Raises:
+      SourceError: If the drive can't be found or mounted.
+    """
+    if self.path.joinpath(META_DATA).exists():
+      return
+    device = Path("/dev/disk/by-label").joinpath(self.label)
+    if not device.exists():
+      raise SourceError(f"No config drive at {self.path} or {device}")
+    logger.info("Mounting config drive %s at %s", device, self.path)
+    self.path.mkdir(parents=True, exist_ok=True)
+    result = subprocess.run(
+      ["mount", "-o", "ro", str(device), str(self.path)],
+      capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+      raise SourceError(f"Unable to mount config drive {device}: {result.stderr.strip()}")
+
+  def fetch(self, current: dict) -> dict:
+    self.mount()
+    try:
+      with open(self.path.joinpath(META_DATA), encoding="utf-8") as fh:
+        meta_data = json.load(fh)
+    except (OSError, ValueError) as e:
+      raise SourceError(f"Unable to read config drive metadata: {e}")
+
+    for injected in meta_data.get("files", []):
+      if injected.get("path") != self.file:
+        continue
+      # content_path is relative to the openstack/ directory
+      content = self.path.joinpath("openstack", injected["content_path"].lstrip(os.sep))
+      try:
+        with open(content, encoding="utf-8") as fh:
+          metadata = json.load(fh)
+      except (OSError, ValueError) as e:
+        raise SourceError(f"Unable to read {self.file} from the config drive: {e}")
+      metadata.setdefault("os-collect-config", current)
+      metadata.setdefault("deployments", [])
+      return metadata
+    raise SourceError(f"{self.file} is not on the config drive")
@@ -0,0 +1,153 @@
+"""Fetch metadata over plain HTTP, with conditional requests.
+
+For metadata published at a URL, such as a Swift temp URL or anything set
+  up for os-collect-config's `request` collector. The URL is `url` in the
+  `[source.http]` section, or if that isn't set, the `metadata_url` of the
+  `request` section of the current `os-collect-config` metadata.
+
+Every fetch after the first sends `If-None-Match` and `If-Modified-Since`
+  with the validators the server gave us last time. A `304 Not Modified`
+  means nothing has changed, so nothing is downloaded or parsed, and the
+  agent skips straight to waiting for the next poll.
+
+The validators, along with the metadata they're for, are kept in the cache
+  directory so that they survive a restart. Requests go through one pooled,
+  keep-alive session.
+
+Configured in the `[source.http]` section:
+
+  url: The metadata URL. Optional; see above.
+  timeout: Seconds to wait for the server.
+  validators: File to keep validators in, relative to the cache directory.
+"""
+import json
+import threading
+from pathlib import Path
+import structlog
+
+from . import Source, SourceError
+
+logger = structlog.getLogger(__name__)
+
+class HTTPSource(Source):
+  """
+  Polls a URL for metadata, using ETag and Last-Modified validators.
+  """
+
+  def __init__(self, url: str = None, validators=None, timeout: float = 30):
+    self.url = url or None
+    self.timeout = timeout
+    self.validators_path = Path(validators) if validators else None
+    self._session = None
+    self._lock = threading.Lock()
+    # What we know about the last response: url, etag, last_modified and
+    #   the metadata itself.
+    self._cached = self._load()
+    # Whether the cached metadata has been handed to the agent yet. It
+    #   always is on the first fetch, in case the agent stopped before it
+    #   finished acting on it.
+    self._delivered = False
+
+  @classmethod
+  def from_config(cls, config) -> "HTTPSource":
+    validators = config.get("source.http", "validators", fallback="")
+    return cls(
+      config.get("source.http", "url", fallback=""),
+      Path(config.get("cache", "dir")).joinpath(validators) if validators else None,
+      config.getfloat("source.http", "timeout", fallback=30),
+    )
+
+  def session(self):
+    """Returns the pooled HTTP session used for fetching."""
+    with self._lock:
+      if self._session is None:
+        import requests
+        self._session = requests.Session()
+      return self._session
+
+  def _load(self) -> dict:
+    if not self.validators_path or not self.validators_path.exists():
+      return None
+    try:
+      with open(self.validators_path, encoding="utf-8") as fh:
+        cached = json.load(fh)
+      if not isinstance(cached.get("metadata"), dict):
+        raise ValueError("no metadata")
+      return cached
+    except (OSError, ValueError, AttributeError) as e:
+      logger.warning("Ignoring unreadable validators %s: %s", self.validators_path, e)
+      return None
+
+  def _save(self) -> None:
+    if not self.validators_path:
+      return
+    # Imported here; the cache imports half the agent.
+    from os_heat_agent.cache import write_atomic
+    try:
+      write_atomic(self.validators_path, json.dumps(self._cached))
+    except OSError as e:
+      # Only costs a full download after a restart.
+      logger.warning("Unable to save validators to %s: %s", self.validators_path, e)
+
+  def _url(self, current: dict) -> str:
+    url = self.url or (current or {}).get("request", {}).get("metadata_url")
+    if not url:
+      raise SourceError("No metadata URL configured")
+    return url
+
+  def fetch(self, current: dict) -> dict:
+    """Fetch the metadata, if it has changed.
+
+    Returns:
+      dict: The metadata, or None if it hasn't changed since it was last
+        returned.
+    """
+    import requests
+    url = self._url(current)
+    cached = self._cached if self._cached and self._cached.get("url") == url else None
+
+    headers = {}
+    if cached:
+      if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+      if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    try:
+      response = self.session().get(url, headers=headers, timeout=self.timeout)
+    except requests.RequestException as e:
+      raise SourceError(f"Unable to fetch metadata from {url}: {e}")
+
+    if response.status_code == 304 and cached:
+      logger.debug("Metadata at %s not modified", url)
+      if self._delivered:
+        return None
+      self._delivered = True
+      return cached["metadata"]
+
+    if response.status_code != 200:
+      raise SourceError(f"Fetching metadata from {url} returned {response.status_code}")
+    try:
+      metadata = response.json()
+    except ValueError as e:
+      raise SourceError(f"Invalid metadata from {url}: {e}")
+    if not isinstance(metadata, dict):
+      raise SourceError(f"Unexpected metadata from {url}")
+    metadata.setdefault("os-collect-config", current)
+    metadata.setdefault("deployments", [])
+
+    self._cached = {
+      "url": url,
+      "etag": response.headers.get("ETag"),
+      "last_modified": response.headers.get("Last-Modified"),
+      "metadata": metadata,
+    }
+    self._delivered = True
+    if self._cached["etag"] or self._cached["last_modified"]:
+      self._save()
+    return metadata
+
+  def close(self) -> None:
+    if self._session is not None:
+      self._session.close()
+      self._session = None
@@ -0,0 +1,227 @@
+"""Read metadata from a local file or drop directory.
+
+For servers that can't, or shouldn't yet, reach Heat: the metadata is read
+  from `path` in the `[source.file]` section, which is either
+
+  - a single JSON metadata blob, in the same format Heat serves, or
+  - a directory, in which case every `*.json` file in it is read in name
+    order, and their `deployments` are run in that order. Each file can be
+    a full metadata blob, or just a list of deployments.
+
+If none of the files have an `os-collect-config` section, the agent keeps
+  using the one it already has.
+
+The file or directory is watched with inotify, so a change is applied as
+  soon as it's written instead of at the next poll. Where inotify isn't
+  available, the agent falls back to checking modification times every
+  `poll_interval` seconds. Either way, write files somewhere else and move
+  them into place, so the agent never reads one half written.
+"""
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import time
+from pathlib import Path
+import structlog
+
+from . import Source, SourceError
+
+logger = structlog.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+  | IN_DELETE | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF)
+
+EVENT = struct.Struct("iIII")
+
+# How long to wait for more events after the first, so that writing several
+#   files at once is picked up as a single change.
+SETTLE = 0.05
+
+class Inotify:
+  """
+  A minimal inotify binding, through ctypes.
+
+  Raises:
+    OSError: If inotify isn't available.
+  """
+
+  def __init__(self):
+    name = ctypes.util.find_library("c")
+    if not name:
+      raise OSError("libc not found")
+    libc = ctypes.CDLL(name, use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+      raise OSError("inotify not supported")
+    self._libc = libc
+    self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, os.strerror(errno))
+
+  def watch(self, path, mask: int = WATCH_MASK) -> int:
+    wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+    if wd < 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, os.strerror(errno), str(path))
+    return wd
+
+  def read(self, timeout: float) -> list:
+    """Wait up to `timeout` seconds for events.
+
+    Returns:
+      list: (mask, name) for every event, or an empty list on timeout.
+    """
+    readable, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+    if not readable:
+      return []
+    events = []
+    try:
+      data = os.read(self.fd, 65536)
+    except BlockingIOError:
+      return []
+    offset = 0
+    while offset < len(data):
+      wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+      offset += EVENT.size
+      name = data[offset:offset + length].rstrip(b"\0")
+      offset += length
+      events.append((mask, os.fsdecode(name)))
+    return events
+
+  def close(self) -> None:
+    if self.fd >= 0:
+      os.close(self.fd)
+      self.fd = -1
+
+class FileSource(Source):
+  """
+  Reads metadata from a local file or directory, and watches it for changes.
+  """
+
+  def __init__(self, path, poll_interval: float = 1.0, use_inotify: bool = True):
+    self.path = Path(path)
+    self.poll_interval = poll_interval
+    self._inotify = None
+    self._signature = None
+    if use_inotify:
+      self._start_watching()
+    if self._inotify is None:
+      self._signature = self._stat()
+
+  @classmethod
+  def from_config(cls, config) -> "FileSource":
+    return cls(
+      config.get("source.file", "path"),
+      poll_interval=config.getfloat("source.file", "poll_interval", fallback=1.0),
+      use_inotify=config.getboolean("source.file", "inotify", fallback=True),
+    )
+
+  def _start_watching(self) -> None:
+    # A file is watched through its directory, so that replacing it with a
+    #   rename is still seen.
+    directory = self.path if self.path.is_dir() else self.path.parent
+    try:
+      self._inotify = Inotify()
+      self._inotify.watch(directory)
+      logger.info("Watching %s for metadata changes", self.path)
+    except OSError as e:
+      logger.warning("inotify unavailable (%s); polling %s instead", e, self.path)
+      if self._inotify:
+        self._inotify.close()
+      self._inotify = None
+
+  def _files(self) -> list:
+    if self.path.is_dir():
+      return sorted(p for p in self.path.glob("*.json") if p.is_file())
+    return [self.path]
+
+  def _stat(self) -> tuple:
+    signature = []
+    for path in self._files():
+      try:
+        stat = path.stat()
+      except FileNotFoundError:
+        continue
+      signature.append((path.name, stat.st_mtime_ns, stat.st_size, stat.st_ino))
+    return tuple(signature)
+
+  def _relevant(self, name: str) -> bool:
+    if self.path.is_dir():
+      return name.endswith(".json") or not name
+    return name == self.path.name or not name
+
+  def fetch(self, current: dict) -> dict:
+    collect_config = current
+    deployments = []
+    for path in self._files():
+      try:
+        with open(path, encoding="utf-8") as fh:
+          data = json.load(fh)
+      except FileNotFoundError:
+        if path == self.path:
+          raise SourceError(f"Metadata file {path} does not exist")
+        # Removed since we listed the directory
+        continue
+      except (OSError, ValueError) as e:
+        # Better to skip a poll than to act on part of the metadata
+        raise SourceError(f"Unable to read metadata from {path}: {e}")
+      if isinstance(data, list):
+        deployments.extend(data)
+        continue
+      if not isinstance(data, dict):
+        raise SourceError(f"Unexpected metadata in {path}")
+      deployments.extend(data.get("deployments", []))
+      collect_config = data.get("os-collect-config", collect_config)
+    return {
+      "os-collect-config": collect_config,
+      "deployments": deployments,
+    }
+
+  def wait(self, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    if self._inotify is None:
+      return self._poll(deadline)
+    while True:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return False
+      events = self._inotify.read(remaining)
+      if any(self._relevant(name) for mask, name in events):
+        # Let a burst of writes finish before reading anything.
+        while self._inotify.read(SETTLE):
+          pass
+        logger.debug("Metadata in %s changed", self.path)
+        return True
+
+  def _poll(self, deadline: float) -> bool:
+    while True:
+      signature = self._stat()
+      if signature != self._signature:
+        self._signature = signature
+        logger.debug("Metadata in %s changed", self.path)
+        return True
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return False
+      time.sleep(min(self.poll_interval, remaining))
+
+  def close(self) -> None:
+    if self._inotify:
+      self._inotify.close()
+      self._inotify = None
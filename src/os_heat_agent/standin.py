@@ -0,0 +1,272 @@
+"""A local stand-in for the parts of Heat the agent talks to.
+
+Serves the CloudFormation `DescribeStackResource` action the agent polls for
+  metadata, and accepts deployment signals, so that the agent can be run and
+  load tested end to end without a real Heat:
+
+  - Metadata is read from a JSON file on every request, so it can be edited
+    while the agent is running. If the path is a directory, the metadata for
+    a stack is read from `<StackName>.json` in it.
+  - `CFN_SIGNAL` (POST) and `TEMP_URL_SIGNAL` (PUT) requests to any other
+    path are accepted and recorded, along with their JSON payload. Recorded
+    signals can be fetched from `GET /_signals` and cleared with
+    `DELETE /_signals`, and are optionally appended to a JSON lines file.
+
+To see how the agent copes with a degraded control plane, every request can
+  be delayed, failed or have its response dribbled out slowly; see `Faults`.
+
+Run it with `os_heat_agent standin`, and point the agent's
+  `os-collect-config` `cfn` `metadata_url` and the deployments' signal URLs
+  at it.
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape
+import structlog
+
+logger = structlog.getLogger(__name__)
+
+XMLNS = "http://cloudformation.amazonaws.com/doc/2010-05-15/"
+
+SIGNALS_PATH = "/_signals"
+
+@dataclass
+class Faults:
+  """
+  Faults to inject into every response.
+  """
+
+  # Seconds to wait before responding, plus up to `jitter` more.
+  latency: float = 0.0
+  jitter: float = 0.0
+  # Fraction of requests, from 0 to 1, answered with `error_status`.
+  error_rate: float = 0.0
+  error_status: int = 503
+  # Seconds to spread writing each response body over.
+  slow_body: float = 0.0
+  # Seed for deciding which requests fail, for repeatable runs.
+  seed: int = None
+
+class StandIn:
+  """
+  The stand-in server. Runs in a background thread once started.
+  """
+
+  def __init__(self, metadata, address: str = "127.0.0.1", port: int = 0,
+               faults: Faults = None, signal_log=None):
+    self.metadata = Path(metadata)
+    self.faults = faults or Faults()
+    self.signal_log = Path(signal_log) if signal_log else None
+    self.signals = []
+    self._random = random.Random(self.faults.seed)
+    self._lock = threading.Lock()
+    self._server = ThreadingHTTPServer((address, port), _handler(self))
+    self._server.daemon_threads = True
+    self._thread = None
+
+  @property
+  def url(self) -> str:
+    """Base URL of the server."""
+    address, port = self._server.server_address[:2]
+    return f"http://{address}:{port}"
+
+  @property
+  def metadata_url(self) -> str:
+    """URL to use as the CFN `metadata_url`."""
+    return f"{self.url}/v1/"
+
+  def start(self) -> "StandIn":
+    self._thread = threading.Thread(
+      target=self._server.serve_forever, name="standin", daemon=True
+    )
+    self._thread.start()
+    logger.info("Stand-in Heat listening on %s", self.url)
+    return self
+
+  def serve_forever(self) -> None:
+    """Run the server in this thread, until interrupted."""
+    logger.info("Stand-in Heat listening on %s", self.url)
+    self._server.serve_forever()
+
+  def stop(self) -> None:
+    self._server.shutdown()
+    self._server.server_close()
+
+  def __enter__(self) -> "StandIn":
+    return self.start()
+
+  def __exit__(self, *exc) -> None:
+    self.stop()
+
+  def stack_metadata(self, stack_name: str) -> str:
+    """Returns the metadata for a stack, as JSON.
+
+    Raises:
+      FileNotFoundError: If there is no metadata for the stack.
+    """
+    path = self.metadata
+    if path.is_dir():
+      path = path.joinpath(f"{Path(stack_name).name}.json")
+    text = path.read_text()
+    # Make sure it's valid before handing it out
+    json.loads(text)
+    return text
+
+  def record(self, verb: str, path: str, body: bytes) -> dict:
+    """Record a signal."""
+    try:
+      payload = json.loads(body) if body else None
+    except ValueError:
+      payload = body.decode("utf-8", errors="replace")
+    signal = {
+      "time": time.time(),
+      "verb": verb,
+      "path": path,
+      "payload": payload,
+    }
+    with self._lock:
+      self.signals.append(signal)
+      if self.signal_log:
+        with open(self.signal_log, "a", encoding="utf-8") as fh:
+          fh.write(json.dumps(signal) + "\n")
+    logger.info("Received %s signal at %s", verb, path)
+    return signal
+
+  def clear(self) -> None:
+    """Forget every recorded signal."""
+    with self._lock:
+      self.signals = []
+
+  def should_fail(self) -> bool:
+    with self._lock:
+      return self._random.random() < self.faults.error_rate
+
+  def delay(self) -> float:
+    with self._lock:
+      return self.faults.latency + self._random.random() * self.faults.jitter
+
+def describe_stack_resource(stack_name: str, resource: str, metadata: str) -> bytes:
+  """Returns a `DescribeStackResource` response carrying `metadata`."""
+  return f"""<DescribeStackResourceResponse xmlns="{XMLNS}">
+  <DescribeStackResourceResult>
+    <StackResourceDetail>
+      <StackName>{escape(stack_name)}</StackName>
+      <LogicalResourceId>{escape(resource)}</LogicalResourceId>
+      <ResourceType>OS::Nova::Server</ResourceType>
+      <LastUpdatedTimestamp>{time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}</LastUpdatedTimestamp>
+      <ResourceStatus>CREATE_COMPLETE</ResourceStatus>
+      <Metadata>{escape(metadata)}</Metadata>
+    </StackResourceDetail>
+  </DescribeStackResourceResult>
+  <ResponseMetadata><RequestId>{uuid.uuid4()}</RequestId></ResponseMetadata>
+</DescribeStackResourceResponse>""".encode("utf-8")
+
+def error_response(code: str, message: str, sender: bool = True) -> bytes:
+  """Returns an error in the format the CloudFormation API uses."""
+  return f"""<ErrorResponse xmlns="{XMLNS}">
+  <Error>
+    <Type>{"Sender" if sender else "Receiver"}</Type>
+    <Code>{escape(code)}</Code>
+    <Message>{escape(message)}</Message>
+  </Error>
+  <RequestId>{uuid.uuid4()}</RequestId>
+</ErrorResponse>""".encode("utf-8")
+
+def _handler(standin: StandIn):
+
+  class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+      logger.debug("standin: " + format, *args)
+
+    def _body(self) -> bytes:
+      length = int(self.headers.get("Content-Length", 0))
+      return self.rfile.read(length) if length else b""
+
+    def _respond(self, status: int, body: bytes, content_type: str = "text/xml") -> None:
+      self.send_response(status)
+      self.send_header("Content-Type", content_type)
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      faults = standin.faults
+      if faults.slow_body > 0 and body:
+        # Dribble the body out in pieces over slow_body seconds
+        pieces = 10
+        size = -(-len(body) // pieces)
+        for offset in range(0, len(body), size):
+          time.sleep(faults.slow_body / pieces)
+          self.wfile.write(body[offset:offset + size])
+          self.wfile.flush()
+      else:
+        self.wfile.write(body)
+
+    def _handle(self, verb: str) -> None:
+      url = urlsplit(self.path)
+      body = self._body()
+
+      # The stand-in's own API is never subject to faults.
+      if url.path == SIGNALS_PATH:
+        if verb == "GET":
+          with standin._lock:
+            data = json.dumps(standin.signals).encode("utf-8")
+          return self._respond(200, data, "application/json")
+        if verb == "DELETE":
+          standin.clear()
+          return self._respond(204, b"")
+        return self._respond(405, b"")
+
+      delay = standin.delay()
+      if delay > 0:
+        time.sleep(delay)
+      if standin.should_fail():
+        logger.debug("Injecting %s for %s %s", standin.faults.error_status, verb, url.path)
+        return self._respond(standin.faults.error_status,
+          error_response("ServiceUnavailable", "Injected fault", sender=False))
+
+      params = parse_qs(url.query)
+      if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+        params.update(parse_qs(body.decode("utf-8")))
+      action = params.get("Action", [None])[0]
+
+      if action is None:
+        # Anything that isn't a CloudFormation API call is a signal.
+        if verb not in ("POST", "PUT"):
+          return self._respond(405, b"")
+        standin.record(verb, self.path, body)
+        return self._respond(200, b"")
+
+      if action != "DescribeStackResource":
+        return self._respond(400, error_response("InvalidAction", f"Unsupported action {action}"))
+      stack_name = params.get("StackName", [""])[0]
+      resource = params.get("LogicalResourceId", [""])[0]
+      try:
+        metadata = standin.stack_metadata(stack_name)
+      except FileNotFoundError:
+        return self._respond(400, error_response("ValidationError", f"Stack {stack_name} does not exist"))
+      except (OSError, ValueError) as e:
+        logger.error("Unable to serve metadata for %s: %s", stack_name, e)
+        return self._respond(500, error_response("InternalFailure", str(e), sender=False))
+      return self._respond(200, describe_stack_resource(stack_name, resource, metadata))
+
+    def do_GET(self):
+      self._handle("GET")
+
+    def do_POST(self):
+      self._handle("POST")
+
+    def do_PUT(self):
+      self._handle("PUT")
+
+    def do_DELETE(self):
+      self._handle("DELETE")
+
+  return Handler
@@ -0,0 +1,135 @@
+import pytest
+import json
+import os
+from pathlib import Path
+from os_heat_agent import cache, changes
+
+@pytest.fixture
+def metadata():
+  with open("tests/fixtures/openstack/software_config/os-cfn-current.json") as fh:
+    return json.loads(fh.read())
+
+@pytest.fixture
+def init_file(tmp_path):
+  path = tmp_path.joinpath("cfn-init-data")
+  path.write_text(json.dumps({
+    "os-collect-config": {"cfn": {"stack_name": "init"}},
+    "deployments": []
+  }))
+  return path
+
+def journal_run(digest, exit_code):
+  # As returned by Journal.completed
+  return {"digest": digest, "action": "CREATE", "exit_code": exit_code, "finished_at": 1700000000.0}
+
+@pytest.fixture
+def state(tmp_path):
+  return cache.StateCache(
+    tmp_path.joinpath("state.json"),
+    tmp_path.joinpath("os-cfn-current")
+  )
+
+###
+###
+###
+
+def test_first_run_uses_init_file(state, init_file):
+  state.load(init_file)
+  assert state.metadata == {"cfn": {"stack_name": "init"}}
+  assert state.known() == {}
+  # Nothing has been written yet
+  assert not state.path.exists()
+
+def test_record_and_reload(state, init_file, metadata):
+  state.load(init_file)
+  deployment = metadata["deployments"][0]
+  state.record(deployment, {"deploy_status_code": "0"})
+  state.update(metadata)
+  assert state.save()
+
+  reloaded = cache.StateCache(state.path, state.legacy_path)
+  reloaded.load(init_file)
+  assert reloaded.metadata == metadata["os-collect-config"]
+  assert reloaded.known() == changes.fingerprints(metadata["deployments"])
+  result = reloaded.deployments[deployment["id"]]["result"]
+  assert result["status_code"] == "0"
+  assert result["action"] == "CREATE"
+
+def test_succeeded(state, init_file, metadata):
+  state.load(init_file)
+  first, second = metadata["deployments"][0], dict(metadata["deployments"][0], id="other")
+  assert not state.succeeded(first)
+  state.record(first, {"deploy_status_code": "0"})
+  state.record(second, {"deploy_status_code": "-125"})
+  assert state.succeeded(first)
+  assert not state.succeeded(second)
+  # Already run before the agent kept results
+  state._from_metadata(metadata)
+  assert state.succeeded(first)
+
+def test_save_only_when_changed(state, init_file, metadata):
+  state.load(init_file)
+  state.update(metadata)
+  assert state.save()
+  mtime = os.stat(state.path).st_mtime_ns
+  state.update(metadata)
+  assert not state.save()
+  assert os.stat(state.path).st_mtime_ns == mtime
+
+def test_update_forgets_removed_deployments(state, init_file, metadata):
+  state.load(init_file)
+  state.record(metadata["deployments"][0], {"deploy_status_code": "0"})
+  state.update({"os-collect-config": {}, "deployments": []})
+  assert state.known() == {}
+
+def test_migrates_legacy_cache(state, init_file, metadata):
+  state.legacy_path.write_text(json.dumps(metadata))
+  state.load(init_file)
+  assert state.known() == changes.fingerprints(metadata["deployments"])
+  assert state.metadata == metadata["os-collect-config"]
+  # Written out in the new format straight away
+  with open(state.path) as fh:
+    assert json.load(fh)["version"] == cache.FORMAT_VERSION
+
+def test_corrupt_state_falls_back(state, init_file, metadata):
+  state.path.write_text('{"version": 1, "deploy')
+  state.legacy_path.write_text(json.dumps(metadata))
+  state.load(init_file)
+  assert state.known() == changes.fingerprints(metadata["deployments"])
+
+def test_write_atomic_keeps_old_file_on_failure(tmp_path, monkeypatch):
+  path = tmp_path.joinpath("state.json")
+  cache.write_atomic(path, "old")
+
+  def fail(*args):
+    raise OSError("disk full")
+  monkeypatch.setattr(os, "fsync", fail)
+  with pytest.raises(OSError):
+    cache.write_atomic(path, "new")
+  assert path.read_text() == "old"
+  # No temporary files left lying around
+  assert [p.name for p in tmp_path.iterdir()] == ["state.json"]
+
+def test_resume_from_journal(state, init_file, metadata):
+  state.load(init_file)
+  deployment = metadata["deployments"][0]
+  digest = changes.fingerprint(deployment)["digest"]
+  state.resume({deployment["id"]: journal_run(digest, 0)})
+  # Ran before the state was lost, so nothing to do
+  assert changes.changed(metadata["deployments"], state.known()) == []
+  assert state.succeeded(deployment)
+
+def test_resume_keeps_failures(state, init_file, metadata):
+  state.load(init_file)
+  deployment = metadata["deployments"][0]
+  digest = changes.fingerprint(deployment)["digest"]
+  # Failed, and then the agent stopped before the state was saved
+  state.resume({deployment["id"]: journal_run(digest, -124)})
+  assert not state.succeeded(deployment)
+  assert state.deployments[deployment["id"]]["result"]["status_code"] == "-124"
+
+def test_missing_result_isnt_success(state, init_file, metadata):
+  state.load(init_file)
+  deployment = metadata["deployments"][0]
+  state.deployments[deployment["id"]] = {"fingerprint": {}, "result": None}
+  assert not state.succeeded(deployment)
@@ -0,0 +1,291 @@
+import json
+import pytest
+import threading
+import time
+import requests_mock
+from os_heat_agent import executor
+from os_heat_agent.config import config
+from os_heat_agent.runners import shell
+
+def make_deployment(index, command, options=None):
+  return {
+    "id": f"deployment-{index}",
+    "name": f"{index:02}-test",
+    "group": "Web::Shell::Bash",
+    "config": command,
+    "inputs": [
+      {"name": "deploy_action", "value": "CREATE"},
+      {"name": "deploy_signal_id", "value": f"http://signal.test/{index}"},
+      {"name": "deploy_signal_verb", "value": "POST"},
+    ],
+    "outputs": [
+      {"name": "os_heat_agent_is_error", "type": "Boolean", "error_output": True},
+    ],
+    "options": dict({"os_heat_agent_serialize": False}, **(options or {})),
+  }
+
+@pytest.fixture
+def selected():
+  return [
+    (make_deployment(1, "echo one"), "new deployment"),
+    (make_deployment(2, "echo two >&2; exit 3"), "new deployment"),
+    (make_deployment(3, "echo three", {"os_heat_agent_serial": True}), "new deployment"),
+    (make_deployment(4, "echo four"), "new deployment"),
+  ]
+
+###
+###
+###
+
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/bin/bash"}], indirect=True)
+def test_parallel_matches_serial(init_shell_config, selected):
+  shell.init()
+  with requests_mock.Mocker() as mock:
+    mock.post(requests_mock.ANY, status_code=200)
+    serial = executor.run(selected, workers=1)
+    serial_signals = sorted((r.url, r.json()["deploy_stdout"]) for r in mock.request_history)
+
+  with requests_mock.Mocker() as mock:
+    mock.post(requests_mock.ANY, status_code=200)
+    parallel = executor.run(selected, workers=4)
+    parallel_signals = sorted((r.url, r.json()["deploy_stdout"]) for r in mock.request_history)
+
+  assert serial == parallel
+  assert serial_signals == parallel_signals
+  assert parallel[1]["deploy_status_code"] == "3"
+  assert parallel[1]["os_heat_agent_is_error"] == "two\n"
+
+def test_serial_deployments_are_barriers(monkeypatch, selected):
+  events = []
+  lock = threading.Lock()
+
+  def fake_execute(deployment, reason=None, journal=None):
+    with lock:
+      events.append(("start", deployment["id"]))
+    time.sleep(0.05)
+    with lock:
+      events.append(("end", deployment["id"]))
+    return {"id": deployment["id"]}
+
+  monkeypatch.setattr(executor, "execute", fake_execute)
+  results = executor.run(selected, workers=4)
+
+  assert [r["id"] for r in results] == [d["id"] for d, reason in selected]
+  # 1 and 2 run together, 3 runs alone, then 4
+  first = {events[0][1], events[1][1]}
+  assert first == {"deployment-1", "deployment-2"}
+  assert events[0][0] == events[1][0] == "start"
+  assert events[4:] == [
+    ("start", "deployment-3"), ("end", "deployment-3"),
+    ("start", "deployment-4"), ("end", "deployment-4"),
+  ]
+
+def babashka(index, variable_file=None):
+  config = {"function": "deploy", "directory": "/etc/babashka/local"}
+  if variable_file:
+    config["variable_file"] = variable_file
+  return {"id": f"deployment-{index}", "name": f"{index:02}-test",
+    "group": "Web::Babashka", "config": config, "options": {}}
+
+def test_shared_state():
+  assert executor.shared(babashka(1, "vars.sh")) == {("babashka", "vars.sh")}
+  # Only the file name is used by the runner
+  assert executor.shared(babashka(1, "../other/vars.sh")) == {("babashka", "vars.sh")}
+  assert executor.shared(babashka(1)) == set()
+  assert executor.shared(make_deployment(1, "echo one")) == set()
+  component = {"group": "Component", "config": {"configs": [
+    {"tool": "Babashka", "config": {"variable_file": "a.sh"}},
+    {"tool": "Shell::Bash", "config": "echo"},
+  ]}}
+  assert executor.shared(component) == {("babashka", "a.sh")}
+
+def test_chains():
+  selected = [(d, "new deployment") for d in [
+    babashka(0, "a.sh"), babashka(1, "b.sh"), babashka(2), babashka(3, "a.sh"),
+    {"group": "Component", "config": {"configs": [
+      {"tool": "Babashka", "config": {"variable_file": "a.sh"}},
+      {"tool": "Babashka", "config": {"variable_file": "b.sh"}},
+    ]}},
+    babashka(5, "c.sh"),
+  ]]
+  # 4 shares with both 0 and 1, and so joins them up
+  assert executor.chains(selected) == [[0, 1, 3, 4], [2], [5]]
+
+def test_shared_state_runs_in_order(monkeypatch):
+  events = []
+  lock = threading.Lock()
+
+  def fake_execute(deployment, reason=None, journal=None):
+    with lock:
+      events.append(("start", deployment["id"]))
+    time.sleep(0.05)
+    with lock:
+      events.append(("end", deployment["id"]))
+    return {"id": deployment["id"]}
+
+  monkeypatch.setattr(executor, "execute", fake_execute)
+  selected = [(babashka(i, "vars.sh" if i != 2 else None), "new deployment") for i in range(4)]
+  results = executor.run(selected, workers=4)
+
+  assert [r["id"] for r in results] == [d["id"] for d, reason in selected]
+  shared = [e for e in events if e[1] != "deployment-2"]
+  assert shared == [
+    ("start", "deployment-0"), ("end", "deployment-0"),
+    ("start", "deployment-1"), ("end", "deployment-1"),
+    ("start", "deployment-3"), ("end", "deployment-3"),
+  ]
+  # Everything else still runs alongside
+  assert ("start", "deployment-2") in events[:2]
+
+def test_serial_option_values():
+  assert executor.serial({"options": {"os_heat_agent_serial": True}})
+  assert executor.serial({"options": {"os_heat_agent_serial": "true"}})
+  assert not executor.serial({"options": {"os_heat_agent_serial": "false"}})
+  assert not executor.serial({"options": {}})
+
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/bin/bash"}], indirect=True)
+def test_timeout_is_reported(init_shell_config):
+  shell.init()
+  deployment = make_deployment(1, "echo before; sleep 60", {"os_heat_agent_timeout": 0.5})
+  with requests_mock.Mocker() as mock:
+    mock.post(requests_mock.ANY, status_code=200)
+    result = executor.execute(deployment)
+  assert result["deploy_status_code"] == str(executor.TIMEOUT_STATUS_CODE)
+  assert result["deploy_stdout"] == "before\n"
+  assert "timed out after 0.5 seconds" in result["os_heat_agent_is_error"]
+
+###
+### Dependencies
+###
+
+def with_dependencies(deployment, *names):
+  deployment["inputs"].append({"name": "os_heat_agent_depends_on", "value": list(names)})
+  return (deployment, "new deployment")
+
+@pytest.fixture
+def recorder(monkeypatch):
+  """Stands in for execute, failing deployments whose command is `fail`."""
+  events = []
+  lock = threading.Lock()
+
+  def fake_execute(deployment, reason=None, journal=None):
+    with lock:
+      events.append(("start", deployment["name"]))
+    time.sleep(0.02)
+    with lock:
+      events.append(("end", deployment["name"]))
+    code = "1" if deployment["config"] == "fail" else "0"
+    return {"name": deployment["name"], "deploy_status_code": code}
+
+  skipped = []
+  def fake_skip(deployment, message, journal=None):
+    skipped.append((deployment["name"], message))
+    return {"name": deployment["name"], "deploy_status_code": str(executor.DEPENDENCY_STATUS_CODE)}
+
+  monkeypatch.setattr(executor, "execute", fake_execute)
+  monkeypatch.setattr(executor, "skip", fake_skip)
+  return events, skipped
+
+def test_depends_on_values():
+  assert executor.depends_on({"inputs": [{"name": "os_heat_agent_depends_on", "value": ["a", "b"]}]}) == ["a", "b"]
+  assert executor.depends_on({"inputs": [{"name": "os_heat_agent_depends_on", "value": "a, b"}]}) == ["a", "b"]
+  assert executor.depends_on({"inputs": [{"name": "os_heat_agent_depends_on", "value": '["a"]'}]}) == ["a"]
+  assert executor.depends_on({"options": {"os_heat_agent_depends_on": "a"}}) == ["a"]
+  assert executor.depends_on({"inputs": [], "options": {}}) == []
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_dependencies_run_in_waves(recorder, workers):
+  events, skipped = recorder
+  selected = [
+    with_dependencies(make_deployment(1, "true"), "02-test"),
+    (make_deployment(2, "true"), "new deployment"),
+    (make_deployment(3, "true"), "new deployment"),
+    with_dependencies(make_deployment(4, "true"), "01-test", "03-test"),
+  ]
+  results = executor.run(selected, workers=workers)
+  assert [r["name"] for r in results] == ["01-test", "02-test", "03-test", "04-test"]
+  order = [name for event, name in events if event == "end"]
+  assert order.index("02-test") < order.index("01-test") < order.index("04-test")
+  assert order.index("03-test") < order.index("04-test")
+  # 2 and 3 are independent, so run together in the first wave
+  if workers > 1:
+    assert {events[0][1], events[1][1]} == {"02-test", "03-test"}
+  assert skipped == []
+
+def test_failed_dependency_skips_dependents(recorder):
+  events, skipped = recorder
+  selected = [
+    (make_deployment(1, "fail"), "new deployment"),
+    with_dependencies(make_deployment(2, "true"), "01-test"),
+    with_dependencies(make_deployment(3, "true"), "02-test"),
+    (make_deployment(4, "true"), "new deployment"),
+  ]
+  results = executor.run(selected, workers=4)
+  ran = {name for event, name in events}
+  assert ran == {"01-test", "04-test"}
+  assert skipped == [
+    ("02-test", "Depends on 01-test, which failed"),
+    ("03-test", "Depends on 02-test, which failed"),
+  ]
+  assert results[2]["deploy_status_code"] == str(executor.DEPENDENCY_STATUS_CODE)
+
+def test_cycles_are_found_before_running(recorder):
+  events, skipped = recorder
+  selected = [
+    with_dependencies(make_deployment(1, "true"), "02-test"),
+    with_dependencies(make_deployment(2, "true"), "01-test"),
+    with_dependencies(make_deployment(3, "true"), "02-test"),
+    (make_deployment(4, "true"), "new deployment"),
+  ]
+  executor.run(selected, workers=1)
+  assert skipped[:2] == [
+    ("01-test", "Dependency cycle: 01-test -> 02-test -> 01-test"),
+    ("02-test", "Dependency cycle: 02-test -> 01-test -> 02-test"),
+  ]
+  assert skipped[2] == ("03-test", "Depends on 02-test, which failed")
+  assert [name for event, name in events] == ["04-test", "04-test"]
+
+def test_dependency_on_completed_deployment(recorder):
+  events, skipped = recorder
+  selected = [
+    with_dependencies(make_deployment(1, "true"), "00-done"),
+    with_dependencies(make_deployment(2, "true"), "00-missing"),
+  ]
+  executor.run(selected, completed={"00-done"})
+  assert [name for event, name in events] == ["01-test", "01-test"]
+  assert skipped == [("02-test", "Depends on 00-missing, which has not been deployed")]
+
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/bin/bash"}], indirect=True)
+def test_skipped_dependent_is_signalled(init_shell_config):
+  shell.init()
+  selected = [
+    (make_deployment(1, "exit 2"), "new deployment"),
+    with_dependencies(make_deployment(2, "echo never"), "01-test"),
+  ]
+  with requests_mock.Mocker() as mock:
+    mock.post(requests_mock.ANY, status_code=200)
+    results = executor.run(selected)
+    signals = {r.url: r.json() for r in mock.request_history}
+  assert results[1]["deploy_stdout"] == ""
+  signal = signals["http://signal.test/2"]
+  assert signal["deploy_status_code"] == str(executor.DEPENDENCY_STATUS_CODE)
+  assert signal["os_heat_agent_is_error"] == "Depends on 01-test, which failed"
+
+###
+###
+###
+
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/bin/bash"}], indirect=True)
+def test_large_output_is_compacted(init_shell_config):
+  config.read_dict({"signal": {"max_bytes": 4096, "error_bytes": 256}})
+  shell.init()
+  selected = [(make_deployment(1, "head -c 200000 /dev/zero | tr '\\0' e >&2; exit 1"), "new deployment")]
+  with requests_mock.Mocker() as mock:
+    mock.post(requests_mock.ANY, status_code=200)
+    executor.run(selected)
+    body = mock.last_request.body
+  assert len(body) <= 4096
+  signal = json.loads(body)
+  assert signal["deploy_status_code"] == "1"
+  assert signal["os_heat_agent_is_error"].endswith("eeee")
+  assert signal["os_heat_agent_stderr_log"]["bytes"] == 200000
@@ -0,0 +1,108 @@
+import pytest
+import requests_mock
+from click.testing import CliRunner
+from os_heat_agent import journal, changes, executor, signals, main
+from os_heat_agent.runners import shell
+
+def make_deployment(ident, command="true", action="CREATE"):
+  return {
+    "id": ident,
+    "name": f"{ident}-name",
+    "group": "Web::Shell::Bash",
+    "config": command,
+    "inputs": [
+      {"name": "deploy_action", "value": action},
+      {"name": "deploy_signal_id", "value": f"http://signal.test/{ident}"},
+    ],
+    "outputs": [
+      {"name": "os_heat_agent_is_error", "type": "Boolean", "error_output": True},
+    ],
+    "options": {"os_heat_agent_serialize": False},
+  }
+
+@pytest.fixture
+def runs(tmp_path):
+  j = journal.Journal(tmp_path.joinpath("journal.sqlite"))
+  yield j
+  j.close()
+
+###
+###
+###
+
+def test_completed_uses_latest_finished_run(runs):
+  first = make_deployment("a")
+  second = make_deployment("a", command="false")
+  runs.finished(runs.started(first), 0)
+  runs.finished(runs.started(second), 1)
+  # Started but never finished
+  runs.started(make_deployment("b"))
+  completed = runs.completed()
+  assert list(completed) == ["a"]
+  assert completed["a"]["digest"] == changes.fingerprint(second)["digest"]
+  # What that run did is kept too
+  assert completed["a"]["exit_code"] == 1
+  assert completed["a"]["action"] == "CREATE"
+  assert completed["a"]["finished_at"] is not None
+
+def test_recover_marks_interrupted(runs):
+  runs.finished(runs.started(make_deployment("a")), 0)
+  runs.started(make_deployment("b"))
+  interrupted = runs.recover()
+  assert [row["deployment_id"] for row in interrupted] == ["b"]
+  assert runs.history(deployment="b")[0]["signal_status"] == journal.INTERRUPTED
+  # Only reported once
+  assert runs.recover() == []
+
+def test_signalled_updates_latest_run(runs):
+  runs.finished(runs.started(make_deployment("a")), 0)
+  runs.finished(runs.started(make_deployment("a", action="UPDATE")), 0)
+  runs.signalled("a", signals.DELIVERED)
+  history = runs.history(deployment="a")
+  assert [row["signal_status"] for row in history] == [signals.DELIVERED, None]
+  assert [row["action"] for row in history] == ["UPDATE", "CREATE"]
+
+def test_persists_across_reopen(tmp_path):
+  path = tmp_path.joinpath("journal.sqlite")
+  first = journal.Journal(path)
+  deployment = make_deployment("a")
+  first.finished(first.started(deployment), 0)
+  first.close()
+  second = journal.Journal(path)
+  assert second.completed()["a"]["digest"] == changes.fingerprint(deployment)["digest"]
+  second.close()
+
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/bin/bash"}], indirect=True)
+def test_executor_records_runs(init_shell_config, runs):
+  shell.init()
+  selected = [(make_deployment("a", "exit 2"), "new deployment")]
+  with requests_mock.Mocker() as mock:
+    mock.post(requests_mock.ANY, status_code=200)
+    executor.run(selected, journal=runs)
+  row = runs.history()[0]
+  assert row["exit_code"] == 2
+  assert row["finished_at"] >= row["started_at"]
+  assert row["signal_status"] == signals.DELIVERED
+
+def test_history_command(init_config, tmp_path, runs):
+  runs.finished(runs.started(make_deployment("a")), 0)
+  config_file = tmp_path.joinpath("agent.ini")
+  config_file.write_text(f"""
+[cache]
+dir = {tmp_path}
+journal_filename = journal.sqlite
+""")
+  result = CliRunner().invoke(main, ["-c", str(config_file), "history"])
+  assert result.exit_code == 0
+  assert "a-name" in result.output
+  assert "CREATE" in result.output
+
+def test_history_command_no_journal(init_config, tmp_path):
+  config_file = tmp_path.joinpath("agent.ini")
+  config_file.write_text(f"""
+[cache]
+dir = {tmp_path}
+journal_filename = missing.sqlite
+""")
+  result = CliRunner().invoke(main, ["-c", str(config_file), "history"])
+  assert result.exit_code == 1
@@ -0,0 +1,219 @@
+import io
+import json
+import logging
+import pytest
+import signal
+import subprocess
+import sys
+import threading
+import time
+import structlog
+from os_heat_agent import logs, metrics
+
+class SlowStream(io.StringIO):
+  """Holds up every write until it's released."""
+  def __init__(self):
+    super().__init__()
+    self.released = threading.Event()
+  def write(self, text):
+    self.released.wait()
+    return super().write(text)
+
+@pytest.fixture
+def pipeline(init_config):
+  """Configures logging into a buffer, and returns a function that waits for
+  and returns what's been written, one event per line."""
+  init_config.read_dict({"logging": {"renderer": "json"}})
+  root = logging.getLogger()
+  level = root.level
+  stream = io.StringIO()
+
+  def configure(log_level=logging.INFO, stream=stream):
+    logs.configure(log_level, stream)
+    def written():
+      logs.pipeline.flush()
+      return [json.loads(line) for line in stream.getvalue().splitlines()]
+    return written
+
+  yield configure
+  logs.pipeline.close()
+  logs.pipeline = None
+  for handler in [h for h in root.handlers if isinstance(h, logs.Handler)]:
+    root.removeHandler(handler)
+  root.setLevel(level)
+  structlog.reset_defaults()
+
+###
+
+def test_disabled_level_isnt_rendered(pipeline):
+  written = pipeline(logging.INFO)
+  calls = []
+  expensive = logs.lazy(lambda: calls.append(1) or "details")
+  structlog.getLogger("test").debug("not logged %s", expensive, extra=expensive)
+  logging.getLogger("test").debug("not logged %s", expensive)
+  assert written() == []
+  assert calls == []
+
+def test_lazy_is_resolved_once(pipeline):
+  written = pipeline(logging.DEBUG)
+  calls = []
+  expensive = logs.lazy(lambda: calls.append(1) or "details")
+  structlog.getLogger("test").debug("logged %s", expensive, extra=expensive)
+  event = written()[0]
+  assert event["event"] == "logged details"
+  assert event["extra"] == "details"
+  assert event["level"] == "debug"
+  assert event["logger"] == "test"
+  assert calls == [1]
+
+def test_fields_are_truncated(init_config, pipeline):
+  init_config.read_dict({"logging": {"field_length": 100, "field_items": 3}})
+  written = pipeline()
+  structlog.getLogger("test").info("x" * 1000, inputs={str(i): i for i in range(10)})
+  event = written()[0]
+  assert len(event["event"]) < 150
+  assert event["event"].startswith("x" * 50)
+  assert "900 characters elided" in event["event"]
+  assert event["inputs"] == {"0": 0, "1": 1, "2": 2, "...": "7 more"}
+
+def test_snapshot_is_taken_when_logged(pipeline):
+  stream = SlowStream()
+  written = pipeline(stream=stream)
+  inputs = {"a": [1]}
+  structlog.getLogger("test").info("inputs", inputs=inputs)
+  inputs["a"].append(2)
+  stream.released.set()
+  assert written()[0]["inputs"] == {"a": [1]}
+
+def test_standard_library_logging(pipeline):
+  written = pipeline()
+  try:
+    raise ValueError("broken")
+  except ValueError:
+    logging.getLogger("stdlib").exception("failed %s", "here")
+  event = written()[0]
+  assert event["event"] == "failed here"
+  assert event["level"] == "error"
+  assert event["logger"] == "stdlib"
+  assert "ValueError: broken" in event["exception"]
+
+def test_console_renderer(init_config, pipeline):
+  init_config["logging"]["renderer"] = "console"
+  stream = io.StringIO()
+  pipeline(stream=stream)
+  structlog.getLogger("test").warning("hello", key="value")
+  logs.pipeline.flush()
+  assert "hello" in stream.getvalue()
+  assert "key=value" in stream.getvalue()
+
+###
+
+def test_drop_policy(init_config, pipeline):
+  init_config.read_dict({"logging": {"queue_size": 2, "policy": "drop"}})
+  stream = SlowStream()
+  written = pipeline(stream=stream)
+  before = metrics.LOG_EVENTS_DROPPED.value()
+  log = structlog.getLogger("test")
+  started = time.monotonic()
+  for i in range(10):
+    log.info("event", index=i)
+  # Never waits on the writer
+  assert time.monotonic() - started < 1
+  stream.released.set()
+  events = written()
+  dropped = logs.pipeline.dropped
+  assert dropped >= 7
+  assert len([e for e in events if e["event"] == "event"]) == 10 - dropped
+  # Reported once the writer catches up
+  assert f"Dropped {dropped} log events; the log queue was full" in [e["event"] for e in events]
+  assert metrics.LOG_EVENTS_DROPPED.value() - before == dropped
+
+def test_block_policy(init_config, pipeline):
+  init_config.read_dict({"logging": {"queue_size": 2, "policy": "block"}})
+  stream = SlowStream()
+  written = pipeline(stream=stream)
+  log = structlog.getLogger("test")
+  thread = threading.Thread(target=lambda: [log.info("event", index=i) for i in range(10)])
+  thread.start()
+  thread.join(0.2)
+  # Waiting for room on the queue
+  assert thread.is_alive()
+  stream.released.set()
+  thread.join(5)
+  assert [e["index"] for e in written()] == list(range(10))
+  assert logs.pipeline.dropped == 0
+
+def test_close_writes_everything(pipeline):
+  stream = io.StringIO()
+  pipeline(stream=stream)
+  for i in range(100):
+    structlog.getLogger("test").info("event", index=i)
+  logs.pipeline.close()
+  assert len(stream.getvalue().splitlines()) == 100
+  # Written straight away once the writer has stopped
+  structlog.getLogger("test").info("late")
+  assert "late" in stream.getvalue()
+
+def test_close_while_logging_loses_nothing(init_config, pipeline):
+  init_config.read_dict({"logging": {"policy": "block"}})
+  stream = io.StringIO()
+  pipeline(stream=stream)
+  stop = threading.Event()
+  counts = [0] * 4
+
+  def log(index):
+    while not stop.is_set():
+      logs.pipeline.put({"event": "event", "level": "info"})
+      counts[index] += 1
+
+  threads = [threading.Thread(target=log, args=(i,)) for i in range(len(counts))]
+  for thread in threads:
+    thread.start()
+  time.sleep(0.05)
+  logs.pipeline.close()
+  stop.set()
+  for thread in threads:
+    thread.join(5)
+  assert len(stream.getvalue().splitlines()) == sum(counts)
+
+SIGTERM_SCRIPT = """
+import signal, sys, time
+import structlog
+import os_heat_agent
+from os_heat_agent import logs
+from os_heat_agent.config import config
+
+class Slow:
+  def write(self, text):
+    time.sleep(0.01)
+    sys.stdout.write(text)
+  def flush(self):
+    sys.stdout.flush()
+
+config.read_dict({"logging": {"renderer": "json", "queue_size": "1", "policy": "block"}})
+logs.configure(20, Slow())
+signal.signal(signal.SIGTERM, os_heat_agent._terminate)
+print("ready", flush=True)
+index = 0
+while True:
+  structlog.getLogger("test").info("event", index=index)
+  index += 1
+"""
+
+def test_sigterm_while_logging_exits(tmp_path):
+  # Killed while waiting for room on the queue, which is where the agent
+  #   spends its time when logging is slow.
+  process = subprocess.Popen([sys.executable, "-c", SIGTERM_SCRIPT],
+    stdout=subprocess.PIPE, text=True)
+  try:
+    assert process.stdout.readline() == "ready\n"
+    time.sleep(0.2)
+    process.send_signal(signal.SIGTERM)
+    stdout, stderr = process.communicate(timeout=10)
+  finally:
+    process.kill()
+  assert process.returncode == 128 + signal.SIGTERM
+  indexes = [json.loads(line)["index"] for line in stdout.splitlines()]
+  # Everything that was queued was written out on the way out
+  assert indexes == list(range(len(indexes)))
+  assert len(indexes) > 1
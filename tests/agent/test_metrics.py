@@ -0,0 +1,125 @@
+import pytest
+import requests
+import requests_mock
+from os_heat_agent import metrics, executor
+from os_heat_agent.config import config
+from os_heat_agent.runners import shell
+
+@pytest.fixture
+def clean_metrics():
+  # Metrics are global to the agent
+  for metric in metrics.registry:
+    metric.clear()
+  yield metrics
+  for metric in metrics.registry:
+    metric.clear()
+
+def make_deployment(index, command):
+  return {
+    "id": f"deployment-{index}",
+    "name": f"{index:02}-test",
+    "group": "Web::Shell::Bash",
+    "config": command,
+    "inputs": [
+      {"name": "deploy_signal_id", "value": f"http://signal.test/{index}"},
+    ],
+    "outputs": [
+      {"name": "os_heat_agent_is_error", "type": "Boolean", "error_output": True},
+    ],
+    "options": {"os_heat_agent_serialize": False},
+  }
+
+###
+###
+###
+
+def test_render_counter_and_gauge():
+  counter = metrics.Counter("test_total", "A counter.")
+  gauge = metrics.Gauge("test_gauge", "A \"gauge\".", labels=("tool",))
+  counter.inc()
+  counter.inc(2)
+  gauge.set(1.5, tool="shell")
+  assert metrics.render([counter, gauge]) == "\n".join([
+    "# HELP test_total A counter.",
+    "# TYPE test_total counter",
+    "test_total 3",
+    '# HELP test_gauge A \\"gauge\\".',
+    "# TYPE test_gauge gauge",
+    'test_gauge{tool="shell"} 1.5',
+  ]) + "\n"
+
+def test_render_histogram():
+  histogram = metrics.Histogram("test_seconds", "A histogram.", buckets=(1, 5))
+  for value in (0.5, 2, 10):
+    histogram.observe(value)
+  lines = metrics.render([histogram]).splitlines()
+  assert lines[2:] == [
+    'test_seconds_bucket{le="1"} 1',
+    'test_seconds_bucket{le="5"} 2',
+    'test_seconds_bucket{le="+Inf"} 3',
+    "test_seconds_sum 12.5",
+    "test_seconds_count 3",
+  ]
+
+def test_labels_must_match():
+  gauge = metrics.Gauge("test_gauge", "A gauge.", labels=("tool",))
+  with pytest.raises(ValueError):
+    gauge.set(1)
+
+def test_counter_cannot_decrease():
+  with pytest.raises(ValueError):
+    metrics.Counter("test_total", "A counter.").inc(-1)
+
+def test_timer_observes_on_error():
+  histogram = metrics.Histogram("test_seconds", "A histogram.")
+  with pytest.raises(RuntimeError):
+    with histogram.time():
+      raise RuntimeError()
+  assert histogram.count() == 1
+
+###
+###
+###
+
+def test_export_textfile(init_config, clean_metrics, tmp_path):
+  path = tmp_path.joinpath("os_heat_agent.prom")
+  config.read_dict({"metrics": {"textfile": str(path)}})
+  metrics.DEPLOYMENTS_RUN.inc()
+  metrics.export(config["metrics"])
+  assert "os_heat_agent_deployments_run_total 1\n" in path.read_text()
+  # Nothing left behind from the atomic write
+  assert [p.name for p in tmp_path.iterdir()] == ["os_heat_agent.prom"]
+
+def test_export_disabled(init_config, clean_metrics, tmp_path):
+  config.read_dict({"metrics": {"textfile": ""}})
+  metrics.export(config["metrics"])
+  assert list(tmp_path.iterdir()) == []
+
+def test_serve(clean_metrics):
+  server = metrics.serve("127.0.0.1", 0)
+  try:
+    metrics.DEPLOYMENTS_SKIPPED.inc(4)
+    url = "http://%s:%s" % server.server_address[:2]
+    response = requests.get(f"{url}/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == metrics.CONTENT_TYPE
+    assert "os_heat_agent_deployments_skipped_total 4\n" in response.text
+    assert requests.get(f"{url}/other").status_code == 404
+  finally:
+    metrics.shutdown()
+
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/bin/bash"}], indirect=True)
+def test_executor_counts_deployments(init_shell_config, clean_metrics):
+  shell.init()
+  selected = [
+    (make_deployment(1, "true"), "new deployment"),
+    (make_deployment(2, "exit 1"), "new deployment"),
+  ]
+  with requests_mock.Mocker() as mock:
+    mock.post(requests_mock.ANY, status_code=200)
+    executor.run(selected)
+  assert metrics.DEPLOYMENTS_RUN.value() == 2
+  assert metrics.DEPLOYMENTS_FAILED.value() == 1
+  assert metrics.DEPLOYMENTS_TIMED_OUT.value() == 0
+  assert metrics.RUN_SECONDS.count(tool="shell") == 2
+  assert metrics.SIGNAL_SECONDS.count() == 2
@@ -0,0 +1,111 @@
+import logging
+import pytest
+import pstats
+import requests_mock
+import structlog
+from structlog.testing import capture_logs
+from os_heat_agent import profiling, executor
+from os_heat_agent.runners import shell
+
+class FakeClock:
+  def __init__(self):
+    self.now = 0.0
+  def __call__(self):
+    return self.now
+
+@pytest.fixture
+def profiler():
+  p = profiling.enable()
+  yield p
+  profiling.disable()
+
+def make_deployment(command):
+  return {
+    "id": "deployment-1",
+    "name": "01-test",
+    "group": "Web::Shell::Bash",
+    "config": command,
+    "inputs": [
+      {"name": "deploy_signal_id", "value": "http://signal.test/1"},
+    ],
+    "outputs": [
+      {"name": "os_heat_agent_is_error", "type": "Boolean", "error_output": True},
+    ],
+    "options": {"os_heat_agent_serialize": False},
+  }
+
+###
+###
+###
+
+def test_span_disabled_is_shared_noop():
+  profiling.disable()
+  assert profiling.span("a") is profiling.span("b")
+  with profiling.span("a"):
+    pass
+  # Nothing to do
+  profiling.end_cycle()
+
+def test_cycle_breakdown():
+  # Running the CLI elsewhere may have left INFO filtered out
+  structlog.reset_defaults()
+  clock = FakeClock()
+  p = profiling.Profiler(clock=clock)
+  with p.span("get_config"):
+    clock.now += 0.5
+  for _ in range(2):
+    with p.span("signal"):
+      clock.now += 0.25
+  with capture_logs() as logs:
+    breakdown = p.end_cycle()
+  assert breakdown == {
+    "get_config": {"seconds": 0.5, "count": 1},
+    "signal": {"seconds": 0.5, "count": 2},
+  }
+  assert logs == [{
+    "event": "cycle profile",
+    "log_level": "info",
+    "cycle": 1,
+    "total_seconds": 1.0,
+    "phases": breakdown,
+  }]
+  # The next cycle starts empty
+  assert p.end_cycle() == {}
+
+def test_cycle_logged_at_configured_level():
+  structlog.reset_defaults()
+  p = profiling.enable(level=logging.WARNING)
+  try:
+    with capture_logs() as logs:
+      p.end_cycle()
+  finally:
+    profiling.disable()
+  assert [(e["event"], e["log_level"]) for e in logs] == [("cycle profile", "warning")]
+
+def test_span_records_on_error():
+  p = profiling.Profiler(clock=FakeClock())
+  with pytest.raises(RuntimeError):
+    with p.span("diff"):
+      raise RuntimeError()
+  assert p.end_cycle()["diff"]["count"] == 1
+
+def test_dump_after_cycles(tmp_path):
+  path = tmp_path.joinpath("agent.pstats")
+  p = profiling.Profiler(dump=str(path), cycles=2)
+  sum(range(1000))
+  p.end_cycle()
+  assert not path.exists()
+  p.end_cycle()
+  assert path.exists()
+  assert pstats.Stats(str(path)).total_calls > 0
+
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/bin/bash"}], indirect=True)
+def test_executor_phases(init_shell_config, profiler):
+  shell.init()
+  with requests_mock.Mocker() as mock:
+    mock.post(requests_mock.ANY, status_code=200)
+    executor.run([(make_deployment("true"), "new deployment")])
+  phases = profiler.end_cycle()
+  assert set(phases) == {
+    "get_deployment", "runner_pre", "runner_run", "runner_post", "signal"
+  }
@@ -0,0 +1,107 @@
+import pytest
+from os_heat_agent import scheduler
+from os_heat_agent.config import config
+
+class Clock:
+  def __init__(self):
+    self.now = 0.0
+  def __call__(self):
+    return self.now
+
+@pytest.fixture
+def clock():
+  return Clock()
+
+def make(clock, jitter=0.0, server_id="server"):
+  return scheduler.Scheduler(
+    minimum=5, maximum=60, decay=2, window=30, jitter=jitter,
+    server_id=server_id, clock=clock
+  )
+
+###
+###
+###
+
+def test_idle_polling_after_start(clock):
+  s = make(clock)
+  assert s.next_interval() == 60
+  clock.now = 10
+  s.record(changed=False)
+  assert s.next_interval() == 60
+
+def test_fast_polling_after_first_change(clock):
+  s = make(clock)
+  clock.now = 10
+  s.record(changed=True)
+  assert s.next_interval() == 5
+
+def test_backs_off_to_ceiling(clock):
+  s = make(clock)
+  s.record(changed=True)
+  intervals = []
+  for _ in range(6):
+    clock.now += 31
+    s.record(changed=False)
+    intervals.append(s.next_interval())
+  assert intervals == [10, 20, 40, 60, 60, 60]
+
+def test_change_resets_to_minimum(clock):
+  s = make(clock)
+  s.record(changed=True)
+  for _ in range(4):
+    clock.now += 31
+    s.record(changed=False)
+  assert s.next_interval() == 60
+  clock.now += 60
+  s.record(changed=True)
+  assert s.next_interval() == 5
+  # Still inside the window
+  clock.now += 20
+  s.record(changed=False)
+  assert s.next_interval() == 5
+
+def test_jitter_is_deterministic_and_bounded(clock):
+  a = make(clock, jitter=0.1, server_id="916255c9-1b97-4cce-a4d5-ff1d35196d6b")
+  b = make(clock, jitter=0.1, server_id="916255c9-1b97-4cce-a4d5-ff1d35196d6b")
+  assert a.next_interval() == b.next_interval()
+  assert 54 <= a.next_interval() <= 66
+
+def test_jitter_spreads_servers(clock):
+  intervals = [
+    make(clock, jitter=0.5, server_id=f"server-{i}").next_interval()
+    for i in range(200)
+  ]
+  # Roughly even either side of the nominal interval
+  below = len([i for i in intervals if i < 60])
+  assert 70 < below < 130
+  assert min(intervals) >= 30 and max(intervals) <= 90
+  # Across the whole interval from the start, rather than bunched up
+  assert max(intervals) - min(intervals) > 45
+
+def test_from_config(init_config):
+  config.read_dict({"agent": {
+    "min_polling_interval": 5,
+    "polling_decay": 2,
+    "fast_polling_window": 300,
+    "polling_jitter": 0.1
+  }})
+  s = scheduler.Scheduler.from_config(config["agent"], server_id="server")
+  assert s.maximum == 60
+  config["agent"]["max_polling_interval"] = "120"
+  config["agent"]["min_polling_interval"] = "1"
+  s = scheduler.Scheduler.from_config(config["agent"], server_id="server")
+  assert (s.minimum, s.maximum) == (1, 120)
+
+@pytest.mark.parametrize("load_heat_fixture", ["software_config/os-cfn-current.json"], indirect=True)
+def test_server_id(load_heat_fixture):
+  assert scheduler.server_id(load_heat_fixture) == "916255c9-1b97-4cce-a4d5-ff1d35196d6b"
+  assert scheduler.server_id({"deployments": []}) is None
+
+def test_sleep_with_wait():
+  schedule = scheduler.Scheduler(minimum=5, maximum=60, jitter=0)
+  waited = []
+  def wait(interval):
+    waited.append(interval)
+    return True
+  assert schedule.sleep(wait) is True
+  assert waited == [60]
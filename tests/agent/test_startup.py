@@ -0,0 +1,73 @@
+import pytest
+import subprocess
+import sys
+from os_heat_agent import deployments
+
+# Importing the package should cost structlog, click and very little else.
+#   It measures around 80ms; the budget leaves plenty of room for a slow
+#   machine, but not for pulling requests back in.
+IMPORT_BUDGET = 0.2
+
+# Modules that only the running agent needs.
+LAZY_MODULES = [
+  "requests",
+  "urllib3",
+  "sqlite3",
+  "boto3",
+  "botocore",
+  "os_heat_agent.deployments",
+  "os_heat_agent.runners.shell",
+  "os_heat_agent.runners.babashka",
+  "os_heat_agent.heat",
+  "os_heat_agent.cache",
+  "os_heat_agent.journal",
+]
+
+def import_time() -> tuple:
+  """Import the package in a fresh interpreter.
+
+  Returns:
+    tuple: Cumulative import time of the package in seconds, and the set of
+      modules that were imported.
+  """
+  result = subprocess.run(
+    [sys.executable, "-X", "importtime", "-c", "import os_heat_agent"],
+    capture_output=True, text=True, check=True,
+  )
+  modules = set()
+  cumulative = None
+  for line in result.stderr.splitlines():
+    if not line.startswith("import time:") or "|" not in line:
+      continue
+    _, total, name = line.split("|")
+    if not total.strip().isdigit():
+      # The header
+      continue
+    modules.add(name.strip())
+    if name.strip() == "os_heat_agent":
+      cumulative = int(total) / 1_000_000
+  return cumulative, modules
+
+###
+
+def test_import_is_lazy():
+  _, modules = import_time()
+  assert [module for module in LAZY_MODULES if module in modules] == []
+
+def test_import_time_budget():
+  # Best of three, so a busy machine doesn't fail the build
+  timings = [import_time()[0] for _ in range(3)]
+  assert min(timings) < IMPORT_BUDGET
+
+###
+
+def test_tools_import_on_first_use():
+  tools = deployments.Tools()
+  assert "shell" not in tools
+  from os_heat_agent.runners import shell
+  assert tools["shell"] is shell
+  assert "shell" in tools
+
+def test_tools_unknown_runner():
+  with pytest.raises(KeyError):
+    deployments.Tools()["ansible"]
@@ -0,0 +1,163 @@
+"""Harness for the agent's microbenchmarks.
+
+Benchmarks are ordinary tests, marked `benchmark` so that they don't run
+  with the rest of the suite, which use the `bench` fixture to time a
+  function. Each timing is kept, and at the end of the session:
+
+  - written as JSON to `--bench-output`, if given, and
+  - compared against the JSON in `--bench-compare`, if given, printing the
+    ratio of each benchmark's median to the baseline's.
+
+Benchmarks slower than the baseline by more than `--bench-threshold` are
+  flagged as regressions. With `--bench-strict`, they also fail the run.
+
+Run them with `just bench`. `just bench-baseline` refreshes the stored
+  baseline, `tests/benchmarks/baseline.json`, which should be done on the
+  same machine and committed along with anything that deliberately changes
+  performance.
+"""
+import gc
+import json
+import platform
+import statistics
+import sys
+import time
+from pathlib import Path
+import pytest
+
+# Results for this session, keyed by benchmark name.
+results = {}
+
+def pytest_addoption(parser):
+  group = parser.getgroup("benchmarks")
+  group.addoption("--bench-output", default=None,
+    help="Write benchmark results to this JSON file.")
+  group.addoption("--bench-compare", default=None,
+    help="Compare benchmark results against this JSON file.")
+  group.addoption("--bench-threshold", default=1.25, type=float,
+    help="Flag benchmarks whose median is this many times the baseline's.")
+  group.addoption("--bench-strict", action="store_true", default=False,
+    help="Fail the run if any benchmark regressed.")
+
+def _option(config, name):
+  # Options are only registered when this directory is part of the run.
+  return config.getoption(name, default=None)
+
+class Bench:
+  """
+  Times a function over a number of rounds, and records the result.
+  """
+
+  def __init__(self, name: str):
+    self.name = name
+
+  def __call__(self, function, *args, rounds: int = 20, iterations: int = 1,
+               setup=None, **kwargs):
+    """Time `function(*args, **kwargs)`.
+
+    Args:
+      rounds (int): How many timings to take.
+      iterations (int): Calls per timing, for very fast functions. Timings
+        are per call.
+      setup (callable, optional): Called before every round, untimed. If it
+        returns a tuple, that is used as the arguments for that round.
+
+    Returns:
+      The return value of the last call.
+    """
+    def arguments():
+      if setup is None:
+        return args
+      return setup() or args
+
+    # Warm up caches and lazy imports so the first round isn't an outlier.
+    result = function(*arguments(), **kwargs)
+    timings = []
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+      for _ in range(rounds):
+        round_args = arguments()
+        started = time.perf_counter()
+        for _ in range(iterations):
+          result = function(*round_args, **kwargs)
+        timings.append((time.perf_counter() - started) / iterations)
+    finally:
+      if enabled:
+        gc.enable()
+    results[self.name] = {
+      "rounds": rounds,
+      "iterations": iterations,
+      "min": min(timings),
+      "median": statistics.median(timings),
+      "mean": statistics.mean(timings),
+      "stdev": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+    }
+    return result
+
+@pytest.fixture
+def bench(request):
+  """Time a function, recording the result under this test's name."""
+  name = request.node.originalname.removeprefix("test_")
+  return Bench(name)
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+  """Compare results against a baseline.
+
+  Returns:
+    list: (name, baseline median, current median, ratio, regressed) for every
+      benchmark in the current results. Baseline values are None for new
+      benchmarks.
+  """
+  rows = []
+  for name, result in sorted(current.items()):
+    base = baseline.get(name)
+    if base is None:
+      rows.append((name, None, result["median"], None, False))
+      continue
+    ratio = result["median"] / base["median"] if base["median"] else float("inf")
+    rows.append((name, base["median"], result["median"], ratio, ratio > threshold))
+  return rows
+
+def pytest_sessionfinish(session, exitstatus):
+  if not results:
+    return
+  config = session.config
+  output = _option(config, "--bench-output")
+  if output:
+    Path(output).write_text(json.dumps({
+      "machine": {
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "processor": platform.machine(),
+      },
+      "benchmarks": results,
+    }, indent=2, sort_keys=True) + "\n")
+
+  baseline_path = _option(config, "--bench-compare")
+  if not baseline_path or not Path(baseline_path).exists():
+    return
+  baseline = json.loads(Path(baseline_path).read_text())["benchmarks"]
+  threshold = _option(config, "--bench-threshold") or 1.25
+  rows = compare(results, baseline, threshold)
+  config._bench_rows = rows
+  if _option(config, "--bench-strict") and any(row[4] for row in rows):
+    session.exitstatus = pytest.ExitCode.TESTS_FAILED
+
+def pytest_terminal_summary(terminalreporter, exitstatus, config):
+  if not results:
+    return
+  reporter = terminalreporter
+  reporter.section("benchmarks")
+  rows = getattr(config, "_bench_rows", None)
+  if rows is None:
+    for name, result in sorted(results.items()):
+      reporter.write_line(f"{name:<40} {result['median'] * 1000:>12.4f}ms")
+    return
+  reporter.write_line(f"{'BENCHMARK':<40} {'BASELINE':>14} {'CURRENT':>14} {'RATIO':>7}")
+  for name, base, current, ratio, regressed in rows:
+    base = "-" if base is None else f"{base * 1000:.4f}ms"
+    ratio = "new" if ratio is None else f"{ratio:.2f}x"
+    line = f"{name:<40} {base:>14} {current * 1000:>12.4f}ms {ratio:>7}"
+    reporter.write_line(line + ("  REGRESSED" if regressed else ""), red=regressed)
@@ -0,0 +1,53 @@
+"""Benchmarks for loading and saving the agent's state."""
+import json
+import pytest
+from os_heat_agent import cache
+
+def metadata(count: int) -> dict:
+  return {
+    "os-collect-config": {"cfn": {"stack_name": "bench"}},
+    "deployments": [
+      {
+        "id": f"deployment-{i}",
+        "name": f"{i:04}-bench",
+        "group": "Web::Shell::Bash",
+        "config": f"echo {i}\n" * 50,
+        "inputs": [{"name": "deploy_action", "value": "CREATE"}],
+        "outputs": [],
+        "options": {},
+      }
+      for i in range(count)
+    ],
+  }
+
+@pytest.fixture
+def state_file(tmp_path):
+  init_file = tmp_path.joinpath("cfn-init-data")
+  init_file.write_text(json.dumps(metadata(500)))
+  state = cache.StateCache(tmp_path.joinpath("state.json"))
+  state.load(init_file)
+  state.save()
+  return state.path
+
+###
+###
+###
+
+@pytest.mark.benchmark
+def test_cache_load(bench, state_file):
+  def load():
+    state = cache.StateCache(state_file)
+    state.load(None)
+    return state
+  state = bench(load)
+  assert len(state.deployments) == 500
+
+@pytest.mark.benchmark
+def test_cache_save(bench, state_file):
+  state = cache.StateCache(state_file)
+  state.load(None)
+
+  def changed():
+    # Force a write every round
+    state._written = None
+  assert bench(state.save, setup=changed)
@@ -0,0 +1,108 @@
+"""Benchmark a full poll cycle of the agent.
+
+Runs `main()` once around its loop, with a stubbed CloudFormation fetch and
+  signal endpoint, so the timing covers startup, loading the cache, diffing,
+  running every deployment with the shell runner, signalling and saving the
+  state.
+"""
+import itertools
+import json
+import pytest
+import requests_mock
+from os_heat_agent import main, deployments, scheduler, signals, heat
+from os_heat_agent.config import config
+
+DEPLOYMENTS = 10
+
+class CycleFinished(Exception):
+  pass
+
+def metadata(count: int) -> dict:
+  return {
+    "os-collect-config": {
+      "cfn": {
+        "stack_name": "bench",
+        "metadata_url": "http://metadata.test/v1/",
+        "path": "server.Metadata",
+        "secret_access_key": "",
+        "access_key_id": "",
+      },
+    },
+    "deployments": [
+      {
+        "id": f"deployment-{i}",
+        "name": f"{i:02}-bench",
+        "group": "Web::Shell::Bash",
+        "config": f"echo {i}",
+        "inputs": [
+          {"name": "deploy_action", "value": "CREATE"},
+          {"name": "deploy_server_id", "value": "server"},
+          {"name": "deploy_signal_id", "value": f"http://signal.test/{i}"},
+        ],
+        "outputs": [
+          {"name": "os_heat_agent_is_error", "type": "Boolean", "error_output": True},
+        ],
+        "options": {"os_heat_agent_serialize": False},
+      }
+      for i in range(count)
+    ],
+  }
+
+@pytest.fixture
+def agent(monkeypatch, tmp_path):
+  """Stubs out everything main() talks to, and stops it after one cycle."""
+  # main() reads its configuration file over the defaults; put them back
+  #   afterwards.
+  saved = {section: dict(config[section]) for section in config.sections()}
+  monkeypatch.setattr(deployments, "TOOLS", deployments.TOOLS)
+  monkeypatch.setattr(heat, "get_config", lambda cfn, region: metadata(DEPLOYMENTS))
+
+  def stop(self, wait=None):
+    raise CycleFinished()
+  monkeypatch.setattr(scheduler.Scheduler, "sleep", stop)
+
+  counter = itertools.count()
+
+  def fresh():
+    # Every round starts from nothing, so that every deployment runs.
+    root = tmp_path.joinpath(str(next(counter)))
+    root.mkdir()
+    init_file = root.joinpath("cfn-init-data")
+    init_file.write_text(json.dumps(metadata(0)))
+    config_file = root.joinpath("agent.ini")
+    config_file.write_text(f"""
+[cache]
+dir = {root}
+
+[tools.shell.runners]
+bash = /bin/bash
+""")
+    return ([
+      "-c", str(config_file), "-i", str(init_file), "-l", "ERROR",
+    ],)
+
+  yield fresh
+  if signals.dispatcher is not None:
+    signals.dispatcher.stop()
+    signals.dispatcher = None
+  config.clear()
+  config.read_dict(saved)
+
+def cycle(args: list) -> None:
+  with pytest.raises(CycleFinished):
+    main.main(args=args, standalone_mode=False)
+  # Include delivering the signals, which happens in the background.
+  signals.dispatcher.join()
+  signals.dispatcher.stop()
+  signals.dispatcher = None
+
+###
+###
+###
+
+@pytest.mark.benchmark
+def test_main_cycle(bench, agent):
+  with requests_mock.Mocker() as mock:
+    mock.post(requests_mock.ANY, status_code=200)
+    bench(cycle, setup=agent, rounds=5)
+    assert mock.call_count == DEPLOYMENTS * 6
@@ -0,0 +1,71 @@
+"""Benchmarks for turning Heat deployment blobs into Deployments."""
+import copy
+import pytest
+from os_heat_agent import deployments
+
+def software_config(inputs: int, config_bytes: int) -> dict:
+  return {
+    "id": "deployment-1",
+    "name": "01-bench",
+    "group": "Web::Shell::Bash",
+    "config": "#!/bin/bash\n" + "echo line\n" * (config_bytes // 10),
+    "inputs": [
+      {"name": "deploy_action", "value": "CREATE"},
+      {"name": "deploy_server_id", "value": "server"},
+      {"name": "deploy_signal_id", "value": "http://signal.test/1"},
+      {"name": "os_heat_agent_serial", "value": False},
+    ] + [
+      # A mix of environment variables and passthrough inputs
+      {"name": f"envar_VALUE_{i}" if i % 2 else f"input_{i}", "value": f"value {i}"}
+      for i in range(inputs)
+    ],
+    "outputs": [
+      {"name": "os_heat_agent_is_error", "type": "Boolean", "error_output": True},
+    ],
+    "options": {"os_heat_agent_serialize": False},
+  }
+
+def structured_config(keys: int) -> dict:
+  data = software_config(10, 0)
+  data["group"] = "Web::Babashka"
+  data["config"] = {
+    "function": "deploy",
+    "variable_file": "bench",
+    "values": {f"key_{i}": {"nested": [i, f"{i}"]} for i in range(keys)},
+  }
+  return data
+
+def copies(data: dict):
+  # Deployments normalize the blob they're given in place, as the executor
+  #   hands them a copy, so every round needs its own.
+  return lambda: (copy.deepcopy(data),)
+
+###
+###
+###
+
+@pytest.mark.benchmark
+def test_get_deployment_small(bench):
+  setup = copies(software_config(5, 200))
+  result = bench(deployments.get_deployment, setup=setup, rounds=200)
+  assert isinstance(result, deployments.SoftwareConfig)
+
+@pytest.mark.benchmark
+def test_get_deployment_huge(bench):
+  setup = copies(software_config(5000, 1_000_000))
+  result = bench(deployments.get_deployment, setup=setup)
+  assert isinstance(result, deployments.SoftwareConfig)
+
+@pytest.mark.benchmark
+def test_get_deployment_structured_huge(bench):
+  setup = copies(structured_config(5000))
+  result = bench(deployments.get_deployment, setup=setup)
+  assert isinstance(result, deployments.StructuredConfig)
+
+@pytest.mark.benchmark
+def test_deployment_input_classification(bench):
+  # Deployment.__init__ on its own, without get_deployment's dispatch
+  setup = copies(software_config(5000, 200))
+  result = bench(deployments.SoftwareConfig, setup=setup)
+  assert len(result.environment) == 2500
+  assert len(result.inputs) == 2500
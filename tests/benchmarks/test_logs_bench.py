@@ -0,0 +1,60 @@
+"""Benchmarks for logging a deployment's output."""
+import io
+import logging
+import pytest
+import time
+import structlog
+from os_heat_agent import logs
+
+# About what a chatty deployment prints, after capture has kept its head
+#   and tail.
+OUTPUT = "line of deployment output\n" * 2500
+
+class SlowStream(io.StringIO):
+  """A log destination that takes a millisecond per write, like a busy
+  journald."""
+  def write(self, text):
+    time.sleep(0.001)
+    return super().write(text)
+
+@pytest.fixture
+def logging_to(init_config):
+  root = logging.getLogger()
+  level = root.level
+  yield logs.configure
+  logs.pipeline.close()
+  logs.pipeline = None
+  for handler in [h for h in root.handlers if isinstance(h, logs.Handler)]:
+    root.removeHandler(handler)
+  root.setLevel(level)
+  structlog.reset_defaults()
+
+def log_output(logger) -> None:
+  logger.debug(OUTPUT)
+  logger.debug("Exit code %s", 0)
+
+###
+###
+###
+
+@pytest.mark.benchmark
+def test_log_output_sync(bench, logging_to):
+  # What logging used to cost: rendered and written in the deployment's
+  #   own thread.
+  logging_to(logging.DEBUG)
+  structlog.configure(
+    processors=[structlog.processors.add_log_level, structlog.dev.ConsoleRenderer(colors=False)],
+    logger_factory=structlog.PrintLoggerFactory(SlowStream()),
+  )
+  bench(log_output, structlog.getLogger("bench"), iterations=5)
+
+@pytest.mark.benchmark
+def test_log_output_async(bench, logging_to):
+  pipeline = logging_to(logging.DEBUG, SlowStream())
+  bench(log_output, structlog.getLogger("bench"), iterations=5)
+  pipeline.flush()
+
+@pytest.mark.benchmark
+def test_log_output_disabled(bench, logging_to):
+  logging_to(logging.WARNING, SlowStream())
+  bench(log_output, structlog.getLogger("bench"), iterations=1000)
@@ -0,0 +1,105 @@
+"""Benchmarks for the runners' in-process work."""
+import pytest
+from os_heat_agent.config import config
+from os_heat_agent.runners import babashka, shell
+
+def variables(entries: int) -> dict:
+  data = {}
+  for i in range(entries // 4):
+    data[f"string_{i}"] = f"value \"{i}\" with $things"
+    data[f"number_{i}"] = i
+    data[f"list_{i}"] = [f"a{i}", f"b {i}"]
+  data["table"] = {f"key {i}": f"value {i}" for i in range(entries // 4)}
+  data["nested"] = {"inner": {"deeper": list(range(10))}}
+  return data
+
+###
+###
+###
+
+@pytest.mark.benchmark
+def test_bashify(bench):
+  data = variables(1000)
+  result = bench(babashka.bashify, data, iterations=10)
+  assert result
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/bin/bash"}], indirect=True)
+def test_shell_command(init_shell_config, bench):
+  shell.init()
+  data = shell.normalize({
+    "group": ["bash"],
+    "command": "echo \"$HOME\" 'quoted' `id` && ls -al /etc | wc -l",
+  })
+  result = bench(shell.command, data, iterations=1000)
+  assert result[-1] == data["command"]
+
+def delivered(data: dict):
+  shell.pre(data, {})
+  try:
+    return shell.run(data)
+  finally:
+    shell.post(data)
+
+def delivery(bench, mode: str):
+  # A serialized script of a realistic size, delivered each way; `file` is
+  #   how every serialized script used to be delivered.
+  config.read_dict({"tools.shell": {"delivery": mode}})
+  shell.init()
+  data = shell.normalize({
+    "group": ["bash"],
+    "command": "# padding\n" * 2000 + "echo done\n",
+    "serialize": True,
+  })
+  result = bench(delivered, data)
+  assert result.stdout == "done\n"
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/bin/bash"}], indirect=True)
+def test_shell_file_delivery(init_shell_config, bench):
+  delivery(bench, "file")
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/bin/bash"}], indirect=True)
+def test_shell_memfd_delivery(init_shell_config, bench):
+  delivery(bench, "memfd")
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/bin/bash"}], indirect=True)
+def test_shell_tmpfs_delivery(init_shell_config, bench):
+  delivery(bench, "tmpfs")
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/bin/bash"}], indirect=True)
+def test_shell_stdin_delivery(init_shell_config, bench):
+  delivery(bench, "stdin")
+
+def functions(directory):
+  # A directory of a few hundred small functions, as a stand-in for a real
+  #   set of Babashka functions.
+  directory.mkdir()
+  for i in range(50):
+    directory.joinpath(f"{i}.sh").write_text("".join(
+      f"f_{i}_{j}() {{ local value=$1; [ -n \"$value\" ] && echo {i} {j} \"$value\"; }}\n"
+      for j in range(50)
+    ))
+  directory.joinpath("main.sh").write_text("main() { echo \"$NAME\"; }\n")
+  return directory
+
+@pytest.mark.benchmark
+def test_babashka_cold_call(init_config, tmp_path, bench):
+  from os_heat_agent.runners import capture
+  directory = functions(tmp_path.joinpath("functions"))
+  command = f"for f in {directory}/*.sh; do source $f; done; main"
+  result = bench(capture.run, ["bash", "-c", command], {"NAME": "x"})
+  assert result.stdout == "x\n"
+
+@pytest.mark.benchmark
+def test_babashka_warm_call(init_config, tmp_path, bench):
+  from os_heat_agent.runners import worker
+  directory = functions(tmp_path.joinpath("functions"))
+  try:
+    result = bench(worker.run, directory, "main", {"NAME": "x"})
+  finally:
+    worker.pool.close()
+  assert result.stdout == "x\n"
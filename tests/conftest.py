@@ -33,6 +33,9 @@ def load_heat_stack_response(request):
 
 @pytest.fixture
 def init_config():
+  # Put the configuration back afterwards, so that tests which change it
+  #   don't leak into tests that use the defaults.
+  saved = { section: dict(config[section]) for section in config.sections() }
   config.clear()
   config.read_dict(
     {
@@ -48,7 +51,9 @@ def init_config():
         "region": ""
       },
   })
-  return config
+  yield config
+  config.clear()
+  config.read_dict(saved)
 
 @pytest.fixture
 def init_config_babashka(set_config):
@@ -73,3 +78,11 @@ def init_shell_config(request, init_config):
     "tools.shell.runners": request.param
   })
   return request.param
+
+@pytest.fixture
+def cfn_clients():
+  # Cached CloudFormation clients would otherwise leak between tests.
+  from os_heat_agent import heat
+  heat.clear_clients()
+  yield heat._clients
+  heat.clear_clients()
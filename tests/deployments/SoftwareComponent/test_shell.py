@@ -0,0 +1,105 @@
+import pytest
+from unittest import mock
+from os_heat_agent import deployments
+from os_heat_agent.runners import shell
+
+def make_component(action: str, configs: list, group: str = "component"):
+  return {
+    "id": "component-1",
+    "name": "component",
+    "group": group,
+    "config": {"configs": configs},
+    "inputs": [
+      {"name": "deploy_action", "value": action},
+      {"name": "envar_GREETING", "value": "hello"},
+    ],
+    "outputs": [{"name": "os_heat_agent_is_error", "error_output": True}],
+    "options": {},
+  }
+
+CONFIGS = [
+  {"actions": ["CREATE"], "config": "echo create", "tool": "Shell::Bash"},
+  {"actions": ["CREATE", "UPDATE"], "config": "echo $GREETING; echo oops >&2", "tool": "Shell::Bash"},
+  {"actions": ["DELETE"], "config": "echo delete", "tool": "Shell::Bash"},
+  # Heat's default actions are CREATE and UPDATE
+  {"config": "echo default", "tool": "Shell::Bash"},
+]
+
+@pytest.fixture
+def bash(init_shell_config):
+  shell.init()
+
+###
+###
+###
+
+def test_get_deployment():
+  d = deployments.get_deployment(make_component("CREATE", CONFIGS))
+  assert isinstance(d, deployments.SoftwareComponent)
+
+def test_selected_by_action():
+  d = deployments.get_deployment(make_component("update", CONFIGS))
+  assert d.selected() == [CONFIGS[1], CONFIGS[3]]
+
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/bin/bash"}], indirect=True)
+def test_runs_configs_for_action(bash):
+  d = deployments.get_deployment(make_component("CREATE", CONFIGS))
+  assert d.validate()
+  response = d.run()
+  assert response.exit_code == 0
+  assert response.stdout == "create\nhello\ndefault\n"
+  assert response.stderr == "oops\n"
+
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/bin/bash"}], indirect=True)
+def test_combined_output_keeps_each_config(bash):
+  response = deployments.get_deployment(make_component("CREATE", CONFIGS)).run()
+  assert len(response.parts) == 3
+  assert response.stdout_bytes == len(response.stdout) == sum(p.stdout_bytes for p in response.parts)
+  assert response.stderr_bytes == len("oops\n")
+  # There's no one digest of output from several commands
+  assert response.stdout_digest is None
+  assert all(p.stdout_digest.startswith("sha256:") for p in response.parts)
+
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/bin/bash"}], indirect=True)
+@pytest.mark.parametrize("action", ["SUSPEND", "CHECK"])
+def test_no_configs_for_action(bash, action):
+  d = deployments.get_deployment(make_component(action, CONFIGS))
+  with mock.patch.object(shell, "run") as run:
+    response = d.run()
+  assert run.call_count == 0
+  assert response.exit_code == 0
+  assert response.stdout == ""
+
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/bin/bash"}], indirect=True)
+def test_stops_at_first_failure(bash):
+  configs = [
+    {"actions": ["CREATE"], "config": "echo first", "tool": "Shell::Bash"},
+    {"actions": ["CREATE"], "config": "echo second; exit 3", "tool": "Shell::Bash"},
+    {"actions": ["CREATE"], "config": "echo third", "tool": "Shell::Bash"},
+  ]
+  response = deployments.get_deployment(make_component("CREATE", configs)).run()
+  assert response.exit_code == 3
+  assert response.stdout == "first\nsecond\n"
+
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/bin/bash"}], indirect=True)
+def test_tool_from_group(bash):
+  configs = [{"actions": ["CREATE"], "config": "echo grouped"}]
+  d = deployments.get_deployment(make_component("CREATE", configs, group="Web::Shell::Bash"))
+  assert d.run().stdout == "grouped\n"
+
+def test_no_tool():
+  configs = [{"actions": ["CREATE"], "config": "echo nothing"}]
+  d = deployments.get_deployment(make_component("CREATE", configs))
+  with pytest.raises(deployments.NoSuchRunner):
+    d.run()
+
+def test_validate_unknown_tool():
+  configs = [
+    {"actions": ["CREATE"], "config": "echo create", "tool": "Puppet"},
+    {"actions": ["DELETE"], "config": "echo delete", "tool": "Ansible"},
+  ]
+  with pytest.raises(deployments.NoSuchRunner):
+    deployments.get_deployment(make_component("CREATE", configs)).validate()
+  # Tools for other actions don't matter
+  configs[0]["tool"] = "Shell::Bash"
+  assert deployments.get_deployment(make_component("CREATE", configs)).validate()
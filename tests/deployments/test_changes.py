@@ -0,0 +1,69 @@
+import pytest
+import copy
+from os_heat_agent import changes
+
+@pytest.fixture
+def deployment_list():
+  return [
+    {
+      "id": "a",
+      "name": "10-first",
+      "config": "#!/bin/bash\nexit 0\n",
+      "inputs": [
+        {"name": "deploy_action", "value": "CREATE"},
+        {"name": "envar_foo", "value": "bar"}
+      ],
+      "options": {"os_heat_agent_serialize": True}
+    },
+    {
+      "id": "b",
+      "name": "20-second",
+      "config": {"command": "true"},
+      "inputs": [
+        {"name": "deploy_action", "value": "CREATE"}
+      ],
+      "options": {}
+    }
+  ]
+
+###
+###
+###
+
+def test_fingerprint_stable_across_key_order(deployment_list):
+  reordered = dict(reversed(list(deployment_list[0].items())))
+  assert changes.fingerprint(reordered) == changes.fingerprint(deployment_list[0])
+
+def test_first_run_selects_everything(deployment_list):
+  selected = changes.changed(deployment_list, {})
+  assert [d["id"] for d, reason in selected] == ["a", "b"]
+  assert all(reason == "new deployment" for d, reason in selected)
+
+def test_unchanged_selects_nothing(deployment_list):
+  known = changes.fingerprints(deployment_list)
+  assert changes.changed(copy.deepcopy(deployment_list), known) == []
+
+def test_only_modified_deployment_selected(deployment_list):
+  known = changes.fingerprints(deployment_list)
+  new = copy.deepcopy(deployment_list)
+  new[1]["config"]["command"] = "false"
+  selected = changes.changed(new, known)
+  assert len(selected) == 1
+  deployment, reason = selected[0]
+  assert deployment["id"] == "b"
+  assert reason == "changed config"
+
+def test_action_change_reported(deployment_list):
+  known = changes.fingerprints(deployment_list)
+  new = copy.deepcopy(deployment_list)
+  new[0]["inputs"][0]["value"] = "UPDATE"
+  deployment, reason = changes.changed(new, known)[0]
+  assert deployment["id"] == "a"
+  assert reason == "changed inputs, deploy_action"
+
+def test_new_deployment_appended(deployment_list):
+  known = changes.fingerprints(deployment_list)
+  new = copy.deepcopy(deployment_list)
+  new.append({"id": "c", "config": "", "inputs": [], "options": {}})
+  selected = changes.changed(new, known)
+  assert [(d["id"], reason) for d, reason in selected] == [("c", "new deployment")]
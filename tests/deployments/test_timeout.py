@@ -0,0 +1,46 @@
+import pytest
+from os_heat_agent import deployments
+from os_heat_agent.config import config
+
+def make_deployment(options=None):
+  return {
+    "id": "deployment-1",
+    "name": "timeout",
+    "group": "Web::Shell::Bash",
+    "config": "true",
+    "inputs": [],
+    "outputs": [],
+    "options": dict({"os_heat_agent_serialize": False}, **(options or {})),
+  }
+
+###
+###
+###
+
+def test_no_timeout_by_default():
+  # Deployments run for as long as they need unless a timeout is configured
+  assert config.getfloat("agent", "timeout") == 0
+
+def test_timeout_from_agent(init_config):
+  config.read_dict({"agent": {"timeout": "600"}})
+  assert deployments.get_deployment(make_deployment()).timeout == 600
+
+def test_timeout_from_tool_section(init_config):
+  config.read_dict({"agent": {"timeout": "600"}, "tools.shell": {"timeout": "30"}})
+  assert deployments.get_deployment(make_deployment()).timeout == 30
+
+def test_timeout_from_options(init_config):
+  config.read_dict({"agent": {"timeout": "600"}, "tools.shell": {"timeout": "30"}})
+  d = deployments.get_deployment(make_deployment({"os_heat_agent_timeout": "5"}))
+  assert d.timeout == 5
+
+@pytest.mark.parametrize("value", [0, "0", -1])
+def test_timeout_disabled(init_config, value):
+  config.read_dict({"agent": {"timeout": "600"}})
+  d = deployments.get_deployment(make_deployment({"os_heat_agent_timeout": value}))
+  assert d.timeout is None
+
+def test_timeout_invalid(init_config):
+  d = deployments.get_deployment(make_deployment({"os_heat_agent_timeout": "soon"}))
+  with pytest.raises(ValueError):
+    d.timeout
@@ -0,0 +1,66 @@
+"""Benchmark fetching metadata with and without the CloudFormation client cache.
+
+Runs `get_config` against the local stand-in Heat, so the numbers include
+  building the request and parsing the response, but not a real network.
+"""
+import pytest
+import json
+import resource
+import statistics
+import time
+import tracemalloc
+from os_heat_agent import heat
+from os_heat_agent.standin import StandIn
+
+POLLS = 10
+
+metadata = {
+  "os-collect-config": {"cfn": {}},
+  "deployments": []
+}
+
+@pytest.fixture
+def metadata_server(tmp_path):
+  path = tmp_path.joinpath("metadata.json")
+  path.write_text(json.dumps(metadata))
+  with StandIn(path) as standin:
+    yield standin.metadata_url
+
+def poll(cfn, cached):
+  timings = []
+  tracemalloc.start()
+  rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  for _ in range(POLLS):
+    if not cached:
+      # Equivalent to building a new session and client every poll.
+      heat.clear_clients()
+    start = time.perf_counter()
+    heat.get_config(cfn, "region")
+    timings.append(time.perf_counter() - start)
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return {
+    "mean_ms": statistics.mean(timings) * 1000,
+    "median_ms": statistics.median(timings) * 1000,
+    "peak_alloc_kb": peak / 1024,
+    "maxrss_growth_kb": rss_after - rss_before,
+  }
+
+@pytest.mark.benchmark
+def test_client_cache_benchmark(metadata_server, cfn_clients):
+  cfn = {
+    "stack_name": "bench",
+    "access_key_id": "access",
+    "secret_access_key": "secret",
+    "metadata_url": metadata_server,
+    "path": "server.Metadata"
+  }
+  # Warm up imports and the botocore loader caches so neither run pays them.
+  heat.get_config(cfn, "region")
+
+  uncached = poll(cfn, cached=False)
+  cached = poll(cfn, cached=True)
+
+  print(f"\nuncached: {uncached}\ncached:   {cached}")
+  assert cached["median_ms"] < uncached["median_ms"]
@@ -0,0 +1,113 @@
+import pytest
+import json
+import requests
+import requests_mock
+from os_heat_agent import sources
+from os_heat_agent.config import config
+from os_heat_agent.sources.http import HTTPSource
+
+URL = "http://metadata.test/server"
+
+metadata = {
+  "os-collect-config": {"request": {"metadata_url": URL}},
+  "deployments": [{"id": "a", "name": "a"}],
+}
+
+def conditional(etag="\"v1\"", last_modified="Sat, 17 Oct 2026 10:00:00 GMT"):
+  """Responds like a server that honours validators."""
+  def respond(request, context):
+    if request.headers.get("If-None-Match") == etag:
+      context.status_code = 304
+      return ""
+    context.status_code = 200
+    if etag:
+      context.headers["ETag"] = etag
+    if last_modified:
+      context.headers["Last-Modified"] = last_modified
+    return json.dumps(metadata)
+  return respond
+
+@pytest.fixture
+def validators(tmp_path):
+  return tmp_path.joinpath("validators.json")
+
+###
+###
+###
+
+def test_not_modified_is_not_parsed(validators):
+  source = HTTPSource(URL, validators)
+  with requests_mock.Mocker() as mock:
+    mock.get(URL, text=conditional())
+    assert source.fetch({}) == metadata
+    assert source.fetch({}) is None
+    assert mock.request_history[0].headers.get("If-None-Match") is None
+    assert mock.request_history[1].headers["If-None-Match"] == "\"v1\""
+    assert mock.request_history[1].headers["If-Modified-Since"] == "Sat, 17 Oct 2026 10:00:00 GMT"
+
+def test_validators_survive_restart(validators):
+  with requests_mock.Mocker() as mock:
+    mock.get(URL, text=conditional())
+    HTTPSource(URL, validators).fetch({})
+    assert json.loads(validators.read_text())["etag"] == "\"v1\""
+
+    restarted = HTTPSource(URL, validators)
+    # The first fetch after a restart still hands over the metadata, in
+    #   case the agent stopped before acting on it, but doesn't download it.
+    assert restarted.fetch({}) == metadata
+    assert mock.request_history[-1].headers["If-None-Match"] == "\"v1\""
+    assert restarted.fetch({}) is None
+
+def test_changed(validators):
+  source = HTTPSource(URL, validators)
+  with requests_mock.Mocker() as mock:
+    mock.get(URL, text=conditional("\"v1\""))
+    source.fetch({})
+    mock.get(URL, text=conditional("\"v2\""))
+    assert source.fetch({}) == metadata
+    assert source._cached["etag"] == "\"v2\""
+
+def test_without_validators(validators):
+  source = HTTPSource(URL, validators)
+  with requests_mock.Mocker() as mock:
+    mock.get(URL, json=metadata)
+    assert source.fetch({}) == metadata
+    assert source.fetch({}) == metadata
+    assert "If-None-Match" not in mock.request_history[1].headers
+  assert not validators.exists()
+
+def test_url_from_metadata():
+  source = HTTPSource()
+  with requests_mock.Mocker() as mock:
+    mock.get(URL, json=metadata)
+    assert source.fetch(metadata["os-collect-config"]) == metadata
+  with pytest.raises(sources.SourceError):
+    source.fetch({})
+
+@pytest.mark.parametrize("response", [
+  {"status_code": 500},
+  {"text": "not json"},
+  {"exc": requests.exceptions.ConnectTimeout},
+])
+def test_errors(validators, response):
+  source = HTTPSource(URL, validators)
+  with requests_mock.Mocker() as mock:
+    mock.get(URL, **response)
+    with pytest.raises(sources.SourceError):
+      source.fetch({})
+
+def test_session_is_reused():
+  source = HTTPSource(URL)
+  assert source.session() is source.session()
+  source.close()
+
+def test_from_config(init_config, tmp_path):
+  config.read_dict({
+    "agent": {"source": "http"},
+    "cache": {"dir": str(tmp_path)},
+    "source.http": {"url": URL, "validators": "validators.json", "timeout": "5"},
+  })
+  source = sources.get_source(config)
+  assert isinstance(source, HTTPSource)
+  assert source.validators_path == tmp_path.joinpath("validators.json")
+  assert source.timeout == 5
@@ -1,7 +1,9 @@
+import json
 import pytest
 import requests_mock
 from click.testing import CliRunner
-from os_heat_agent import main, deployments
+from os_heat_agent import main, deployments, scheduler, signals, sources
+from os_heat_agent.config import config
 
 @pytest.mark.parametrize("load_metadata",
   ["bad_meta_data.json"],
@@ -46,4 +48,64 @@ def test_main_tool_missing_init_file(config_file):
 ##
 
 # def test_deployment_tools():
-#   
\ No newline at end of file
+#   
+##
+##
+##
+
+class Stopped(Exception):
+  pass
+
+class UnchangedSource(sources.Source):
+  def __init__(self, error=None):
+    self.error = error
+  def fetch(self, current):
+    if self.error:
+      raise self.error
+    return None
+
+@pytest.fixture
+def one_poll(monkeypatch, tmp_path):
+  """Runs main() around its loop once with the given source, and returns
+  the metrics textfile."""
+  saved = {section: dict(config[section]) for section in config.sections()}
+  monkeypatch.setattr(deployments, "TOOLS", deployments.TOOLS)
+  def stop(self, wait=None):
+    raise Stopped()
+  monkeypatch.setattr(scheduler.Scheduler, "sleep", stop)
+  init_file = tmp_path.joinpath("cfn-init-data")
+  init_file.write_text(json.dumps({"os-collect-config": {"cfn": {}}, "deployments": []}))
+  textfile = tmp_path.joinpath("agent.prom")
+  config_file = tmp_path.joinpath("agent.ini")
+  config_file.write_text(f"""
+[cache]
+dir = {tmp_path}
+
+[metrics]
+textfile = {textfile}
+
+[tools.shell.runners]
+bash = /bin/bash
+""")
+
+  def poll(source):
+    monkeypatch.setattr(sources, "get_source", lambda config: source)
+    with pytest.raises(Stopped):
+      main.main(args=["-c", str(config_file), "-i", str(init_file), "-l", "ERROR"],
+        standalone_mode=False)
+    return textfile
+
+  yield poll
+  if signals.dispatcher is not None:
+    signals.dispatcher.stop()
+    signals.dispatcher = None
+  config.clear()
+  config.read_dict(saved)
+
+def test_unchanged_poll_exports_metrics(one_poll):
+  textfile = one_poll(UnchangedSource())
+  assert "os_heat_agent_last_successful_poll_timestamp_seconds" in textfile.read_text()
+
+def test_failed_poll_exports_metrics(one_poll):
+  textfile = one_poll(UnchangedSource(sources.SourceError("unavailable")))
+  assert textfile.exists()
@@ -2,7 +2,7 @@ import pytest
 from unittest import mock
 import requests_mock
 import boto3
-from os_heat_agent.heat import get_config
+from os_heat_agent.heat import get_config, get_client
 from os_heat_agent import dynamically_fetch_region
 import json
 
@@ -17,7 +17,7 @@ def MockCFNResponse(**kwargs):
   indirect=True
 )
 @mock.patch("boto3.session.Session")
-def test_good_response(mock_session_class, load_heat_stack_response):
+def test_good_response(mock_session_class, load_heat_stack_response, cfn_clients):
   mock_session_obj = mock.Mock()
   mock_client_obj = mock.Mock()
 
@@ -34,6 +34,55 @@ def test_good_response(mock_session_class, load_heat_stack_response):
   }
   get_config(cfg, "region")
 
+###
+###
+###
+
+cfn = {
+  "stack_name": "asdf",
+  "access_key_id": "asdf",
+  "secret_access_key": "asdf2",
+  "metadata_url": "http://192.168.1.1/",
+  "path": "foo.bar"
+}
+
+@pytest.mark.parametrize("load_heat_stack_response",
+  ["babashka/good_create_response.json"],
+  indirect=True
+)
+@mock.patch("boto3.session.Session")
+def test_client_reused_between_polls(mock_session_class, load_heat_stack_response, cfn_clients):
+  mock_session_class.return_value.client.return_value.describe_stack_resource.return_value = load_heat_stack_response
+  first = get_config(dict(cfn), "region")
+  second = get_config(dict(cfn), "region")
+  assert first == second
+  assert mock_session_class.call_count == 1
+  assert len(cfn_clients) == 1
+
+@mock.patch("boto3.session.Session")
+def test_client_rebuilt_on_new_secret(mock_session_class, cfn_clients):
+  get_client(dict(cfn), "region")
+  rotated = dict(cfn, secret_access_key="rotated")
+  get_client(rotated, "region")
+  assert mock_session_class.call_count == 2
+  assert len(cfn_clients) == 1
+  # The client kept is the one for the new secret
+  assert cfn_clients[(cfn["access_key_id"], cfn["metadata_url"], "region")][0] == "rotated"
+
+@mock.patch("boto3.session.Session")
+def test_client_rebuilt_on_new_access_key(mock_session_class, cfn_clients):
+  get_client(dict(cfn), "region")
+  get_client(dict(cfn, access_key_id="other"), "region")
+  assert mock_session_class.call_count == 2
+  # The client for the old credentials is dropped
+  assert list(cfn_clients.keys()) == [("other", cfn["metadata_url"], "region")]
+
+@mock.patch("boto3.session.Session")
+def test_client_per_region(mock_session_class, cfn_clients):
+  get_client(dict(cfn), "region-a")
+  get_client(dict(cfn), "region-b")
+  assert len(cfn_clients) == 2
+
 ##
 ## Test the dynamic region fetching code
 ## 
@@ -0,0 +1,270 @@
+import pytest
+import json
+import requests
+import requests_mock
+import time
+from os_heat_agent import signals
+from os_heat_agent.config import config
+from os_heat_agent.runners import Output
+
+url = "http://signal.test/deployment"
+
+@pytest.fixture
+def outbox(tmp_path):
+  return tmp_path.joinpath("outbox")
+
+@pytest.fixture
+def dispatcher(outbox):
+  d = signals.Dispatcher(outbox, timeout=1, retries=3, backoff=0, max_backoff=0)
+  yield d
+  d.stop(timeout=5)
+  signals.dispatcher = None
+
+###
+###
+###
+
+def test_send_retries_server_errors():
+  with requests_mock.Mocker() as mock:
+    mock.post(url, [{"status_code": 503}, {"status_code": 200}])
+    response = signals.send("POST", url, {"a": "b"}, backoff=0)
+    assert response.status_code == 200
+    assert mock.call_count == 2
+
+def test_send_does_not_retry_rejection():
+  with requests_mock.Mocker() as mock:
+    mock.post(url, status_code=404)
+    response = signals.send("POST", url, {}, backoff=0)
+    assert response.status_code == 404
+    assert mock.call_count == 1
+
+def test_send_raises_after_retries():
+  with requests_mock.Mocker() as mock:
+    mock.put(url, exc=requests.exceptions.ConnectTimeout)
+    with pytest.raises(requests.exceptions.ConnectTimeout):
+      signals.send("PUT", url, {}, retries=2, backoff=0)
+    assert mock.call_count == 2
+
+###
+###
+###
+
+def test_dispatcher_delivers(dispatcher, outbox):
+  with requests_mock.Mocker() as mock:
+    mock.post(url, status_code=200)
+    dispatcher.start()
+    dispatcher.submit("POST", url, {"deploy_status_code": "0"}, "deployment")
+    assert dispatcher.join(timeout=5)
+    assert mock.last_request.json() == {"deploy_status_code": "0"}
+  assert list(outbox.glob("*.json")) == []
+
+def test_dispatcher_retries(dispatcher, outbox):
+  with requests_mock.Mocker() as mock:
+    mock.post(url, [
+      {"exc": requests.exceptions.ConnectionError},
+      {"status_code": 502},
+      {"status_code": 200}
+    ])
+    dispatcher.start()
+    dispatcher.submit("POST", url, {})
+    assert dispatcher.join(timeout=5)
+    assert mock.call_count == 3
+  assert list(outbox.glob("*.json")) == []
+
+def test_dispatcher_keeps_undelivered(dispatcher, outbox):
+  with requests_mock.Mocker() as mock:
+    mock.post(url, status_code=503)
+    dispatcher.start()
+    dispatcher.submit("POST", url, {})
+    assert dispatcher.join(timeout=5)
+    assert mock.call_count == 3
+  # Still there for the next attempt
+  assert len(list(outbox.glob("*.json"))) == 1
+
+def test_dispatcher_reports_queued_first(dispatcher, outbox):
+  statuses = []
+  def listener(entry, status):
+    if status == signals.QUEUED:
+      # Plenty of time for the worker to deliver it, if it could
+      time.sleep(0.2)
+    statuses.append(status)
+  dispatcher.listeners.append(listener)
+  with requests_mock.Mocker() as mock:
+    mock.post(url, status_code=200)
+    dispatcher.start()
+    dispatcher.submit("POST", url, {}, "deployment")
+    assert dispatcher.join(timeout=5)
+  assert statuses == [signals.QUEUED, signals.DELIVERED]
+
+def test_dispatcher_resends_outbox_on_start(outbox):
+  # Signal queued, but the agent stopped before delivering it
+  first = signals.Dispatcher(outbox)
+  outbox.mkdir()
+  ident = first.submit("PUT", url, {"deploy_stdout": "done"}, "deployment")
+  with open(outbox.joinpath(f"{ident}.json")) as fh:
+    assert json.load(fh)["url"] == url
+
+  second = signals.Dispatcher(outbox, backoff=0)
+  with requests_mock.Mocker() as mock:
+    mock.put(url, status_code=200)
+    second.start()
+    assert second.join(timeout=5)
+    second.stop(timeout=5)
+    assert mock.last_request.json() == {"deploy_stdout": "done"}
+  assert list(outbox.glob("*.json")) == []
+
+def test_newer_signal_supersedes_retry(outbox):
+  d = signals.Dispatcher(outbox, timeout=1, retries=3, backoff=0.5, max_backoff=0.5)
+  with requests_mock.Mocker() as mock:
+    mock.post(url, [{"status_code": 503}, {"status_code": 200}])
+    d.start()
+    try:
+      d.submit("POST", url, {"deploy_status_code": "1"}, "deployment")
+      deadline = time.monotonic() + 5
+      while mock.call_count == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+      # The first is waiting to be retried when the next comes in
+      d.submit("POST", url, {"deploy_status_code": "0"}, "deployment")
+      assert d.join(timeout=5)
+    finally:
+      d.stop(timeout=5)
+    assert [r.json() for r in mock.request_history] == [
+      {"deploy_status_code": "1"}, {"deploy_status_code": "0"},
+    ]
+  assert list(outbox.glob("*.json")) == []
+
+def test_resend_only_sends_latest(outbox):
+  first = signals.Dispatcher(outbox)
+  outbox.mkdir()
+  first.submit("POST", url, {"deploy_status_code": "1"}, "deployment")
+  first.submit("POST", url, {"deploy_status_code": "0"}, "deployment")
+  first.submit("POST", url + "/other", {"deploy_status_code": "2"}, "other")
+
+  second = signals.Dispatcher(outbox, backoff=0)
+  with requests_mock.Mocker() as mock:
+    mock.post(requests_mock.ANY, status_code=200)
+    second.start()
+    assert second.join(timeout=5)
+    second.stop(timeout=5)
+    assert sorted(r.json()["deploy_status_code"] for r in mock.request_history) == ["0", "2"]
+  assert list(outbox.glob("*.json")) == []
+
+def test_deliver_uses_running_dispatcher(dispatcher, outbox):
+  signals.dispatcher = dispatcher
+  with requests_mock.Mocker() as mock:
+    mock.post(url, status_code=200)
+    dispatcher.start()
+    assert signals.deliver("POST", url, {}) is None
+    assert dispatcher.join(timeout=5)
+    assert mock.call_count == 1
+
+###
+###
+###
+
+@pytest.fixture
+def budget(init_config):
+  config.read_dict({"signal": {"max_bytes": 2000, "error_bytes": 100, "digest": "true"}})
+
+def output(stdout: str, stderr: str = "") -> Output:
+  return Output(
+    stdout=stdout, stderr=stderr, exit_code=1,
+    stdout_log="/logs/d.stdout.log", stderr_log="/logs/d.stderr.log",
+    stdout_bytes=len(stdout), stderr_bytes=len(stderr),
+    stdout_digest="sha256:out", stderr_digest="sha256:err",
+  )
+
+def test_elide_keeps_head_and_tail():
+  text = "a" * 500 + "b" * 500
+  elided = signals.elide(text, 200)
+  assert len(json.dumps(elided)) <= 200
+  assert elided.startswith("a" * 50)
+  assert elided.endswith("b" * 50)
+  assert "bytes elided" in elided
+  assert signals.elide("short", 200) == "short"
+
+def test_elide_counts_escapes_and_multibyte():
+  text = "\n\"✓" * 1000
+  elided = signals.elide(text, 300)
+  assert len(json.dumps(elided)) <= 300
+  # Never cut in the middle of a character
+  assert "\ufffd" not in elided
+
+@pytest.mark.parametrize("text", [
+  "é" * 200000,
+  "\x00\x01" * 50000,
+  "a\n" * 100000,
+])
+def test_elide_fills_the_budget(text):
+  # However much escaping the text needs, most of the room is used.
+  limit = signals.MAX_BYTES
+  elided = signals.elide(text, limit)
+  assert limit * 0.95 <= len(json.dumps(elided)) <= limit
+  assert text[:100] in elided
+  assert "bytes elided" in elided
+
+def test_elide_tail_only():
+  elided = signals.elide("a" * 500 + "the error", 100, head=False)
+  assert elided.endswith("the error")
+  assert not elided.startswith("a")
+
+def test_compact_small_signal_unchanged(budget):
+  signal = {"deploy_stdout": "out", "deploy_stderr": "err", "deploy_status_code": "1",
+    "os_heat_agent_is_error": "err"}
+  assert signals.compact(signal, output("out", "err")) == signal
+
+def test_compact_fits_budget(budget):
+  stdout, stderr = "o" * 100000, "e" * 300
+  signal = {"deploy_stdout": stdout, "deploy_stderr": stderr, "deploy_status_code": "1",
+    "os_heat_agent_is_error": stderr}
+  compacted = signals.compact(signal, output(stdout, stderr))
+  assert len(json.dumps(compacted)) <= 2000
+  # The small stream is sent whole, and only once
+  assert compacted["deploy_stderr"] == stderr
+  assert len(json.dumps(compacted["os_heat_agent_is_error"])) <= 100
+  assert compacted["os_heat_agent_stdout_log"] == {
+    "path": "/logs/d.stdout.log", "bytes": 100000, "digest": "sha256:out"}
+  assert "os_heat_agent_stderr_log" not in compacted
+  assert signal["deploy_stdout"] == stdout
+
+def test_compact_shares_budget(budget):
+  stdout, stderr = "o" * 100000, "e" * 100000
+  compacted = signals.compact(
+    {"deploy_stdout": stdout, "deploy_stderr": stderr, "deploy_status_code": "1"},
+    output(stdout, stderr),
+  )
+  assert len(json.dumps(compacted)) <= 2000
+  assert abs(len(compacted["deploy_stdout"]) - len(compacted["deploy_stderr"])) < 10
+
+def test_compact_describes_captured_truncation(budget):
+  result = output("head [... 10 bytes elided ...] tail")
+  result.stdout_bytes = 1000
+  compacted = signals.compact({"deploy_stdout": result.stdout, "deploy_stderr": ""}, result)
+  assert compacted["os_heat_agent_stdout_log"]["bytes"] == 1000
+
+def test_compact_describes_each_part(budget):
+  parts = [output("a" * 1500), output("b" * 1500)]
+  combined = Output(stdout="a" * 1500 + "b" * 1500, stderr="", exit_code=1,
+    stdout_bytes=3000, stderr_bytes=0, parts=parts)
+  compacted = signals.compact({"deploy_stdout": combined.stdout, "deploy_stderr": ""}, combined)
+  assert len(json.dumps(compacted)) <= 2000
+  assert compacted["os_heat_agent_stdout_log"] == {
+    "bytes": 3000,
+    "parts": [
+      {"path": "/logs/d.stdout.log", "bytes": 1500, "digest": "sha256:out"},
+      {"path": "/logs/d.stdout.log", "bytes": 1500, "digest": "sha256:out"},
+    ],
+  }
+
+def test_compact_without_digest(budget):
+  config["signal"]["digest"] = "false"
+  stdout = "o" * 100000
+  compacted = signals.compact({"deploy_stdout": stdout, "deploy_stderr": ""}, output(stdout))
+  assert "os_heat_agent_stdout_log" not in compacted
+  assert len(json.dumps(compacted)) <= 2000
+
+def test_compact_unlimited(budget):
+  config["signal"]["max_bytes"] = "0"
+  stdout = "o" * 100000
+  compacted = signals.compact({"deploy_stdout": stdout}, output(stdout))
+  assert compacted["deploy_stdout"] == stdout
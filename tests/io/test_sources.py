@@ -0,0 +1,168 @@
+import pytest
+import json
+import os
+import threading
+import time
+from botocore.exceptions import ClientError, EndpointConnectionError, ReadTimeoutError
+from os_heat_agent import heat, sources
+from os_heat_agent.config import config
+from os_heat_agent.errors import ConfigurationError
+from os_heat_agent.sources import local, configdrive, cfn
+
+current = {"cfn": {"stack_name": "current"}}
+
+def deployment(ident):
+  return {"id": ident, "name": ident}
+
+def write(path, data):
+  # Write alongside, then move into place, as the agent expects
+  tmp = path.with_name(f".{path.name}.tmp")
+  tmp.write_text(json.dumps(data))
+  os.replace(tmp, path)
+
+def later(delay, function, *args):
+  timer = threading.Timer(delay, function, args)
+  timer.start()
+  return timer
+
+###
+###
+###
+
+def test_get_source(init_config, tmp_path):
+  assert isinstance(sources.get_source(config), cfn.CFNSource)
+  config.read_dict({"agent": {"source": "file"}, "source.file": {"path": str(tmp_path)}})
+  source = sources.get_source(config)
+  assert isinstance(source, local.FileSource)
+  source.close()
+
+def test_get_source_unknown(init_config):
+  config.read_dict({"agent": {"source": "carrier-pigeon"}})
+  with pytest.raises(ConfigurationError):
+    sources.get_source(config)
+
+###
+###
+###
+
+def test_cfn(monkeypatch):
+  monkeypatch.setattr(heat, "get_config", lambda cfn, region: {"deployments": []})
+  assert cfn.CFNSource().fetch(current) == {"deployments": []}
+
+@pytest.mark.parametrize("error", [
+  ClientError({"Error": {"Code": "ServiceUnavailable", "Message": "busy"}}, "DescribeStackResource"),
+  EndpointConnectionError(endpoint_url="http://metadata.test/v1/"),
+  ReadTimeoutError(endpoint_url="http://metadata.test/v1/"),
+  json.decoder.JSONDecodeError("Expecting value", "", 0),
+])
+def test_cfn_errors(monkeypatch, error):
+  def fail(cfn, region):
+    raise error
+  monkeypatch.setattr(heat, "get_config", fail)
+  with pytest.raises(sources.SourceError):
+    cfn.CFNSource().fetch(current)
+
+###
+###
+###
+
+def test_file(tmp_path):
+  path = tmp_path.joinpath("metadata.json")
+  write(path, {"os-collect-config": {"cfn": {}}, "deployments": [deployment("a")]})
+  source = local.FileSource(path)
+  assert source.fetch(current) == {
+    "os-collect-config": {"cfn": {}},
+    "deployments": [deployment("a")],
+  }
+  source.close()
+
+def test_file_missing(tmp_path):
+  source = local.FileSource(tmp_path.joinpath("metadata.json"))
+  with pytest.raises(sources.SourceError):
+    source.fetch(current)
+  source.close()
+
+def test_directory(tmp_path):
+  write(tmp_path.joinpath("20-second.json"), {"deployments": [deployment("b")]})
+  write(tmp_path.joinpath("10-first.json"), [deployment("a")])
+  tmp_path.joinpath("notes.txt").write_text("ignored")
+  source = local.FileSource(tmp_path)
+  metadata = source.fetch(current)
+  # Keeps the os-collect-config it was given
+  assert metadata["os-collect-config"] == current
+  assert [d["id"] for d in metadata["deployments"]] == ["a", "b"]
+  source.close()
+
+def test_directory_invalid_file(tmp_path):
+  write(tmp_path.joinpath("10-first.json"), [deployment("a")])
+  tmp_path.joinpath("20-broken.json").write_text('{"deployments": [')
+  source = local.FileSource(tmp_path)
+  with pytest.raises(sources.SourceError):
+    source.fetch(current)
+  source.close()
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_wait_for_change(tmp_path, use_inotify):
+  path = tmp_path.joinpath("metadata.json")
+  write(path, {"deployments": []})
+  source = local.FileSource(path, poll_interval=0.05, use_inotify=use_inotify)
+  assert (source._inotify is not None) == use_inotify
+  assert source.wait(0.2) is False
+
+  timer = later(0.1, write, path, {"deployments": [deployment("a")]})
+  started = time.monotonic()
+  assert source.wait(10) is True
+  # Well before the timeout
+  assert time.monotonic() - started < 5
+  timer.join()
+  assert source.fetch(current)["deployments"] == [deployment("a")]
+  source.close()
+
+def test_wait_ignores_other_files(tmp_path):
+  path = tmp_path.joinpath("metadata.json")
+  write(path, {"deployments": []})
+  source = local.FileSource(path)
+  timer = later(0.05, tmp_path.joinpath("other").write_text, "x")
+  assert source.wait(0.3) is False
+  timer.join()
+  source.close()
+
+###
+###
+###
+
+@pytest.fixture
+def config_drive(tmp_path):
+  root = tmp_path.joinpath("config")
+  root.joinpath("openstack/latest").mkdir(parents=True)
+  root.joinpath("openstack/content").mkdir()
+  root.joinpath("openstack/latest/meta_data.json").write_text(json.dumps({
+    "uuid": "server",
+    "files": [
+      {"path": "/etc/motd", "content_path": "/content/0000"},
+      {"path": "/var/lib/os-heat-agent/metadata.json", "content_path": "/content/0001"},
+    ],
+  }))
+  root.joinpath("openstack/content/0000").write_text("hello")
+  root.joinpath("openstack/content/0001").write_text(json.dumps({
+    "deployments": [deployment("a")],
+  }))
+  return root
+
+def test_config_drive(config_drive):
+  source = configdrive.ConfigDriveSource(config_drive, "/var/lib/os-heat-agent/metadata.json")
+  assert source.fetch(current) == {
+    "os-collect-config": current,
+    "deployments": [deployment("a")],
+  }
+
+def test_config_drive_file_missing(config_drive):
+  source = configdrive.ConfigDriveSource(config_drive, "/var/lib/other.json")
+  with pytest.raises(sources.SourceError):
+    source.fetch(current)
+
+def test_config_drive_not_found(tmp_path):
+  source = configdrive.ConfigDriveSource(tmp_path, "/var/lib/os-heat-agent/metadata.json",
+    label="no-such-label")
+  with pytest.raises(sources.SourceError):
+    source.fetch(current)
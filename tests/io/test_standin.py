@@ -0,0 +1,125 @@
+import pytest
+import json
+import time
+import requests
+import botocore.exceptions
+from click.testing import CliRunner
+from os_heat_agent import heat, signals, deployments, main
+from os_heat_agent.standin import StandIn, Faults
+
+@pytest.fixture
+def metadata_file(tmp_path):
+  path = tmp_path.joinpath("metadata.json")
+  path.write_text(json.dumps({
+    "os-collect-config": {"cfn": {}},
+    "deployments": [{"id": "deployment-1", "name": "first"}],
+  }))
+  return path
+
+@pytest.fixture
+def no_dispatcher():
+  # Signal synchronously, so the signal has arrived when we look for it
+  saved, signals.dispatcher = signals.dispatcher, None
+  yield
+  signals.dispatcher = saved
+
+def cfn(standin, stack_name="stack"):
+  return {
+    "stack_name": stack_name,
+    "access_key_id": "access",
+    "secret_access_key": "secret",
+    "metadata_url": standin.metadata_url,
+    "path": "server.Metadata",
+  }
+
+def make_deployment(url, verb):
+  return {
+    "id": "deployment-1",
+    "name": "first",
+    "group": "Web::Shell::Bash",
+    "config": "true",
+    "inputs": [
+      {"name": "deploy_signal_id", "value": url},
+      {"name": "deploy_signal_verb", "value": verb},
+    ],
+    "outputs": [],
+    "options": {"os_heat_agent_serialize": False},
+  }
+
+###
+###
+###
+
+def test_get_config(metadata_file, cfn_clients):
+  with StandIn(metadata_file) as standin:
+    metadata = heat.get_config(cfn(standin), "region")
+    assert metadata["deployments"][0]["name"] == "first"
+    # Edits are picked up on the next poll
+    metadata_file.write_text(json.dumps({"os-collect-config": {}, "deployments": []}))
+    assert heat.get_config(cfn(standin), "region")["deployments"] == []
+
+def test_get_config_per_stack(tmp_path, cfn_clients):
+  tmp_path.joinpath("web.json").write_text(json.dumps({"deployments": ["web"]}))
+  with StandIn(tmp_path) as standin:
+    assert heat.get_config(cfn(standin, "web"), "region") == {"deployments": ["web"]}
+    with pytest.raises(botocore.exceptions.ClientError) as e:
+      heat.get_config(cfn(standin, "db"), "region")
+    assert e.value.response["Error"]["Code"] == "ValidationError"
+
+@pytest.mark.parametrize("verb", ["POST", "PUT"])
+def test_signals_are_recorded(metadata_file, no_dispatcher, tmp_path, verb):
+  log = tmp_path.joinpath("signals.jsonl")
+  with StandIn(metadata_file, signal_log=log) as standin:
+    url = f"{standin.url}/v1/signal/arn%3Aopenstack%3Aheat?Signature=abc"
+    d = deployments.get_deployment(make_deployment(url, verb))
+    response = d.signal({"deploy_status_code": "0"})
+    assert response.status_code == 200
+
+    assert len(standin.signals) == 1
+    signal = standin.signals[0]
+    assert signal["verb"] == verb
+    assert signal["path"] == "/v1/signal/arn%3Aopenstack%3Aheat?Signature=abc"
+    assert signal["payload"] == {"deploy_status_code": "0"}
+    assert json.loads(log.read_text()) == signal
+
+    recorded = requests.get(f"{standin.url}/_signals").json()
+    assert recorded == [signal]
+    requests.delete(f"{standin.url}/_signals")
+    assert standin.signals == []
+
+###
+###
+###
+
+def test_error_rate(metadata_file):
+  faults = Faults(error_rate=0.5, seed=1)
+  with StandIn(metadata_file, faults=faults) as standin:
+    statuses = [requests.put(f"{standin.url}/signal", json={}).status_code for _ in range(40)]
+  assert set(statuses) == {200, 503}
+  # Only the ones that got through are recorded
+  assert len(standin.signals) == statuses.count(200)
+
+def test_error_status(metadata_file, cfn_clients):
+  faults = Faults(error_rate=1, error_status=400)
+  with StandIn(metadata_file, faults=faults) as standin:
+    with pytest.raises(botocore.exceptions.ClientError):
+      heat.get_config(cfn(standin), "region")
+
+def test_latency_and_slow_body(metadata_file):
+  with StandIn(metadata_file, faults=Faults(latency=0.2, slow_body=0.2)) as standin:
+    started = time.monotonic()
+    response = requests.post(f"{standin.metadata_url}?Action=DescribeStackResource&StackName=stack")
+    elapsed = time.monotonic() - started
+  assert response.status_code == 200
+  assert "<Metadata>" in response.text
+  assert elapsed >= 0.4
+
+def test_unsupported_action(metadata_file):
+  with StandIn(metadata_file) as standin:
+    response = requests.post(f"{standin.metadata_url}?Action=DeleteStack")
+  assert response.status_code == 400
+  assert "InvalidAction" in response.text
+
+def test_standin_command_requires_metadata(init_config):
+  result = CliRunner().invoke(main, ["standin"])
+  assert result.exit_code == 2
@@ -38,22 +38,46 @@ foo=("bar" "baz" "bar baz")
   }
   assert "\n".join(babashka.bashify(data)) == output
   
-def test_bashify_dict_exception():
+def test_bashify_nested_dict():
+  output = """declare -A a
+a["b"]="a__b"
+declare -A a__b
+a__b["c"]="d"
+"""
+  output = output.strip()
   data = {
     "a": {
       "b": {
-        
+        "c": "d"
       }
     }
   }
-  with pytest.raises(babashka.SerializerError):
-    babashka.bashify(data)
+  assert "\n".join(babashka.bashify(data)) == output
+
+def test_bashify_nested_list():
+  output = """declare -A a
+a["b c"]="a__b_c"
+a__b_c=("x" "a__b_c__1")
+a__b_c__1=("y" "z")
+"""
+  output = output.strip()
+  data = {
+    "a": {
+      "b c": ["x", ["y", "z"]]
+    }
+  }
+  assert "\n".join(babashka.bashify(data)) == output
 
-def test_bashify_list_exception():
+def test_bashify_name_collision_exception():
   data = {
     "a": {
-      "b": []
+      "b-c": [],
+      "b_c": []
     }
   }
   with pytest.raises(babashka.SerializerError):
-    babashka.bashify(data)
\ No newline at end of file
+    babashka.bashify(data)
+
+def test_bashify_bad_name_exception():
+  with pytest.raises(babashka.SerializerError):
+    babashka.bashify({"not a name": "value"})
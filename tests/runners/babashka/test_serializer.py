@@ -0,0 +1,67 @@
+"""Round-trip tests for the Bash serializer.
+
+Each test sources the serialized output in a real Bash, and has Bash print
+  the values back out.
+"""
+import pytest
+import subprocess
+from os_heat_agent.runners import serializer
+
+tricky = [
+  "plain",
+  "with spaces",
+  'double "quotes"',
+  "single 'quotes'",
+  "back\\slash\\",
+  "$HOME and ${PATH}",
+  "`id` and $(id)",
+  "history !! expansion",
+  "glob * ? [a-z]",
+  "line\nbreak",
+  "tab\there",
+  "semi; colon && pipe |",
+  "unicode ✓ ünïcødé",
+  "trailing backslash \\",
+]
+
+def source(lines: list, script: str) -> str:
+  program = "\n".join(lines) + "\n" + script
+  return subprocess.run(
+    ["bash", "-c", program],
+    capture_output=True, check=True
+  ).stdout.decode("utf-8")
+
+###
+###
+###
+
+@pytest.mark.parametrize("value", tricky)
+def test_round_trip_string(value):
+  lines = serializer.bashify({"value": value})
+  assert source(lines, 'printf %s "$value"') == value
+
+def test_round_trip_list():
+  lines = serializer.bashify({"values": tricky})
+  out = source(lines, 'printf "%s\\0" "${values[@]}"')
+  assert out.split("\0")[:-1] == tricky
+
+def test_round_trip_dict():
+  data = { value: value for value in tricky }
+  lines = serializer.bashify({"values": data})
+  out = source(lines, 'for k in "${!values[@]}"; do printf "%s\\0%s\\0" "$k" "${values[$k]}"; done')
+  items = out.split("\0")[:-1]
+  assert dict(zip(items[::2], items[1::2])) == data
+
+def test_round_trip_nested():
+  data = {"servers": {"web": ["a b", {"port": "80"}]}}
+  lines = serializer.bashify(data)
+  script = """
+declare -n web="${servers[web]}"
+declare -n second="${web[1]}"
+printf "%s\\0%s" "${web[0]}" "${second[port]}"
+"""
+  assert source(lines, script).split("\0") == ["a b", "80"]
+
+def test_whitespace_stripped():
+  # Matches the behaviour of the previous serializer.
+  assert serializer.bashify({"a": "  padded \n"}) == ['a="padded"']
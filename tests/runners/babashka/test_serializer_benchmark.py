@@ -0,0 +1,58 @@
+"""Benchmark the in-process Bash serializer against the subprocess version it
+replaced.
+"""
+import pytest
+import shlex
+import subprocess
+import time
+from os_heat_agent.runners import serializer
+
+def legacy_bashify(config: dict) -> list:
+  # The previous implementation, which ran `printf` in Bash for every value.
+  bash_vars = []
+  for key, value in config.items():
+    if isinstance(value, dict):
+      bash_vars.append(f'declare -A {key}')
+      for k, v in value.items():
+        escaped_key = subprocess.check_output(['bash', '-c', f'printf %s {shlex.quote(k)}']).decode('utf-8').strip()
+        escaped_value = subprocess.check_output(['bash', '-c', f'printf %s {shlex.quote(v)}']).decode('utf-8').strip()
+        bash_vars.append(f'{key}["{escaped_key}"]="{escaped_value}"')
+    elif isinstance(value, list):
+        escaped_values = []
+        for v in value:
+          escaped = subprocess.check_output(['bash', '-c', f'printf %s {shlex.quote(v)}']).decode('utf-8').strip()
+          escaped_values.append(f'"{escaped}"')
+        bash_vars.append(f'{key}=({" ".join(escaped_values)})')
+    elif isinstance(value, str):
+        escaped_value = subprocess.check_output(['bash', '-c', f'printf %s {shlex.quote(value)}']).decode('utf-8').strip()
+        bash_vars.append(f'{key}="{escaped_value}"')
+    else:
+        bash_vars.append(f'{key}={value}')
+  return bash_vars
+
+def payload(entries: int) -> dict:
+  data = {}
+  for i in range(entries // 4):
+    data[f"string_{i}"] = f"value {i}"
+    data[f"number_{i}"] = i
+    data[f"list_{i}"] = [f"a{i}", f"b {i}"]
+  data["table"] = { f"key {i}": f"value {i}" for i in range(entries // 4) }
+  return data
+
+def timed(function, data, repeat: int = 1) -> float:
+  start = time.perf_counter()
+  for _ in range(repeat):
+    result = function(data)
+  return (time.perf_counter() - start) / repeat, result
+
+@pytest.mark.benchmark
+def test_serializer_benchmark():
+  data = payload(200)
+  legacy_time, legacy = timed(legacy_bashify, data)
+  current_time, current = timed(serializer.bashify, data, repeat=100)
+
+  print(f"\nlegacy: {legacy_time * 1000:.1f}ms  in-process: {current_time * 1000:.3f}ms  "
+        f"({legacy_time / current_time:.0f}x)")
+  # Values without characters that need escaping serialize identically
+  assert current == legacy
+  assert current_time < legacy_time
@@ -0,0 +1,157 @@
+import hashlib
+import os
+import pytest
+import signal
+import sys
+import time
+from pathlib import Path
+from os_heat_agent.config import config
+from os_heat_agent.runners import capture
+
+@pytest.fixture
+def capture_config(init_config, tmp_path):
+  config.read_dict({
+    "cache": {"dir": str(tmp_path)},
+    "capture": {
+      "head_bytes": 100,
+      "tail_bytes": 50,
+      "spool": "true",
+      "directory": "logs"
+    }
+  })
+  return tmp_path
+
+###
+###
+###
+
+def test_buffer_keeps_everything_under_limit():
+  buffer = capture.Buffer(10, 10)
+  buffer.write(b"hello ")
+  buffer.write(b"world")
+  assert buffer.elided == 0
+  assert buffer.text() == "hello world"
+
+def test_buffer_keeps_head_and_tail():
+  buffer = capture.Buffer(4, 3)
+  for chunk in [b"abc", b"defgh", b"ijk", b"lmnop"]:
+    buffer.write(chunk)
+  assert buffer.total == 16
+  assert buffer.elided == 9
+  assert buffer.text() == "abcd" + capture.ELIDED_MARKER.format(9) + "nop"
+
+def test_buffer_translates_newlines():
+  buffer = capture.Buffer()
+  buffer.write(b"a\r\nb\rc\n")
+  assert buffer.text() == "a\nb\nc\n"
+
+###
+###
+###
+
+def test_run_small_output(capture_config):
+  response = capture.run(
+    [sys.executable, "-c", "import sys; print('out'); print('err', file=sys.stderr); sys.exit(3)"]
+  )
+  assert response.stdout == "out\n"
+  assert response.stderr == "err\n"
+  assert response.exit_code == 3
+  # Not spooled without a name
+  assert response.stdout_log is None
+
+def test_run_large_output_is_bounded_and_spooled(capture_config):
+  script = "import sys; sys.stdout.write('x' * 1000000 + 'END'); sys.stderr.write('e' * 10)"
+  response = capture.run([sys.executable, "-c", script], name="deployment-id")
+
+  assert response.stdout.startswith("x" * 100)
+  assert response.stdout.endswith("x" * 47 + "END")
+  assert capture.ELIDED_MARKER.format(1000003 - 150) in response.stdout
+  assert response.stderr == "e" * 10
+
+  spooled = Path(response.stdout_log)
+  assert spooled == capture_config.joinpath("logs", "deployment-id.stdout.log")
+  assert spooled.stat().st_size == 1000003
+  assert Path(response.stderr_log).read_text() == "e" * 10
+  # Describes the complete output, not just what was kept
+  assert response.stdout_bytes == 1000003
+  assert response.stdout_digest == "sha256:" + hashlib.sha256(spooled.read_bytes()).hexdigest()
+
+def test_spool_is_private(capture_config):
+  old = os.umask(0o022)
+  try:
+    path = capture_config.joinpath("logs", "private.stdout.log")
+    path.parent.mkdir()
+    # Left readable by an earlier run
+    path.write_bytes(b"")
+    path.chmod(0o644)
+    response = capture.run([sys.executable, "-c", "print('secret')"], name="private")
+  finally:
+    os.umask(old)
+  assert response.stdout_log == str(path)
+  assert path.stat().st_mode & 0o777 == 0o600
+  assert path.read_text() == "secret\n"
+
+def test_run_spool_disabled(capture_config):
+  config["capture"]["spool"] = "false"
+  response = capture.run([sys.executable, "-c", "print('hi')"], name="deployment-id")
+  assert response.stdout_log is None
+  assert not capture_config.joinpath("logs").exists()
+
+###
+###
+###
+
+def test_run_within_timeout(capture_config):
+  response = capture.run([sys.executable, "-c", "print('done')"], timeout=10)
+  assert response.exit_code == 0
+  assert not response.timed_out
+
+def test_run_timeout_kills_process_group(capture_config, tmp_path):
+  # The child starts a grandchild which would outlive it, and then hangs.
+  pidfile = tmp_path.joinpath("grandchild.pid")
+  script = f"""
+sleep 60 &
+echo $! > {pidfile}
+echo started
+sleep 60
+"""
+  response = capture.run(["/bin/bash", "-c", script], timeout=0.5)
+  assert response.timed_out
+  assert response.exit_code == -signal.SIGTERM
+  assert response.stdout == "started\n"
+  grandchild = Path(f"/proc/{int(pidfile.read_text())}/stat")
+  # Gone, or a zombie waiting to be reaped by init
+  assert not grandchild.exists() or grandchild.read_text().split(") ")[1][0] == "Z"
+
+def test_run_timeout_escalates_to_sigkill(capture_config):
+  config.read_dict({"agent": {"kill_grace": "0.2"}})
+  script = "trap '' TERM; echo ignoring; sleep 60"
+  started = time.monotonic()
+  response = capture.run(["/bin/bash", "-c", script], timeout=0.5)
+  assert time.monotonic() - started < 5
+  assert response.timed_out
+  assert response.exit_code == -signal.SIGKILL
+
+def test_run_timeout_covers_background_children(capture_config):
+  # The command exits straight away, but leaves its pipes with a child.
+  started = time.monotonic()
+  response = capture.run(["/bin/bash", "-c", "sleep 30 & echo hi"], timeout=1)
+  assert time.monotonic() - started < 5
+  assert response.timed_out
+  assert response.stdout == "hi\n"
+
+def test_run_leftover_children_without_timeout_fail(capture_config):
+  config.read_dict({"agent": {"kill_grace": "0.5"}})
+  started = time.monotonic()
+  response = capture.run(["/bin/bash", "-c", "sleep 30 & echo hi"])
+  assert time.monotonic() - started < 5
+  assert not response.timed_out
+  assert response.exit_code != 0
+  assert response.stdout == "hi\n"
+  assert "still holding the output" in response.stderr
+
+def test_run_waits_for_quick_background_children(capture_config):
+  response = capture.run(["/bin/bash", "-c", "(sleep 0.2; echo late) & echo early"], timeout=10)
+  assert response.exit_code == 0
+  assert not response.timed_out
+  assert response.stdout == "early\nlate\n"
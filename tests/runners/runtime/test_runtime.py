@@ -0,0 +1,126 @@
+import os
+import pytest
+from pathlib import Path
+from os_heat_agent.runners import runtime, shell
+
+class FakeClock:
+  def __init__(self):
+    self.now = 0.0
+  def __call__(self):
+    return self.now
+
+class Validator:
+  """Counts validations, and fails once told to."""
+  def __init__(self):
+    self.calls = 0
+    self.fail = False
+  def __call__(self, path: Path) -> Path:
+    self.calls += 1
+    if self.fail or not path.exists():
+      raise FileNotFoundError(f"{path} is no good")
+    return path.resolve()
+
+@pytest.fixture
+def clock():
+  return FakeClock()
+
+@pytest.fixture
+def registry(clock):
+  return runtime.Registry(ttl=60, clock=clock)
+
+@pytest.fixture
+def executable(tmp_path):
+  path = tmp_path.joinpath("tool")
+  path.write_text("#!/bin/sh\n")
+  path.chmod(0o755)
+  return path
+
+###
+
+def test_validates_once(registry, executable):
+  validate = Validator()
+  assert registry.check(executable, validate) == executable.resolve()
+  assert registry.check(executable, validate) == executable.resolve()
+  assert registry.check(str(executable), validate) == executable.resolve()
+  assert validate.calls == 1
+
+def test_revalidates_after_ttl(registry, clock, executable):
+  validate = Validator()
+  registry.check(executable, validate)
+  clock.now = 59
+  registry.check(executable, validate)
+  assert validate.calls == 1
+  clock.now = 61
+  registry.check(executable, validate)
+  assert validate.calls == 2
+
+def test_revalidates_when_modified(registry, executable):
+  validate = Validator()
+  registry.check(executable, validate)
+  stat = executable.stat()
+  os.utime(executable, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+  registry.check(executable, validate)
+  assert validate.calls == 2
+
+def test_revalidates_when_replaced(registry, executable):
+  validate = Validator()
+  registry.check(executable, validate)
+  replacement = executable.with_name("tool.new")
+  replacement.write_text("#!/bin/sh\n")
+  os.utime(replacement, ns=(executable.stat().st_atime_ns, executable.stat().st_mtime_ns))
+  replacement.rename(executable)
+  registry.check(executable, validate)
+  assert validate.calls == 2
+
+def test_removed_path_fails(registry, executable):
+  validate = Validator()
+  registry.check(executable, validate)
+  executable.unlink()
+  with pytest.raises(FileNotFoundError):
+    registry.check(executable, validate)
+  # Failures aren't kept
+  with pytest.raises(FileNotFoundError):
+    registry.check(executable, validate)
+  assert validate.calls == 3
+
+def test_validators_are_separate(registry, executable):
+  first = Validator()
+  second = Validator()
+  registry.check(executable, first)
+  second.fail = True
+  with pytest.raises(FileNotFoundError):
+    registry.check(executable, second)
+  assert registry.check(executable, first) == executable.resolve()
+
+def test_invalidate(registry, executable):
+  validate = Validator()
+  registry.check(executable, validate)
+  registry.invalidate(executable)
+  registry.check(executable, validate)
+  registry.invalidate()
+  registry.check(executable, validate)
+  assert validate.calls == 3
+
+def test_validated(registry, clock, executable):
+  registry.check(executable, Validator())
+  assert registry.validated() == {str(executable): executable.resolve()}
+  clock.now = 61
+  assert registry.validated() == {}
+
+def test_configure(init_config):
+  init_config.read_dict({"agent": {"runtime_ttl": 5}})
+  registry = runtime.configure(init_config["agent"])
+  assert runtime.registry is registry
+  assert registry.ttl == 5
+
+###
+
+def test_shell_revalidates_removed_runner(init_config, monkeypatch, executable):
+  monkeypatch.setattr(runtime, "registry", runtime.Registry())
+  init_config.read_dict({"tools.shell.runners": {"bash": str(executable)}})
+  shell.init()
+  data = shell.normalize({"group": ["bash"], "command": "true"})
+  assert data["runner"] == executable.resolve()
+  executable.unlink()
+  with pytest.raises(shell.MissingRunner):
+    shell.normalize({"group": ["bash"], "command": "true"})
@@ -0,0 +1,75 @@
+"""Regression tests for building the shell runner's command line in-process.
+
+The command used to be passed through `bash -c 'printf %s ...'`; these check
+  that the argument handed to the runner is unchanged.
+"""
+import pytest
+import shlex
+import subprocess
+from unittest import mock
+from os_heat_agent.runners import shell
+
+commands = [
+  "ls -al /etc",
+  "echo 'single quoted'",
+  'echo "double quoted $HOME"',
+  "echo \\$escaped \\\\ backslash",
+  "echo `backticks` $(subshell)",
+  "printf '%s\\n' a b c",
+  "echo %s %d %%",
+  "-leading-dash",
+  "  surrounding whitespace  ",
+  "multi\nline\nscript\n",
+  "tab\tseparated",
+  "echo ünïcødé ✓",
+  "echo !! !$",
+  "glob * ? [a-z] {a,b}",
+  "a; b && c || d | e > f < g",
+]
+
+def printf_command(command: str) -> str:
+  # What the previous implementation produced.
+  return subprocess.check_output(
+    ["bash", "-c", f"printf %s {shlex.quote(command)}"]
+  ).decode("utf-8")
+
+###
+###
+###
+
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/usr/bin/bash"}], indirect=True)
+@pytest.mark.parametrize("command", commands)
+def test_command_matches_printf(init_shell_config, command):
+  data = {
+    "group": ["bash"],
+    "command": command,
+  }
+  shell.init()
+  shell.normalize(data)
+  cmd = shell.command(data)
+  assert cmd[1] == "-c"
+  assert cmd[2] == printf_command(command)
+
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/usr/bin/bash"}], indirect=True)
+def test_command_does_not_spawn(init_shell_config):
+  data = {
+    "group": ["bash"],
+    "command": "echo hello",
+  }
+  shell.init()
+  shell.normalize(data)
+  with mock.patch("subprocess.Popen") as popen:
+    shell.command(data)
+  assert popen.call_count == 0
+
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/usr/bin/bash"}], indirect=True)
+def test_run_spawns_once(init_shell_config):
+  data = {
+    "group": ["bash"],
+    "command": "echo 'hello world'",
+  }
+  shell.init()
+  with mock.patch("subprocess.Popen", wraps=subprocess.Popen) as popen:
+    response = shell.run(data)
+  assert popen.call_count == 1
+  assert response.stdout == "hello world\n"
@@ -0,0 +1,38 @@
+"""Benchmark building the shell runner's command line."""
+import pytest
+import shlex
+import subprocess
+import time
+from os_heat_agent.runners import shell
+
+def legacy_command(data: dict) -> list:
+  # The previous implementation, which ran `printf` in Bash to build the
+  #   argument.
+  return [
+    str(data["runner"].resolve()),
+    shell.known_modifiers[data["group"][0]],
+    subprocess.check_output(['bash', '-c', f'printf %s {shlex.quote(data["command"])}']).decode('utf-8'),
+  ]
+
+def timed(function, data, repeat: int) -> tuple:
+  # Returns the mean seconds per call, and the last call's result.
+  start = time.perf_counter()
+  for _ in range(repeat):
+    result = function(data)
+  return (time.perf_counter() - start) / repeat, result
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("init_shell_config", [{"bash": "/usr/bin/bash"}], indirect=True)
+def test_command_benchmark(init_shell_config):
+  data = {
+    "group": ["bash"],
+    "command": "echo \"$HOME\" 'quoted' `id` && ls -al /etc | wc -l",
+  }
+  shell.init()
+  shell.normalize(data)
+  legacy_time, legacy = timed(legacy_command, data, repeat=20)
+  current_time, current = timed(shell.command, data, repeat=1000)
+
+  print(f"\nlegacy: {legacy_time * 1000:.2f}ms  in-process: {current_time * 1000:.4f}ms")
+  assert current == legacy
+  assert current_time < legacy_time
@@ -0,0 +1,114 @@
+import os
+import pytest
+from pathlib import Path
+from os_heat_agent.config import config
+from os_heat_agent.runners import shell, runtime, RunnerError
+
+SCRIPT = """
+echo "delivered as $0"
+read -r line && echo "stdin: $line"
+exit 4
+"""
+
+@pytest.fixture
+def bash(init_config, monkeypatch):
+  monkeypatch.setattr(runtime, "registry", runtime.Registry())
+  config.read_dict({"tools.shell.runners": {"bash": "/usr/bin/bash"}})
+  shell.init()
+
+def script(command: str = SCRIPT, serialize: bool = True) -> dict:
+  return {"group": ["bash"], "command": command, "serialize": serialize}
+
+def delivered(data: dict):
+  shell.normalize(data)
+  shell.pre(data, {})
+  try:
+    return data.get("filehandle"), shell.run(data)
+  finally:
+    shell.post(data)
+
+###
+
+@pytest.mark.skipif(not hasattr(os, "memfd_create"), reason="needs memfd_create")
+def test_auto_uses_memfd(bash):
+  data = script()
+  handle, output = delivered(data)
+  assert handle.mode == "memfd"
+  assert handle.name.startswith("/proc/self/fd/")
+  assert output.exit_code == 4
+  assert output.stdout == f"delivered as {handle.name}\n"
+
+@pytest.mark.skipif(not hasattr(os, "memfd_create"), reason="needs memfd_create")
+def test_memfd_is_sealed(bash):
+  data = script()
+  shell.pre(data, {})
+  try:
+    with pytest.raises(OSError):
+      os.write(data["filehandle"].pass_fds[0], b"changed")
+  finally:
+    shell.post(data)
+
+def test_tmpfs(bash, tmp_path):
+  config.read_dict({"tools.shell": {"delivery": "tmpfs", "tmpfs": str(tmp_path)}})
+  handle, output = delivered(script())
+  assert handle.mode == "tmpfs"
+  assert Path(handle.name).parent == tmp_path
+  assert output.stdout == f"delivered as {handle.name}\n"
+  assert list(tmp_path.iterdir()) == []
+
+def test_missing_tmpfs_falls_back(bash, tmp_path):
+  config.read_dict({"tools.shell": {"delivery": "tmpfs", "tmpfs": str(tmp_path / "missing")}})
+  handle, output = delivered(script())
+  assert handle.mode != "tmpfs"
+  assert output.exit_code == 4
+
+def test_stdin(bash):
+  config.read_dict({"tools.shell": {"delivery": "stdin"}})
+  handle, output = delivered(script())
+  assert handle.mode == "stdin"
+  # The script is its stdin, so it reads its own next line
+  assert output.stdout == "delivered as /usr/bin/bash\nstdin: exit 4\n"
+  assert output.exit_code == 0
+
+def test_auto_never_uses_stdin(bash, monkeypatch):
+  # Even with nothing else available, a script keeps its stdin
+  def unavailable(script, name):
+    raise OSError("unavailable")
+  for mode in ("memfd", "tmpfs"):
+    monkeypatch.setitem(shell.DELIVERIES, mode, unavailable)
+  handle, output = delivered(script())
+  assert handle.mode == "file"
+  assert output.stdout == f"delivered as {handle.name}\n"
+
+def test_stdin_needs_known_runner(bash):
+  config.read_dict({"tools.shell": {"delivery": "stdin"}})
+  data = script()
+  data["group"] = ["zsh"]
+  handle = shell.deliver(data, ["stdin", "file"])
+  assert handle.mode == "file"
+  handle.close()
+
+def test_file(bash):
+  config.read_dict({"tools.shell": {"delivery": "file"}})
+  handle, output = delivered(script())
+  assert handle.mode == "file"
+  assert output.exit_code == 4
+  assert not Path(handle.name).exists()
+
+def test_large_scripts_skip_argv(bash):
+  command = "true\n" * (shell.ARGV_MAX // 5 + 1)
+  assert shell.delivery(script(command, serialize=False)) == ["memfd", "tmpfs", "file"]
+  assert shell.delivery(script("true", serialize=False)) == ["argv"]
+  config.read_dict({"tools.shell": {"memory_max": 10}})
+  assert shell.delivery(script(command, serialize=False)) == ["file"]
+
+def test_large_script_runs(bash):
+  command = "x=1\n" * 100000 + "echo done"
+  handle, output = delivered(script(command, serialize=False))
+  assert handle is not None
+  assert output.stdout == "done\n"
+
+def test_unknown_delivery(bash):
+  config.read_dict({"tools.shell": {"delivery": "carrier-pigeon"}})
+  with pytest.raises(RunnerError):
+    shell.pre(script(), {})
@@ -0,0 +1,138 @@
+import os
+import pytest
+import signal
+import time
+from pathlib import Path
+from os_heat_agent.config import config
+from os_heat_agent.runners import babashka, capture, worker
+
+FUNCTIONS = """
+greet() {
+  echo "hello $NAME"
+  echo "to stderr" >&2
+  return 3
+}
+leak() {
+  export LEAKED=yes
+  echo "${LEAKED_BEFORE:-clean}"
+  export LEAKED_BEFORE=dirty
+}
+chatty() {
+  for i in $(seq 1 2000); do echo "line $i"; done
+}
+slow() {
+  sleep 30
+}
+"""
+
+@pytest.fixture
+def directory(tmp_path):
+  path = tmp_path.joinpath("functions")
+  path.mkdir()
+  path.joinpath("functions.sh").write_text(FUNCTIONS)
+  return path
+
+@pytest.fixture
+def pool(monkeypatch):
+  pool = worker.Pool()
+  monkeypatch.setattr(worker, "pool", pool)
+  yield pool
+  pool.close()
+
+@pytest.fixture
+def capture_config(init_config, tmp_path):
+  config.read_dict({
+    "cache": {"dir": str(tmp_path)},
+    "capture": {"head_bytes": 100, "tail_bytes": 50, "spool": "false"},
+  })
+
+def cold(directory: Path, function: str, environment: dict) -> capture.Output:
+  # The same function, in a Bash of its own
+  return capture.run(
+    ["bash", "-c", f"source {directory}/functions.sh; {function}"], environment
+  )
+
+def workers(pool) -> list:
+  return [w for idle in pool._idle.values() for w in idle]
+
+###
+
+@pytest.mark.parametrize("function", ["greet", "chatty"])
+def test_output_matches_cold_run(capture_config, pool, directory, function):
+  environment = {"NAME": "it's $me"}
+  warm = worker.run(directory, function, environment)
+  assert warm == cold(directory, function, environment)
+
+def test_worker_is_reused(pool, directory):
+  worker.run(directory, "greet", {})
+  first = workers(pool)
+  worker.run(directory, "greet", {})
+  assert workers(pool) == first
+  assert len(first) == 1
+
+def test_calls_are_isolated(pool, directory):
+  assert worker.run(directory, "leak", {}).stdout == "clean\n"
+  assert worker.run(directory, "leak", {}).stdout == "clean\n"
+
+def test_timeout(capture_config, pool, directory):
+  config.read_dict({"agent": {"kill_grace": 1}})
+  started = time.monotonic()
+  output = worker.run(directory, "slow", {}, timeout=0.5)
+  assert time.monotonic() - started < 5
+  assert output.timed_out
+  assert output.exit_code == -signal.SIGTERM
+  # The worker survives its call being killed
+  assert worker.run(directory, "greet", {}).exit_code == 3
+
+def test_restarts_when_directory_changes(pool, directory):
+  worker.run(directory, "greet", {"NAME": "a"})
+  old = workers(pool)[0]
+  directory.joinpath("functions.sh").write_text('greet() { echo "changed"; }\n')
+  assert worker.run(directory, "greet", {}).stdout == "changed\n"
+  assert workers(pool)[0] is not old
+  assert not old.alive()
+
+def test_restarts_after_crash(pool, directory):
+  worker.run(directory, "greet", {})
+  crashed = workers(pool)[0]
+  os.kill(crashed.process.pid, signal.SIGKILL)
+  crashed.process.wait()
+  output = worker.run(directory, "greet", {"NAME": "again"})
+  assert output.stdout == "hello again\n"
+  assert workers(pool)[0] is not crashed
+
+def test_invalid_function(pool, directory):
+  with pytest.raises(worker.RunnerError):
+    worker.run(directory, "greet\tnope", {})
+
+def test_failed_start(pool, directory, monkeypatch):
+  monkeypatch.setattr(worker, "SCRIPT", directory.joinpath("missing.sh"))
+  with pytest.raises(worker.WorkerError):
+    worker.run(directory, "greet", {})
+
+###
+
+@pytest.fixture
+def babashka_worker_config(init_config, directory, tmp_path):
+  # Stands in for Babashka itself, when the worker isn't used
+  path = tmp_path.joinpath("babashka")
+  path.write_text('#!/bin/sh\necho "cold $NAME"\n')
+  path.chmod(0o755)
+  config.read_dict({
+    "tools.babashka": {
+      "path": str(path),
+      "variables": "tests/fixtures/variables",
+      "worker": "true",
+    }
+  })
+
+def test_babashka_uses_worker(babashka_worker_config, pool, directory):
+  output = babashka.run({"directory": str(directory), "function": "greet"}, {"NAME": "warm"})
+  assert output.stdout == "hello warm\n"
+  assert output.exit_code == 3
+
+def test_babashka_falls_back(babashka_worker_config, pool, directory, monkeypatch):
+  monkeypatch.setattr(worker, "SCRIPT", directory.joinpath("missing.sh"))
+  output = babashka.run({"directory": str(directory), "function": "greet"}, {"NAME": "run"})
+  assert output.stdout == "cold run\n"
+  assert output.exit_code == 0